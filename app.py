@@ -1,13 +1,8 @@
 import streamlit as st
-import os
 from dotenv import load_dotenv
-from openai import OpenAI
 import pandas as pd
-import PyPDF2
-import pdfplumber
 import io
 from datetime import datetime
-from pathlib import Path
 
 # Import custom modules
 from knowledge_base import get_full_knowledge_base, get_ear_knowledge
@@ -19,7 +14,6 @@ from utils import (
     check_entity_list,
     assess_risk_level,
     generate_action_items,
-    load_eccn_json,
     search_eccn_json,
     get_eccn_by_number,
     get_eccn_categories_summary
@@ -29,19 +23,43 @@ from visualization import (
     create_world_map_restrictions,
     create_regulation_summary_chart,
     create_interactive_eccn_table,
+    filter_eccn_table,
+    ECCN_SEARCH_COLUMN,
     display_reference_data,
     create_entity_list_viewer
 )
+from country_index import get_country_chart_index
+from data_registry import get_registry, get_reference_data
+from lazy_imports import lazy_import, get_lazy_import_report
+from llm_cache import cached_chat_completion, get_llm_cache
+from embedding_cache import get_embedding_cache
+from eccn_index import ECCN_CODE_PATTERN
+from openai_client import get_openai_client, get_openai_client_stats
+from semantic_cache import build_chat_query, chat_cache_scope, embed_text, get_semantic_cache
+from prompt_budget import PromptSegment, fit_prompt
+from prompt_context import (
+    CHAT_CHART_COLUMNS,
+    CONTRACT_CHART_COLUMNS,
+    get_destination_chart_context,
+    get_ranked_eccn_chunks,
+    get_ranked_regulation_chunks
+)
+from step_executor import AnalysisStep, join_sections, run_steps
+from telemetry import trace
+from structured_analysis import RESPONSE_FORMAT, build_system_prompt, parse_structured_analysis, render_sections
 from rag_tools import (
-    LicenseExceptionRAG,
-    check_license_exception_with_rag
+    check_license_exception_with_rag,
+    display_license_exception_analysis,
+    get_license_exception_rag,
+    get_license_exception_rag_health
 )
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def get_client():
+    """Get the process-wide OpenAI client (connection pool, timeouts, retries and a concurrency limit shared by all sessions)"""
+    return get_openai_client()
 
 # Page config
 st.set_page_config(
@@ -478,37 +496,8 @@ header {visibility: hidden;}
 
 # Define functions before session state initialization
 def load_sample_data():
-    """Load sample data"""
-    sample_data_dir = Path("sample_data")
-    data = {}
-    
-    # ECCN List (CSV)
-    eccn_path = sample_data_dir / "eccn_list.csv"
-    if eccn_path.exists():
-        data['eccn_csv'] = pd.read_csv(eccn_path)
-    
-    # ECCN List (JSON) - more detailed data
-    eccn_json_path = Path("eccnnumber.json")
-    if eccn_json_path.exists():
-        data['eccn_json'] = load_eccn_json(str(eccn_json_path))
-        # Display success message later
-    
-    # Country Chart (US EAR)
-    country_chart_path = Path("11_12_2025_country_chart_export.csv")
-    if country_chart_path.exists():
-        data['country_chart'] = pd.read_csv(country_chart_path)
-    
-    # Country Groups
-    country_path = sample_data_dir / "country_groups.csv"
-    if country_path.exists():
-        data['countries'] = pd.read_csv(country_path)
-    
-    # Entity List
-    entity_path = sample_data_dir / "entity_list_sample.csv"
-    if entity_path.exists():
-        data['entities'] = pd.read_csv(entity_path)
-    
-    return data
+    """Load sample data (shared, read-only registry across all sessions)"""
+    return get_reference_data()
 
 # Initialize session state
 if 'analysis_result' not in st.session_state:
@@ -517,13 +506,14 @@ if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 if 'extracted_info' not in st.session_state:
     st.session_state.extracted_info = None
-if 'sample_data' not in st.session_state:
-    st.session_state.sample_data = load_sample_data()
+# Reference data is owned by the process-wide registry; sessions only hold a reference
+st.session_state.sample_data = load_sample_data()
 
 def extract_text_from_pdf(pdf_file):
     """Extract text from PDF (using pdfplumber for better accuracy)"""
     try:
         # Try pdfplumber
+        pdfplumber = lazy_import("pdfplumber")
         with pdfplumber.open(io.BytesIO(pdf_file.read())) as pdf:
             text = ""
             for page in pdf.pages:
@@ -535,6 +525,7 @@ def extract_text_from_pdf(pdf_file):
         # Fallback: Use PyPDF2
         st.warning(f"Failed to extract with pdfplumber. Falling back to PyPDF2: {str(e)}")
         pdf_file.seek(0)  # Reset file pointer to the beginning
+        PyPDF2 = lazy_import("PyPDF2")
         pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_file.read()))
         text = ""
         for page in pdf_reader.pages:
@@ -548,35 +539,10 @@ def load_knowledge_base():
 def analyze_contract_with_gpt(contract_text, knowledge_base):
     """Analyze contract with GPT (US EAR Re-export Regulations only)"""
     
-    # Prepare ECCN database
-    eccn_json = st.session_state.sample_data.get('eccn_json')
-    eccn_data_text = ""
-    if eccn_json and 'ccl_categories' in eccn_json:
-        eccn_data_text = "\n[ECCN Number Database (Complete)]\n"
-        for category in eccn_json['ccl_categories']:
-            eccn_data_text += f"\n## Category {category.get('category_number', '')}: {category.get('title', '')}\n"
-            for group in category.get('product_groups', []):
-                eccn_data_text += f"\n### {group.get('group_title', '')}\n"
-                for item in group.get('items', [])[:10]:  # Max 10 items from each group
-                    eccn_data_text += f"- **{item.get('eccn', '')}**: {item.get('description', '')[:200]}...\n"
-    
-    # Prepare Country Chart data
-    country_chart = st.session_state.sample_data.get('country_chart')
-    country_chart_text = ""
-    if country_chart is not None and not country_chart.empty:
-        country_chart_text = "\n[Country Chart (Complete)]\n"
-        country_chart_text += "Below is actual US EAR Country Chart data. 'X' indicates license required.\n\n"
-        # Include first ~30 countries (considering token limit)
-        for idx, row in country_chart.head(30).iterrows():
-            country_name = row.iloc[0]
-            country_chart_text += f"\n**{country_name}**:\n"
-            # Show only key regulation reason columns
-            key_columns = ['NS 1', 'NS 2', 'MT 1', 'NP 1', 'NP 2', 'CB 1', 'AT 1']
-            for col in key_columns:
-                if col in row.index and pd.notna(row[col]):
-                    country_chart_text += f"  - {col}: {row[col]}\n"
-    
-    prompt = f"""
+    # Ranked ECCN chunks and the destination rows of the Country Chart (same context as the step-by-step mode)
+    eccn_chunks, country_chart_text = contract_reference_context(contract_text, st.session_state.sample_data)
+
+    prompt_template = """
 You are an expert on US EAR re-export regulations. Analyze the following contract and determine US EAR regulatory requirements.
 
 [Important Prerequisites]
@@ -584,14 +550,14 @@ This system analyzes only US EAR regulations for "re-exporting US-origin items f
 Japanese Foreign Exchange and Foreign Trade Act is outside the scope.
 
 [Contract Content]
-{contract_text[:5000]}  # First 5000 chars due to token limit
+{contract}
 
-{eccn_data_text[:3000]}
+{eccn}
 
-{country_chart_text[:3000]}
+{chart}
 
 [Knowledge Base (Reference)]
-{knowledge_base[:1000]}
+{knowledge}
 
 Please analyze the following items in detail:
 
@@ -643,63 +609,242 @@ Specific procedures and contact points for BIS license application if required
 
 Please respond in a clear and structured format.
 """
+    # Token budget: the contract comes first, then the most relevant ECCN groups and chart rows
+    prompt = budget_prompt(prompt_template, [
+        PromptSegment.text("contract", contract_text, priority=3, max_tokens=2500),
+        PromptSegment("eccn", eccn_chunks, priority=2, max_tokens=1200),
+        PromptSegment.blocks("chart", country_chart_text, priority=2, max_tokens=1200),
+        PromptSegment.blocks("knowledge", knowledge_base, priority=1, max_tokens=400),
+    ], PROMPT_BUDGETS["contract:full"])
 
     try:
-        response = client.chat.completions.create(
+        return cached_chat_completion(
+            get_client(),
             model="gpt-4-turbo-preview",
             messages=[
                 {"role": "system", "content": "You are an expert on US EAR re-export regulations. You analyze regulations for re-exporting US-origin items from Japan to other countries. Japanese FEFTA is out of scope."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=3000
+            max_tokens=3000,
+            step="contract:full"
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         st.error(f"Analysis Error: {str(e)}")
         return None
 
 
-def analyze_contract_step_by_step(contract_text, knowledge_base, result_container):
-    """Analyze contract step by step with GPT (US EAR Re-export Regulations only)"""
+ANALYSIS_MODEL = "gpt-4-turbo-preview"
+
+# Prompt token budget per step (segments are filled by priority within the budget)
+PROMPT_BUDGETS = {
+    "contract:full": 6000,
+    "contract:step1": 1500,
+    "contract:step2a": 1000,
+    "contract:step2b": 1500,
+    "contract:step2c": 1500,
+    "contract:step2d": 500,
+    "contract:step2e": 500,
+    "contract:step3": 3000,
+    "contract:step4": 400,
+    "chat:step1": 1200,
+    "chat:step2": 1200,
+    "chat:step3": 1800,
+    "chat:step4": 3000,
+    "contract:single": 4000,
+    "chat:single": 3000,
+}
+
+
+def budget_prompt(template, segments, budget, usage=None, key=None):
+    """Fill the template's {segment} placeholders within the token budget and record the usage report"""
+    prompt, report = fit_prompt(template, segments, budget)
+    if usage is not None:
+        usage[key] = report
+    return prompt
+
+
+def render_prompt_usage(steps, usage, result_container):
+    """Show prompt token usage per step (budget, tokens used and truncated segments)"""
+    if not usage:
+        return
+    rows = []
+    for step in steps:
+        report = usage.get(step.key)
+        if report is None:
+            continue
+        rows.append({
+            "Step": step.title,
+            "Prompt tokens": report["prompt_tokens"],
+            "Budget": report["budget"],
+            "Segments": ", ".join(
+                f"{name} {seg['used']}/{seg['available']}{' ✂️' if seg['truncated'] else ''}"
+                for name, seg in report["segments"].items()
+            ),
+        })
+    tokenizer = next(iter(usage.values()))["tokenizer"]
+    with result_container:
+        with st.expander(f"🧮 Prompt token usage ({sum(row['Prompt tokens'] for row in rows):,} tokens, {tokenizer})"):
+            st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+
+def render_performance(analysis_trace, result_container):
+    """Show the collapsible Performance panel: wall, queue and first-token time, tokens and estimated cost per step"""
+    totals = analysis_trace.totals()
+    if not totals["calls"]:
+        return
+    rows = [
+        {
+            "Step": group["label"],
+            "Calls": group["calls"],
+            "Kind": ", ".join(group["kinds"]),
+            "Wall (ms)": round(group["wall_ms"]),
+            "Queue (ms)": round(group["queue_ms"]),
+            "First token (ms)": round(group["first_token_ms"]) if group["first_token_ms"] is not None else None,
+            "Prompt tokens": group["prompt_tokens"],
+            "Completion tokens": group["completion_tokens"],
+            "Est. cost (USD)": round(group["cost_usd"], 4),
+            "Cached": group["cached"],
+            "Retries": group["retries"],
+            "Errors": group["errors"],
+        }
+        for group in analysis_trace.by_label()
+    ]
+    tokens = totals["prompt_tokens"] + totals["completion_tokens"]
+    with result_container:
+        with st.expander(
+            f"⚡ Performance ({totals['elapsed_ms'] / 1000:.1f} s · {totals['calls']} calls · "
+            f"{tokens:,} tokens · ${totals['cost_usd']:.4f})"
+        ):
+            st.caption(
+                f"Call time adds up to {totals['call_ms'] / 1000:.1f} s because concurrent steps overlap. "
+                f"Cached calls cost $0. Trace {analysis_trace.trace_id} is also written to the call log."
+            )
+            st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+
+def _step_model_caller(pipeline_name):
+    """Build the call_model function for run_steps (runs in worker threads, streams through the response cache)"""
+    def call_step_model(step, prompt, on_token):
+        return cached_chat_completion(
+            get_client(),
+            model=ANALYSIS_MODEL,
+            messages=[
+                {"role": "system", "content": step.system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=step.temperature,
+            max_tokens=step.max_tokens,
+            step=f"{pipeline_name}:{step.key}",
+            on_token=on_token,
+            response_format=step.response_format
+        )
+    return call_step_model
+
+
+def run_analysis_steps(steps, result_container, pipeline_name, prompt_usage=None):
+    """
+    Run analysis steps concurrently and stream each one's tokens into its own placeholder.
+    Placeholders are created in step order, so the page layout stays fixed regardless of completion order.
+    """
+    with result_container:
+        placeholders = {step.key: st.empty() for step in steps}
+    for step in steps:
+        placeholders[step.key].caption(f"⏳ {step.running_label}")
     
-    # Prepare ECCN database
-    eccn_json = st.session_state.sample_data.get('eccn_json')
-    eccn_data_text = ""
-    if eccn_json and 'ccl_categories' in eccn_json:
-        eccn_data_text = "\n[ECCN Number Database (Complete)]\n"
-        for category in eccn_json['ccl_categories']:
-            eccn_data_text += f"\n## Category {category.get('category_number', '')}: {category.get('title', '')}\n"
-            for group in category.get('product_groups', []):
-                eccn_data_text += f"\n### {group.get('group_title', '')}\n"
-                for item in group.get('items', [])[:10]:
-                    eccn_data_text += f"- **{item.get('eccn', '')}**: {item.get('description', '')[:200]}...\n"
+    def render_step(step, text, streaming=False):
+        with placeholders[step.key].container():
+            st.markdown(f"### {step.title}")
+            st.markdown(text + (" ▌" if streaming else ""))
+            st.markdown("---")
+    
+    def render_result(step, result):
+        if result.skipped:
+            placeholders[step.key].empty()
+        elif result.error is not None:
+            placeholders[step.key].error(f"{step.error_label or step.key + ' Error'}: {str(result.error)}")
+        else:
+            render_step(step, result.content)
+    
+    # Create the shared client on the main thread before fanning out
+    get_client()
+    pipeline = run_steps(
+        steps,
+        _step_model_caller(pipeline_name),
+        on_done=render_result,
+        on_progress=lambda step, text: render_step(step, text, streaming=True)
+    )
+    if pipeline.aborted:
+        # Steps still running (or never started) when a required step failed are abandoned; drop their progress
+        for step in steps:
+            if step.key not in pipeline.results:
+                placeholders[step.key].caption(f"⏹️ {step.title}: cancelled because an earlier step failed")
+    render_prompt_usage(steps, prompt_usage, result_container)
+    return pipeline
+
+
+def contract_reference_context(contract_text, sample_data):
+    """ECCN chunks ranked for the contract and the Country Chart text for its destination(s)"""
+    # Prepare ECCN database / Country Chart data (built once per reference data version)
+    # ECCN groups are ordered by relevance to the contract so the token budget keeps the best matches
+    eccn_chunks = get_ranked_eccn_chunks(contract_text, sample_data.get('eccn_json'))
+    # Country Chart rows for the destination(s) named in the contract, plus their footnotes
+    destination = extract_contract_info(contract_text).get("Destination", "")
+    country_chart_text = get_destination_chart_context(destination, sample_data.get('country_chart'), 30, CONTRACT_CHART_COLUMNS)
+    return eccn_chunks, country_chart_text
+
+
+# Step key → (title, section heading); shared by the step-by-step and single-pass modes
+CONTRACT_SECTIONS = {
+    'step1': ("📝 Step 1: Contract Information Extraction", "## 1. Contract Information Extraction"),
+    'step2a': ("🔍 Step 2-A: EAR-Controlled Items Determination", "### A. EAR対象Productの判定"),
+    'step2b': ("🔢 Step 2-B: ECCN Number Determination", "### B. ECCN Number Determination"),
+    'step2c': ("🗺️ Step 2-C: Country Chart Analysis", "### C. Country Chart Analysis"),
+    'step2d': ("📋 Step 2-D: License Exception Review", "### D. License Exception Review"),
+    'step2e': ("🚨 Step 2-E: Embargo & Restricted Lists", "### E. Embargo Countries & Restricted Lists"),
+    'step3': ("📊 Step 3: Overall Assessment & Risk Evaluation", "## 3. Overall Assessment & Risk Evaluation"),
+    'step4': ("📝 Step 4: Required Procedures", "## 4. Required Procedures"),
+}
+
+# Step key → (title, section heading) for the chat consultation
+CHAT_SECTIONS = {
+    'step1': ("🔢 Step 1: ECCN Number Determination", "## ステップ1: ECCN番号判定"),
+    'step2': ("🗺️ Step 2: Country Chart Analysis", "## ステップ2: カントリーチャート分析"),
+    'step3': ("🚨 Step 3: General Prohibitions Check", "## ステップ3: General Prohibitions"),
+    'step4': ("📊 ステップ4: 総合判定とリスク評価", "## ステップ4: 総合判定"),
+}
+
+
+def section_step(sections, key, running_label, system_prompt, build_prompt, **options):
+    """AnalysisStep whose title and section heading come from the pipeline's section table"""
+    title, heading = sections[key]
+    return AnalysisStep(key, title, running_label, heading, system_prompt, build_prompt, **options)
+
+
+def join_section_table(sections, contents):
+    """Join section texts in table order under their headings (the single-pass counterpart of join_sections)"""
+    return ''.join(f"{heading}\n{contents[key]}\n\n" for key, (title, heading) in sections.items() if key in contents)
+
+
+CONTRACT_EXPERT = "あなたは米国EAR再輸出規制の専門家です。"
+
+
+def contract_analysis_steps(contract_text, sample_data, prompt_usage=None):
+    """Build the step-by-step contract analysis (US EAR Re-export Regulations only); prompts are built when each step starts"""
     
-    # Prepare Country Chart data
-    country_chart = st.session_state.sample_data.get('country_chart')
-    country_chart_text = ""
-    if country_chart is not None and not country_chart.empty:
-        country_chart_text = "\n[Country Chart (Complete)]\n"
-        country_chart_text += "Below is actual US EAR Country Chart data. 'X' indicates license required.\n\n"
-        for idx, row in country_chart.head(30).iterrows():
-            country_name = row.iloc[0]
-            country_chart_text += f"\n**{country_name}**:\n"
-            key_columns = ['NS 1', 'NS 2', 'MT 1', 'NP 1', 'NP 2', 'CB 1', 'AT 1']
-            for col in key_columns:
-                if col in row.index and pd.notna(row[col]):
-                    country_chart_text += f"  - {col}: {row[col]}\n"
+    eccn_chunks, country_chart_text = contract_reference_context(contract_text, sample_data)
+    expert = CONTRACT_EXPERT
     
-    # Analysis Resultsを格納
-    full_analysis = ""
+    def contract_segment(max_tokens):
+        return PromptSegment.text("contract", contract_text, priority=2, max_tokens=max_tokens)
     
     # ステップ1: 契約情報の抽出
-    with st.spinner("📝 Step 1: Extracting contract information..."):
-        step1_prompt = f"""
+    def build_step1_prompt(results):
+        return budget_prompt("""
 あなたは米国EAR再輸出規制の専門家です。Extract important information from the following contract.
 
 [Contract Content]
-{contract_text[:3000]}
+{contract}
 
 Extract the following information:
 ## 1. Contract Information Extraction
@@ -711,32 +856,12 @@ Extract the following information:
 - Delivery Date
 
 Please respond concisely in bullet points.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。"},
-                    {"role": "user", "content": step1_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
-            )
-            step1_result = response.choices[0].message.content
-            full_analysis += f"## 1. Contract Information Extraction\n{step1_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 📝 Step 1: Contract Information Extraction")
-                st.markdown(step1_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 1 Error: {str(e)}")
-            return None
+""", [contract_segment(1200)], PROMPT_BUDGETS["contract:step1"], prompt_usage, 'step1')
     
     # ステップ2-A: EAR対象Product判定
-    with st.spinner("🔍 Step 2-A: Determining EAR-controlled items..."):
-        step2a_prompt = f"""
-{contract_text[:2000]}
+    def build_step2a_prompt(results):
+        return budget_prompt("""
+{contract}
 
 For the above contract, determine the following:
 
@@ -746,33 +871,14 @@ For the above contract, determine the following:
 - Applicability of Foreign Direct Product (FDP) rule
 
 Please make a concise determination.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。"},
-                    {"role": "user", "content": step2a_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=400
-            )
-            step2a_result = response.choices[0].message.content
-            full_analysis += f"### A. EAR対象Productの判定\n{step2a_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 🔍 Step 2-A: EAR-Controlled Items Determination")
-                st.markdown(step2a_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 2-A Error: {str(e)}")
+""", [contract_segment(800)], PROMPT_BUDGETS["contract:step2a"], prompt_usage, 'step2a')
     
     # ステップ2-B: ECCN番号判定
-    with st.spinner("🔢 Step 2-B: Determining ECCN number..."):
-        step2b_prompt = f"""
-Product: {contract_text[:1000]}
+    def build_step2b_prompt(results):
+        return budget_prompt("""
+Product: {contract}
 
-{eccn_data_text[:2500]}
+{eccn}
 
 Refer to the ECCN database above and determine the most appropriate ECCN number.
 
@@ -784,33 +890,14 @@ Refer to the ECCN database above and determine the most appropriate ECCN number.
 - **Selection Rationale**: [Why this ECCN was chosen]
 
 Please respond in the format above.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。ECCNデータベースを参照して正確に判定してください。"},
-                    {"role": "user", "content": step2b_prompt}
-                ],
-                temperature=0.2,
-                max_tokens=600
-            )
-            step2b_result = response.choices[0].message.content
-            full_analysis += f"### B. ECCN Number Determination\n{step2b_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 🔢 Step 2-B: ECCN Number Determination")
-                st.markdown(step2b_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 2-B Error: {str(e)}")
+""", [contract_segment(300), PromptSegment("eccn", eccn_chunks, priority=1)], PROMPT_BUDGETS["contract:step2b"], prompt_usage, 'step2b')
     
     # ステップ2-C: カントリーチャート分析
-    with st.spinner("🗺️ Step 2-C: Analyzing Country Chart..."):
-        step2c_prompt = f"""
-Product: {contract_text[:1000]}
+    def build_step2c_prompt(results):
+        return budget_prompt("""
+Product: {contract}
 
-{country_chart_text[:2500]}
+{chart}
 
 Refer to the Country Chart data above and determine regulations for the destination country.
 
@@ -821,31 +908,12 @@ Refer to the Country Chart data above and determine regulations for the destinat
 - Overall determination (License Required or License Exception Available or No License Required)
 
 Please respond in the format above.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。カントリーチャートを参照して正確に判定してください。"},
-                    {"role": "user", "content": step2c_prompt}
-                ],
-                temperature=0.2,
-                max_tokens=600
-            )
-            step2c_result = response.choices[0].message.content
-            full_analysis += f"### C. Country Chart Analysis\n{step2c_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 🗺️ Step 2-C: Country Chart Analysis")
-                st.markdown(step2c_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 2-C Error: {str(e)}")
+""", [contract_segment(300), PromptSegment.blocks("chart", country_chart_text, priority=1)], PROMPT_BUDGETS["contract:step2c"], prompt_usage, 'step2c')
     
     # ステップ2-D: 許可例外の検討
-    with st.spinner("📋 Step 2-D: Reviewing License Exceptions..."):
-        step2d_prompt = f"""
-Product: {contract_text[:1000]}
+    def build_step2d_prompt(results):
+        return budget_prompt("""
+Product: {contract}
 
 ### D. License Exception Review
 Applicable license exceptions（LVS, GBS, TSR, TMP, ENCetc.）について検討してください。
@@ -855,31 +923,12 @@ Applicable license exceptions（LVS, GBS, TSR, TMP, ENCetc.）について検討
 - Determination rationale
 
 簡潔に回答してください。
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。"},
-                    {"role": "user", "content": step2d_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
-            )
-            step2d_result = response.choices[0].message.content
-            full_analysis += f"### D. License Exception Review\n{step2d_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 📋 Step 2-D: License Exception Review")
-                st.markdown(step2d_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 2-D Error: {str(e)}")
+""", [contract_segment(300)], PROMPT_BUDGETS["contract:step2d"], prompt_usage, 'step2d')
     
     # ステップ2-E: 禁輸国・リスト規制
-    with st.spinner("🚨 Step 2-E: Checking Embargo & Restricted Lists..."):
-        step2e_prompt = f"""
-Product: {contract_text[:1000]}
+    def build_step2e_prompt(results):
+        return budget_prompt("""
+Product: {contract}
 
 ### E. Embargo Countries & Restricted Lists
 Please check the following:
@@ -890,32 +939,15 @@ Please check the following:
 - Military End User List該当チェック
 
 Please make a concise determination.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。"},
-                    {"role": "user", "content": step2e_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=400
-            )
-            step2e_result = response.choices[0].message.content
-            full_analysis += f"### E. Embargo Countries & Restricted Lists\n{step2e_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 🚨 Step 2-E: Embargo & Restricted Lists")
-                st.markdown(step2e_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 2-E Error: {str(e)}")
+""", [contract_segment(300)], PROMPT_BUDGETS["contract:step2e"], prompt_usage, 'step2e')
     
-    # ステップ3: 総合判定とリスク評価
-    with st.spinner("📊 Step 3: Overall Assessment & Risk Evaluation..."):
-        step3_prompt = f"""
+    # ステップ3: 総合判定とリスク評価（ステップ1〜2-Eの結果を定義順に連結して使用）
+    def build_step3_prompt(results):
+        # Each prior step's section is one chunk, kept in step order
+        sections = [join_sections([step], results) for step in steps[:6]]
+        return budget_prompt("""
 Analysis results so far:
-{full_analysis}
+{analysis}
 
 Based on the analysis results above, make an overall assessment.
 
@@ -925,73 +957,101 @@ Based on the analysis results above, make an overall assessment.
 - **Recommended Actions**: Specific next steps
 
 Please make a clear determination.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。"},
-                    {"role": "user", "content": step3_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=600
-            )
-            step3_result = response.choices[0].message.content
-            full_analysis += f"## 3. Overall Assessment & Risk Evaluation\n{step3_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 📊 Step 3: Overall Assessment & Risk Evaluation")
-                st.markdown(step3_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 3 Error: {str(e)}")
+""", [PromptSegment("analysis", sections)], PROMPT_BUDGETS["contract:step3"], prompt_usage, 'step3')
     
     # ステップ4: 必要な手続き
-    with st.spinner("📝 Step 4: Determining Required Procedures..."):
-        step4_prompt = f"""
-Overall Assessment: {step3_result[:500]}
+    def build_step4_prompt(results):
+        return budget_prompt("""
+Overall Assessment: {assessment}
 
 ## 4. Required Procedures
 Specific procedures and contact points for BIS license application if requiredを説明してください。
 
 簡潔に回答してください。
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR再輸出規制の専門家です。"},
-                    {"role": "user", "content": step4_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
-            )
-            step4_result = response.choices[0].message.content
-            full_analysis += f"## 4. Required Procedures\n{step4_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 📝 Step 4: Required Procedures")
-                st.markdown(step4_result)
-        except Exception as e:
-            st.error(f"Step 4 Error: {str(e)}")
+""", [PromptSegment.text("assessment", results['step3'], max_tokens=200)], PROMPT_BUDGETS["contract:step4"], prompt_usage, 'step4')
     
-    return full_analysis
-
+    # Step 1 and Steps 2-A〜2-E depend only on the contract text, so they run concurrently;
+    # Step 3 waits for all of them and Step 4 needs Step 3's result
+    independent = ('step1', 'step2a', 'step2b', 'step2c', 'step2d', 'step2e')
+    steps = [
+        section_step(CONTRACT_SECTIONS, 'step1', "Step 1: Extracting contract information...",
+                     expert, build_step1_prompt,
+                     temperature=0.3, max_tokens=500, abort_on_error=True, error_label="Step 1 Error"),
+        section_step(CONTRACT_SECTIONS, 'step2a', "Step 2-A: Determining EAR-controlled items...",
+                     expert, build_step2a_prompt,
+                     temperature=0.3, max_tokens=400, error_label="Step 2-A Error"),
+        section_step(CONTRACT_SECTIONS, 'step2b', "Step 2-B: Determining ECCN number...",
+                     expert + "ECCNデータベースを参照して正確に判定してください。", build_step2b_prompt,
+                     temperature=0.2, max_tokens=600, error_label="Step 2-B Error"),
+        section_step(CONTRACT_SECTIONS, 'step2c', "Step 2-C: Analyzing Country Chart...",
+                     expert + "カントリーチャートを参照して正確に判定してください。", build_step2c_prompt,
+                     temperature=0.2, max_tokens=600, error_label="Step 2-C Error"),
+        section_step(CONTRACT_SECTIONS, 'step2d', "Step 2-D: Reviewing License Exceptions...",
+                     expert, build_step2d_prompt,
+                     temperature=0.3, max_tokens=500, error_label="Step 2-D Error"),
+        section_step(CONTRACT_SECTIONS, 'step2e', "Step 2-E: Checking Embargo & Restricted Lists...",
+                     expert, build_step2e_prompt,
+                     temperature=0.3, max_tokens=400, error_label="Step 2-E Error"),
+        section_step(CONTRACT_SECTIONS, 'step3', "Step 3: Overall Assessment & Risk Evaluation...",
+                     expert, build_step3_prompt,
+                     temperature=0.3, max_tokens=600, depends_on=independent, error_label="Step 3 Error"),
+        section_step(CONTRACT_SECTIONS, 'step4', "Step 4: Determining Required Procedures...",
+                     expert, build_step4_prompt,
+                     temperature=0.3, max_tokens=500, requires=('step3',), error_label="Step 4 Error"),
+    ]
+    
+    return steps
 
 
-def analyze_chat_step_by_step(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, result_container):
-    """Step-by-step analysis for chat consultation"""
+def analyze_contract_step_by_step(contract_text, knowledge_base, result_container):
+    """Analyze contract step by step with GPT (US EAR Re-export Regulations only)"""
+    prompt_usage = {}
+    steps = contract_analysis_steps(contract_text, st.session_state.sample_data, prompt_usage)
     
-    full_analysis = ""
+    pipeline = run_analysis_steps(steps, result_container, 'contract', prompt_usage)
+    if pipeline.aborted:
+        return None
     
-    # ステップ1: ECCN番号判定
-    with st.spinner("🔢 Step 1: Determining ECCN number..."):
-        step1_prompt = f"""
+    # Analysis Results（完了順に関係なくステップの定義順で連結）
+    return join_sections(steps, pipeline.contents())
+
+
+def eccn_prompt_segment(eccn_context, priority=0, max_tokens=None):
+    """ECCN segment from ranked chunks (list) or a plain database text"""
+    if isinstance(eccn_context, list):
+        return PromptSegment("eccn", eccn_context, priority, max_tokens)
+    return PromptSegment.blocks("eccn", eccn_context, priority, max_tokens)
+
+
+CHAT_EXPERT = "あなたは米国EAR規制の専門家です。"
+
+
+def chat_input_segments(product_input, destination_input, additional_info):
+    """
+    The user's chat inputs as budgeted segments (product, destination, additional info).
+    Like {contract}, they are capped and inserted in one pass, so long or brace-containing text cannot crowd out
+    or inject into the reference context.
+    """
+    return (
+        PromptSegment.text("product", product_input, priority=3, max_tokens=300),
+        PromptSegment.text("destination", destination_input or 'Not specified', priority=3, max_tokens=100),
+        PromptSegment.text("additional_info", additional_info or 'None', priority=2, max_tokens=500),
+    )
+
+
+def chat_analysis_steps(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, prompt_usage=None):
+    """Build the step-by-step chat consultation analysis; prompts are built when each step starts"""
+    product, destination, additional = chat_input_segments(product_input, destination_input, additional_info)
+    
+    # ステップ1: ECCN番号判定（eccn_context はチャンクのリスト、またはテキスト）
+    eccn_segment = eccn_prompt_segment(eccn_context)
+    def build_step1_prompt(results):
+        return budget_prompt("""
 あなたは米国輸出管理規則（EAR）の専門家です。
 
-Product Name: {product_input}
+Product Name: {product}
 
-{eccn_context[:2500]}
+{eccn}
 
 Refer to the ECCN database above and determine the most appropriate ECCN number.
 
@@ -1001,36 +1061,17 @@ Refer to the ECCN database above and determine the most appropriate ECCN number.
 - **Group**: [Group name]
 - **Reason for Control**: [NS, AT, MTetc.]
 - **選定理由**: [詳細な理由]
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR規制の専門家です。"},
-                    {"role": "user", "content": step1_prompt}
-                ],
-                temperature=0.2,
-                max_tokens=600
-            )
-            step1_result = response.choices[0].message.content
-            full_analysis += f"## ステップ1: ECCN番号判定\n{step1_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 🔢 Step 1: ECCN Number Determination")
-                st.markdown(step1_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 1 Error: {str(e)}")
-            return None
+""", [product, eccn_segment], PROMPT_BUDGETS["chat:step1"], prompt_usage, 'step1')
     
-    # ステップ2: カントリーチャート分析
-    if destination_input:
-        with st.spinner("🗺️ Step 2: Analyzing Country Chart..."):
-            step2_prompt = f"""
-Product: {product_input}
-Destination: {destination_input}
+    # ステップ2: カントリーチャート分析（仕向地が入力された場合のみ）
+    def build_step2_prompt(results):
+        if not destination_input:
+            return None
+        return budget_prompt("""
+Product: {product}
+Destination: {destination}
 
-{chart_context[:2500]}
+{chart}
 
 Refer to the Country Chart above and determine regulations for Destination.
 
@@ -1039,34 +1080,18 @@ Refer to the Country Chart above and determine regulations for Destination.
 - 規制理由（NS, AT, MTetc.）ごとの許可要否
 - 「×」マークがある場合は許可必要
 - 総合判定
-"""
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-4-turbo-preview",
-                    messages=[
-                        {"role": "system", "content": "あなたは米国EAR規制の専門家です。"},
-                        {"role": "user", "content": step2_prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=600
-                )
-                step2_result = response.choices[0].message.content
-                full_analysis += f"## ステップ2: カントリーチャート分析\n{step2_result}\n\n"
-                
-                with result_container:
-                    st.markdown("### 🗺️ Step 2: Country Chart Analysis")
-                    st.markdown(step2_result)
-                    st.markdown("---")
-            except Exception as e:
-                st.error(f"ステップ2エラー: {str(e)}")
+""", [product, destination, PromptSegment.blocks("chart", chart_context)], PROMPT_BUDGETS["chat:step2"], prompt_usage, 'step2')
     
-    # ステップ3: General Prohibitions確認
-    with st.spinner("🚨 Step 3: Checking General Prohibitions..."):
-        step3_prompt = f"""
-Product: {product_input}
-Destination: {destination_input if destination_input else 'Not specified'}
+    # ステップ3: General Prohibitions確認（GP4〜GP8の条文を先頭に、品目・用途に関連する項を優先して埋め込む）
+    regulation_chunks = get_ranked_regulation_chunks(f"{product_input} {destination_input} {additional_info}")
+    def build_step3_prompt(results):
+        return budget_prompt("""
+Product: {product}
+Destination: {destination}
+
+{regulations}
 
-{knowledge_base[:1500]}
+{knowledge}
 
 Please check the following:
 
@@ -1077,35 +1102,22 @@ Please check the following:
 **GP8: Transit Controls**
 
 Determine applicability for each item.
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR規制の専門家です。"},
-                    {"role": "user", "content": step3_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=600
-            )
-            step3_result = response.choices[0].message.content
-            full_analysis += f"## ステップ3: General Prohibitions\n{step3_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 🚨 Step 3: General Prohibitions Check")
-                st.markdown(step3_result)
-                st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 3 Error: {str(e)}")
+""", [
+            product,
+            destination,
+            PromptSegment("regulations", regulation_chunks, priority=1, max_tokens=1200),
+            PromptSegment.blocks("knowledge", knowledge_base),
+        ], PROMPT_BUDGETS["chat:step3"], prompt_usage, 'step3')
     
-    # ステップ4: 総合判定
-    with st.spinner("📊 Step 4: Overall Assessment & Risk Evaluation..."):
-        step4_prompt = f"""
+    # ステップ4: 総合判定（ステップ1〜3の結果を定義順に連結して使用）
+    def build_step4_prompt(results):
+        sections = [join_sections([step], results) for step in steps[:3]]
+        return budget_prompt("""
 Analysis results so far:
 
-{full_analysis}
+{analysis}
 
-Additional Info: {additional_info if additional_info else 'None'}
+Additional Info: {additional_info}
 
 Based on the analysis results above, make an overall assessment.
 
@@ -1122,28 +1134,201 @@ Based on the analysis results above, make an overall assessment.
 1. [Specific next steps]
 2. [Items to verify]
 3. [Procedures if application required]
-"""
+""", [additional, PromptSegment("analysis", sections, priority=1)], PROMPT_BUDGETS["chat:step4"], prompt_usage, 'step4')
+    
+    # Steps 1-3 are independent and run concurrently; Step 4 waits for all of them
+    expert = CHAT_EXPERT
+    steps = [
+        section_step(CHAT_SECTIONS, 'step1', "Step 1: Determining ECCN number...",
+                     expert, build_step1_prompt,
+                     temperature=0.2, max_tokens=600, abort_on_error=True, error_label="Step 1 Error"),
+        section_step(CHAT_SECTIONS, 'step2', "Step 2: Analyzing Country Chart...",
+                     expert, build_step2_prompt,
+                     temperature=0.2, max_tokens=600, error_label="ステップ2エラー"),
+        section_step(CHAT_SECTIONS, 'step3', "Step 3: Checking General Prohibitions...",
+                     expert, build_step3_prompt,
+                     temperature=0.3, max_tokens=600, error_label="Step 3 Error"),
+        section_step(CHAT_SECTIONS, 'step4', "Step 4: Overall Assessment & Risk Evaluation...",
+                     expert, build_step4_prompt,
+                     temperature=0.3, max_tokens=700, depends_on=('step1', 'step2', 'step3'), error_label="Step 4 Error"),
+    ]
+    
+    return steps
+
+
+def analyze_chat_step_by_step(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, result_container):
+    """
+    Step-by-step analysis for chat consultation.
+    Returns (analysis, complete); complete is False if any step failed, so partial answers are not cached.
+    """
+    prompt_usage = {}
+    steps = chat_analysis_steps(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, prompt_usage)
+    
+    pipeline = run_analysis_steps(steps, result_container, 'chat', prompt_usage)
+    if pipeline.aborted:
+        return None, False
+    
+    return join_sections(steps, pipeline.contents()), pipeline.complete
+
+
+# Single-pass mode: one JSON-mode call fills the same sections as the step-by-step pipelines
+SINGLE_PASS_MODE = "Single pass (one structured call)"
+ANALYSIS_MODES = ("Step-by-step (streamed)", SINGLE_PASS_MODE)
+
+CONTRACT_SECTION_FIELDS = {
+    'step1': 'contract_info',
+    'step2a': 'ear_applicability',
+    'step2b': 'eccn',
+    'step2c': 'country_chart',
+    'step2d': 'license_exceptions',
+    'step2e': 'general_prohibitions',
+    'step3': 'risk',
+    'step4': 'procedures',
+}
+CHAT_SECTION_FIELDS = {
+    'step1': 'eccn',
+    'step2': 'country_chart',
+    'step3': 'general_prohibitions',
+    'step4': 'risk',
+}
+
+
+def contract_single_pass_step(contract_text, sample_data, knowledge_base="", prompt_usage=None):
+    """Build the single structured call that covers every contract analysis section"""
+    eccn_chunks, country_chart_text = contract_reference_context(contract_text, sample_data)
+    # The shared context is sent once, with about the same ECCN/chart share as the step-by-step prompts
+    prompt = budget_prompt("""
+[Contract Content]
+{contract}
+
+{eccn}
+
+{chart}
+
+{knowledge}
+
+Analyze the contract above for US EAR re-export compliance (Japan → destination) and fill in every field:
+- contract_info: product name (whether US-origin), re-export destination, end user, end use, contract value, delivery date
+- ear_applicability: US-origin items, incorporated US items, Foreign Direct Product (FDP) rule, determination
+- eccn: the most appropriate ECCN from the ECCN database above (category = 1st character, group = 2nd character)
+- country_chart: license requirement per reason for control from the Country Chart above ('X' = license required) and the overall determination
+- license_exceptions: applicable license exceptions (LVS, GBS, TSR, TMP, ENC etc.) with conditions and rationale
+- general_prohibitions: DPL, Entity List, embargo countries (North Korea, Iran, Syria, Cuba, Crimea) and Military End User List checks
+- risk: overall US EAR determination, risk level and specific recommended actions
+- procedures: BIS license application procedures and contact points if a license is required
+""", [
+        PromptSegment.text("contract", contract_text, priority=3, max_tokens=1500),
+        PromptSegment.blocks("chart", country_chart_text, priority=2),
+        PromptSegment("eccn", eccn_chunks, priority=1, max_tokens=1200),
+        PromptSegment.blocks("knowledge", knowledge_base, max_tokens=400),
+    ], PROMPT_BUDGETS["contract:single"], prompt_usage, 'single')
+    
+    return AnalysisStep('single', "🧩 Single-pass Structured Analysis", "Analyzing all sections in one structured call...",
+                        "", build_system_prompt(CONTRACT_EXPERT, list(CONTRACT_SECTION_FIELDS.values())), lambda r: prompt,
+                        temperature=0.2, max_tokens=2000, abort_on_error=True, error_label="Single-pass Analysis Error",
+                        response_format=RESPONSE_FORMAT)
+
+
+def chat_single_pass_step(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, prompt_usage=None):
+    """Build the single structured call that covers every chat consultation section"""
+    fields = [field for key, field in CHAT_SECTION_FIELDS.items() if destination_input or key != 'step2']
+    regulation_chunks = get_ranked_regulation_chunks(f"{product_input} {destination_input} {additional_info}")
+    prompt = budget_prompt("""
+Product Name: {product}
+Destination: {destination}
+Additional Info: {additional_info}
+
+{eccn}
+
+{chart}
+
+{regulations}
+
+{knowledge}
+
+Analyze the product and destination above for US EAR re-export compliance and fill in every field:
+- eccn: the most appropriate ECCN from the ECCN database above, or EAR99, with the reasons for control
+- country_chart: license requirement per reason for control for the destination from the Country Chart above ('X' = license required)
+- general_prohibitions: GP4 Denied Parties Lists (DPL), GP5 End-Use/End-User Controls (Entity List), GP6 Embargo Countries, GP7 Proliferation Activities, GP8 Transit Controls
+- risk: overall determination, risk level, license application requirement, warnings (applicable General Prohibitions) and recommended actions
+""", [
+        *chat_input_segments(product_input, destination_input, additional_info),
+        PromptSegment.blocks("chart", chart_context if destination_input else "", priority=2),
+        eccn_prompt_segment(eccn_context, priority=1, max_tokens=1000),
+        PromptSegment("regulations", regulation_chunks, max_tokens=600),
+        PromptSegment.blocks("knowledge", knowledge_base, max_tokens=500),
+    ], PROMPT_BUDGETS["chat:single"], prompt_usage, 'single')
+    
+    return AnalysisStep('single', "🧩 Single-pass Structured Analysis", "Analyzing all sections in one structured call...",
+                        "", build_system_prompt(CHAT_EXPERT, fields), lambda r: prompt,
+                        temperature=0.2, max_tokens=1500, abort_on_error=True, error_label="Single-pass Analysis Error",
+                        response_format=RESPONSE_FORMAT)
+
+
+def run_single_pass(step, section_table, section_fields, result_container, pipeline_name, prompt_usage=None, skip=()):
+    """
+    Run one structured call and render its JSON into the same section placeholders as the step-by-step mode.
+    Returns step key → section text, or None if the call failed or the response was not valid JSON.
+    """
+    section_keys = [key for key in section_table if key not in skip]
+    with result_container:
+        status = st.empty()
+        placeholders = {key: st.empty() for key in section_keys}
+    status.caption(f"⏳ {step.running_label}")
+    sections = {}
+    
+    def render_progress(step, text):
+        # The raw JSON is not shown while streaming; only how much has arrived
+        status.caption(f"⏳ {step.running_label} ({len(text):,} characters received)")
+    
+    def render_result(step, result):
+        if result.error is not None:
+            status.error(f"{step.error_label}: {str(result.error)}")
+            return
         try:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "あなたは米国EAR規制の専門家です。"},
-                    {"role": "user", "content": step4_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=700
-            )
-            step4_result = response.choices[0].message.content
-            full_analysis += f"## ステップ4: 総合判定\n{step4_result}\n\n"
-            
-            with result_container:
-                st.markdown("### 📊 ステップ4: 総合判定とリスク評価")
-                st.markdown(step4_result)
+            data = parse_structured_analysis(result.content)
+        except ValueError as e:
+            status.error(f"{step.error_label}: {str(e)}")
+            return
+        sections.update(render_sections(data, section_fields, skip))
+        status.caption(f"🧩 All sections from one structured response ({result.elapsed_ms / 1000:.1f} s)")
+        for key in section_keys:
+            with placeholders[key].container():
+                st.markdown(f"### {section_table[key][0]}")
+                st.markdown(sections[key])
                 st.markdown("---")
-        except Exception as e:
-            st.error(f"Step 4 Error: {str(e)}")
     
-    return full_analysis
+    get_client()
+    run_steps([step], _step_model_caller(pipeline_name), on_done=render_result, on_progress=render_progress)
+    render_prompt_usage([step], prompt_usage, result_container)
+    return sections or None
+
+
+def analyze_contract_single_pass(contract_text, knowledge_base, result_container):
+    """Analyze contract with one structured GPT call, rendered as the same sections as the step-by-step mode"""
+    prompt_usage = {}
+    sample_data = st.session_state.sample_data
+    step = contract_single_pass_step(contract_text, sample_data, knowledge_base, prompt_usage)
+    
+    sections = run_single_pass(step, CONTRACT_SECTIONS, CONTRACT_SECTION_FIELDS, result_container, 'contract', prompt_usage)
+    if sections is None:
+        return None
+    return join_section_table(CONTRACT_SECTIONS, sections)
+
+
+def analyze_chat_single_pass(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, result_container):
+    """
+    Chat consultation with one structured GPT call, rendered as the same sections as the step-by-step mode.
+    Returns (analysis, complete) like analyze_chat_step_by_step; a parsed structured response fills every section.
+    """
+    prompt_usage = {}
+    step = chat_single_pass_step(product_input, destination_input, additional_info, eccn_context, chart_context, knowledge_base, prompt_usage)
+    
+    skip = () if destination_input else ('step2',)
+    sections = run_single_pass(step, CHAT_SECTIONS, CHAT_SECTION_FIELDS, result_container, 'chat', prompt_usage, skip)
+    if sections is None:
+        return None, False
+    return join_section_table(CHAT_SECTIONS, sections), True
 
 def main():
     # Enhanced Header with Icon
@@ -1195,6 +1380,111 @@ def main():
         Consult with experts for legal decisions.
         """)
         
+        # Reference data registry status
+        with st.expander("📦 Reference Data Status"):
+            registry_stats = get_registry().stats()
+            st.caption(f"Version: {registry_stats['version']} / Loads: {registry_stats['load_count']} / Mode: {registry_stats['load_mode']}")
+            st.caption(f"Load time: {registry_stats['total_load_ms']:.1f} ms / Memory: {registry_stats['total_memory_bytes'] / 1024:.0f} KB")
+            st.dataframe(
+                pd.DataFrame([
+                    {
+                        "Source": key,
+                        "Load (ms)": round(s['load_ms'], 1) if s['load_ms'] is not None else None,
+                        "Memory (KB)": round(s['memory_bytes'] / 1024, 1)
+                    }
+                    for key, s in registry_stats['sources'].items()
+                ]),
+                use_container_width=True,
+                hide_index=True
+            )
+        
+        # Libraries loaded on first use
+        with st.expander("⏱️ Deferred Import Timings"):
+            import_report = get_lazy_import_report()
+            if import_report:
+                st.dataframe(
+                    pd.DataFrame([
+                        {"Module": entry["module"], "Import (ms)": round(entry["import_ms"], 1)}
+                        for entry in import_report
+                    ]),
+                    use_container_width=True,
+                    hide_index=True
+                )
+            else:
+                st.caption("No deferred libraries loaded yet")
+        
+        # Persistent GPT response cache
+        with st.expander("🗄️ LLM Response Cache"):
+            llm_cache = get_llm_cache()
+            if llm_cache is None:
+                st.caption("Response cache is disabled (LLM_CACHE_ENABLED=0)")
+            else:
+                cache_stats = llm_cache.stats()
+                st.caption(
+                    f"{cache_stats['entries']:,} / {cache_stats['max_entries']:,} entries · "
+                    f"{cache_stats['size_bytes'] / 1024:.0f} KB · "
+                    f"hits {cache_stats['hits']} / misses {cache_stats['misses']}"
+                )
+                if cache_stats["steps"]:
+                    st.dataframe(
+                        pd.DataFrame([
+                            {"Step": step, "Hits": counts["hits"], "Misses": counts["misses"]}
+                            for step, counts in sorted(cache_stats["steps"].items())
+                        ]),
+                        use_container_width=True,
+                        hide_index=True
+                    )
+                if st.button("Clear response cache", key="clear_llm_cache"):
+                    llm_cache.clear()
+                    st.rerun()
+            
+            semantic_cache = get_semantic_cache()
+            if semantic_cache is not None:
+                semantic_stats = semantic_cache.stats()
+                st.caption(
+                    f"Semantic chat cache: {semantic_stats['entries']:,} answers · "
+                    f"threshold {semantic_stats['threshold']:.2f} · "
+                    f"hits {semantic_stats['hits']} / misses {semantic_stats['misses']}"
+                )
+                if st.button("Clear semantic cache", key="clear_semantic_cache"):
+                    semantic_cache.clear()
+                    st.rerun()
+            
+            embedding_cache = get_embedding_cache()
+            if embedding_cache is not None:
+                embedding_stats = embedding_cache.stats()
+                st.caption(
+                    f"Embedding cache: {embedding_stats['entries']:,} vectors · "
+                    f"{embedding_stats['size_bytes'] / 1024:.0f} KB · "
+                    f"hit rate {embedding_stats['hit_rate']:.0%} "
+                    f"(memory {embedding_stats['memory_hits']} / disk {embedding_stats['disk_hits']} / misses {embedding_stats['misses']})"
+                )
+                if st.button("Clear embedding cache", key="clear_embedding_cache"):
+                    embedding_cache.clear()
+                    st.rerun()
+            
+            # Shared OpenAI client (only once it has been created, so openai is still imported lazily)
+            client_stats = get_openai_client_stats()
+            if client_stats is not None:
+                st.caption(
+                    f"OpenAI requests: {client_stats['requests']:,} · retries {client_stats['retries']} · "
+                    f"failures {client_stats['failures']} · in flight {client_stats['in_flight']} / {client_stats['max_concurrency']}"
+                )
+            
+            # Shared RAG connection (created on the first RAG analysis)
+            rag_health = get_license_exception_rag_health()
+            if rag_health is not None:
+                if rag_health["ok"]:
+                    st.caption(
+                        f"RAG index ({rag_health['store']}): connected · {rag_health['vector_count']:,} vectors · "
+                        f"checked in {rag_health['latency_ms']:.0f} ms"
+                    )
+                else:
+                    st.caption(f"RAG index ({rag_health['store']}): ⚠️ {rag_health['error']}")
+                if st.button("Check RAG connection", key="check_rag_connection"):
+                    get_license_exception_rag().health_check()
+                    st.rerun()
+        
         # Version info
         st.markdown("---")
         st.caption("Version 2.0 - Enhanced UI")
@@ -1233,6 +1523,14 @@ Contract Value: {amount}
 Delivery Date: {delivery_date}
 """
         
+        contract_mode = st.radio(
+            "Analysis mode",
+            ANALYSIS_MODES,
+            horizontal=True,
+            key="contract_analysis_mode",
+            help="Single pass asks for every section in one structured (JSON) response: fewer round trips and less repeated context, but no per-step streaming"
+        )
+        
         if st.button("🔍 Start Analysis", type="primary"):
             knowledge_base = load_knowledge_base()
             
@@ -1279,7 +1577,10 @@ Delivery Date: {delivery_date}
                 st.markdown('<div class="section-header">📋 Analysis Results (Progressive Display)</div>', unsafe_allow_html=True)
                 result_container = st.container()
                 
-                analysis = analyze_contract_step_by_step(contract_text + additional_context, knowledge_base, result_container)
+                analyze_contract = analyze_contract_single_pass if contract_mode == SINGLE_PASS_MODE else analyze_contract_step_by_step
+                with trace("contract") as analysis_trace:
+                    analysis = analyze_contract(contract_text + additional_context, knowledge_base, result_container)
+                render_performance(analysis_trace, result_container)
                 st.session_state.analysis_result = analysis
             else:
                 st.error("No contract information provided")
@@ -1334,6 +1635,18 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
             destination_input = st.text_input("Destination (e.g., China, Russia)", key="chat_destination")
         
         additional_info = st.text_area("Additional Information/Questions (Optional)", key="chat_additional", height=100)
+        use_semantic_cache = st.checkbox(
+            "♻️ Reuse answers to similar previous questions (semantic cache)",
+            value=True,
+            key="chat_semantic_cache"
+        )
+        chat_mode = st.radio(
+            "Analysis mode",
+            ANALYSIS_MODES,
+            horizontal=True,
+            key="chat_analysis_mode",
+            help="Single pass asks for every section in one structured (JSON) response: fewer round trips and less repeated context, but no per-step streaming"
+        )
         
         if st.button("🔍 Start Analysis（RAG許可例外判定含む）", key="chat_submit", type="primary"):
             if product_input:
@@ -1341,31 +1654,10 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
                 eccn_json = st.session_state.sample_data.get('eccn_json')
                 country_chart = st.session_state.sample_data.get('country_chart')
                 
-                # ECCN番号データをテキスト化（完全版）
-                eccn_context = ""
-                if eccn_json:
-                    eccn_context = "[ECCN Number Database (Complete)]\n"
-                    for category in eccn_json.get('ccl_categories', []):
-                        eccn_context += f"\n## Category {category.get('category_number', '')}: {category.get('title', '')}\n"
-                        for group in category.get('product_groups', []):
-                            eccn_context += f"\n### {group.get('group_title', '')}\n"
-                            for item in group.get('items', [])[:10]:  # Max 10 items from each group
-                                eccn_context += f"- **{item.get('eccn', '')}**: {item.get('description', '')[:200]}...\n"
-                
-                # カントリーチャートデータをテキスト化（完全版）
-                chart_context = ""
-                if country_chart is not None and not country_chart.empty:
-                    chart_context = "\n[Country Chart (Complete)]\n"
-                    chart_context += "Below is actual US EAR Country Chart data. 'X' indicates license required.\n\n"
-                    # 主要国を含める（トークン制限を考慮）
-                    for idx, row in country_chart.head(50).iterrows():
-                        country_name = row.iloc[0]
-                        chart_context += f"\n**{country_name}**:\n"
-                        # Show only key regulation reason columns
-                        key_columns = ['NS 1', 'NS 2', 'MT 1', 'NP 1', 'NP 2', 'CB 1', 'CB 2', 'AT 1', 'AT 2']
-                        for col in key_columns:
-                            if col in row.index and pd.notna(row[col]):
-                                chart_context += f"  - {col}: {row[col]}\n"
+                # ECCN番号データ・カントリーチャートのテキスト（データのバージョンごとに構築済み）
+                # カントリーチャートは仕向地の行と脚注のみ（仕向地を解決できない場合は主要国の主要な規制理由列）
+                eccn_context = get_ranked_eccn_chunks(f"{product_input} {additional_info}", eccn_json)
+                chart_context = get_destination_chart_context(destination_input, country_chart, 50, CHAT_CHART_COLUMNS)
                 
                 # General Prohibitionsの情報を追加
                 knowledge_base = load_knowledge_base()
@@ -1374,45 +1666,78 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
                 st.markdown('<div class="section-header">📋 Analysis Results (Progressive Display)</div>', unsafe_allow_html=True)
                 result_container = st.container()
                 
-                # 段階的分析実行
-                analysis = analyze_chat_step_by_step(
-                    product_input, 
-                    destination_input, 
-                    additional_info, 
-                    eccn_context, 
-                    chart_context, 
-                    knowledge_base,
-                    result_container
-                )
-                
-                # ステップ5: RAG許可例外判定
-                with st.spinner("🎯 Step 5: Analyzing RAG License Exceptions..."):
-                    with result_container:
-                        st.markdown("### 🎯 Step 5: License Exceptions Determination [RAG Analysis]")
-                        
+                # 以下のGPT・embedding・ベクトル検索の呼び出しを1つのトレースに計測（Performanceパネル用）
+                with trace("chat") as analysis_trace:
+                    # セマンティックキャッシュ: 同じ仕向地で言い回しが違うだけの過去の質問には保存済みの分析結果を返す
+                    semantic_cache = get_semantic_cache() if use_semantic_cache else None
+                    chat_query = build_chat_query(product_input, destination_input, additional_info)
+                    cache_scope = chat_cache_scope(destination_input)
+                    query_embedding = None
+                    cached_answer = None
+                    if semantic_cache is not None:
                         try:
-                            # RAG分析実行
-                            success, rag_result = check_license_exception_with_rag(
-                                eccn_number="推定ECCN（AIが判定したもの）",
-                                destination=destination_input,
-                                product_description=product_input,
-                                end_user=None,
-                                end_use=additional_info if additional_info else None
+                            query_embedding = embed_text(get_client(), chat_query)
+                            cached_answer = semantic_cache.lookup(query_embedding, cache_scope)
+                        except Exception as e:
+                            st.caption(f"Semantic cache unavailable: {str(e)}")
+                
+                    if cached_answer:
+                        analysis = cached_answer["answer"]
+                        with result_container:
+                            asked_at = datetime.fromtimestamp(cached_answer["created_at"]).strftime('%Y-%m-%d %H:%M')
+                            st.info(
+                                f"♻️ **Cached answer** (similarity {cached_answer['similarity']:.2f}) "
+                                f"to a previous question asked {asked_at}:\n\n{cached_answer['query']}\n\n"
+                                "Uncheck the semantic cache option above to run a fresh analysis."
                             )
+                            st.markdown(analysis)
+                            st.markdown("---")
+                    else:
+                        # 段階的分析（またはシングルパス分析）実行
+                        analyze_chat = analyze_chat_single_pass if chat_mode == SINGLE_PASS_MODE else analyze_chat_step_by_step
+                        analysis, complete = analyze_chat(
+                            product_input, 
+                            destination_input, 
+                            additional_info, 
+                            eccn_context, 
+                            chart_context, 
+                            knowledge_base,
+                            result_container
+                        )
+                        # 一部のステップが失敗した回答は類似質問に返さない（すべてのステップが成功した回答のみ保存）
+                        if analysis and complete and semantic_cache is not None and query_embedding is not None:
+                            semantic_cache.add(query_embedding, cache_scope, chat_query, analysis)
+                
+                    # ステップ5: RAG許可例外判定
+                    with st.spinner("🎯 Step 5: Analyzing RAG License Exceptions..."):
+                        with result_container:
+                            st.markdown("### 🎯 Step 5: License Exceptions Determination [RAG Analysis]")
+                        
+                            try:
+                                # RAG分析実行（分析結果に挙がったECCN候補をまとめて検索）
+                                candidate_eccns = list(dict.fromkeys(ECCN_CODE_PATTERN.findall(analysis or "")))
+                                success, rag_result = check_license_exception_with_rag(
+                                    eccn_number="推定ECCN（AIが判定したもの）",
+                                    destination=destination_input,
+                                    product_description=product_input,
+                                    end_user=None,
+                                    end_use=additional_info if additional_info else None,
+                                    candidate_eccns=candidate_eccns
+                                )
                             
-                            if success:
-                                # RAGAnalysis Resultsを表示
-                                rag = LicenseExceptionRAG()
-                                rag.display_license_exception_analysis(rag_result)
-                            else:
-                                st.warning(f"⚠️ Error occurred in RAG analysis: {rag_result.get('error', '不明')}")
-                                st.info("💡 Check Pinecone connection. Verify PINECONE_API_KEY is set in .env file.")
+                                if success:
+                                    # RAGAnalysis Resultsを表示
+                                    display_license_exception_analysis(rag_result)
+                                else:
+                                    st.warning(f"⚠️ Error occurred in RAG analysis: {rag_result.get('error', '不明')}")
+                                    st.info("💡 Check the vector store connection. Verify PINECONE_API_KEY is set in .env file, or set VECTOR_STORE=local.")
                         
-                        except Exception as e:
-                            st.error(f"❌ RAG System Error: {str(e)}")
-                            st.info("**RAG System Setup**: Add PINECONE_API_KEY to .env file.")
+                            except Exception as e:
+                                st.error(f"❌ RAG System Error: {str(e)}")
+                                st.info("**RAG System Setup**: Add PINECONE_API_KEY to .env file.")
                         
-                        st.markdown("---")
+                            st.markdown("---")
+                render_performance(analysis_trace, result_container)
                 
                 # チャット履歴に保存
                 st.session_state.chat_history.append({
@@ -1420,6 +1745,7 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
                     "destination": destination_input,
                     "question": additional_info if additional_info else "ECCN Determination & Country Chart Analysis",
                     "answer": analysis if analysis else "Analysis Complete",
+                    "cached": bool(cached_answer),
                     "timestamp": datetime.now()
                 })
                 
@@ -1428,10 +1754,9 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
                     with result_container:
                         st.markdown("### 📊 Country Chart Details")
                         
-                        # 国名で検索（部分一致）
-                        matching_countries = country_chart[
-                            country_chart.iloc[:, 0].str.contains(destination_input, case=False, na=False)
-                        ]
+                        # 国名を別名索引で解決して該当行を取得（英語名・日本語名・ISOコード）
+                        chart_row = get_country_chart_index(country_chart).row_for(destination_input)
+                        matching_countries = country_chart.iloc[[chart_row]] if chart_row is not None else country_chart.iloc[0:0]
                         
                         if not matching_countries.empty:
                             st.dataframe(matching_countries, use_container_width=True)
@@ -1448,7 +1773,8 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
                 timestamp_str = chat['timestamp'].strftime('%Y-%m-%d %H:%M')
                 product = chat.get('product', chat.get('question', ''))[:30]
                 
-                with st.expander(f"🔍 {product}... ({timestamp_str})"):
+                cached_label = " ♻️ cached" if chat.get('cached') else ""
+                with st.expander(f"🔍 {product}... ({timestamp_str}){cached_label}"):
                     if 'product' in chat:
                         st.markdown(f"**Product**: {chat['product']}")
                         if chat.get('destination'):
@@ -1512,7 +1838,7 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
         with viz_tab2:
             st.markdown("### 🔢 ECCN Number Database Search")
             
-            # インタラクティブテーブル
+            # インタラクティブテーブル（全セッション共有のキャッシュ済みテーブル）
             if 'eccn_json' in st.session_state.sample_data:
                 eccn_df = create_interactive_eccn_table(st.session_state.sample_data['eccn_json'])
                 
@@ -1522,18 +1848,18 @@ Generated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
                     # 検索機能
                     search_keyword = st.text_input(
                         "🔍 Search by Keyword",
-                        placeholder="e.g., semiconductor, encryption, 5A002",
+                        placeholder="e.g., semiconductor, encryption, 5A002, 5A0*, 4D*, x9xx",
                         key="eccn_search"
                     )
                     
+                    # Hide the precomputed search column
+                    hidden_columns = {ECCN_SEARCH_COLUMN: None}
                     if search_keyword:
-                        filtered_df = eccn_df[
-                            eccn_df.apply(lambda row: row.astype(str).str.contains(search_keyword, case=False).any(), axis=1)
-                        ]
+                        filtered_df = filter_eccn_table(eccn_df, search_keyword, st.session_state.sample_data['eccn_json'])
                         st.success(f"✅ {len(filtered_df)} matches found")
-                        st.dataframe(filtered_df, use_container_width=True, height=500)
+                        st.dataframe(filtered_df, use_container_width=True, height=500, column_config=hidden_columns)
                     else:
-                        st.dataframe(eccn_df, use_container_width=True, height=500)
+                        st.dataframe(eccn_df, use_container_width=True, height=500, column_config=hidden_columns)
                     
                     # クリックで詳細表示（選択機能）
                     st.markdown("---")
@@ -0,0 +1,219 @@
+"""
+分析パイプライン全体のオフラインベンチマーク
+benchmarks/sample_contracts/ の契約書ごとに、契約書分析（段階的・シングルパス）・チャット相談・RAG許可例外判定を
+記録済みの応答の再生（llm_replay）で実行し、全体の所要時間・ステップ別のレイテンシ・プロンプトのトークン数を報告する。
+
+パイプラインはアプリと同じステップ定義・並行実行・応答取得の経路で実行する（Streamlitの描画のみ除く）。
+カセットに無いリクエストは合成応答で代替されるため、プロンプトが変わっても計測できる。
+
+使い方:
+    python benchmarks/bench_pipelines.py                                  # 再生（合成応答・既定のレイテンシ分布）
+    python benchmarks/bench_pipelines.py --cassette benchmarks/cassettes/sample.jsonl --recorded-latency
+    python benchmarks/bench_pipelines.py --speedup 10 --repeat 5
+    python benchmarks/bench_pipelines.py --json results.json              # 結果を保存
+    python benchmarks/bench_pipelines.py --baseline results.json          # 保存した結果と比較（悪化したら終了コード1）
+    python benchmarks/bench_pipelines.py --record benchmarks/cassettes/sample.jsonl   # 実APIの応答を記録
+"""
+
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ["LLM_CACHE_ENABLED"] = "0"
+os.environ.setdefault("TELEMETRY_LOG", "0")
+os.environ["SEMANTIC_CACHE_ENABLED"] = "0"
+os.environ["EMBEDDING_CACHE_ENABLED"] = "0"
+
+import app
+from data_registry import get_reference_data
+from llm_replay import (
+    Cassette,
+    LatencyModel,
+    RecordingOpenAI,
+    RecordingVectorIndex,
+    ReplayOpenAI,
+    ReplayVectorIndex,
+)
+from openai_client import create_openai_client, use_openai_backend
+from prompt_context import CHAT_CHART_COLUMNS, get_destination_chart_context, get_ranked_eccn_chunks
+from rag_tools import LicenseExceptionRAG
+from step_executor import run_steps
+from utils import extract_contract_info
+
+SAMPLE_DIR = Path(__file__).resolve().parent / "sample_contracts"
+DEFAULT_TOLERANCE = 0.2
+
+# RAG判定に渡すECCN（パイプラインの判定結果ではなく固定値で計測する）
+RAG_ECCN = "3A090"
+# 複数のECCN候補の検索（1件ずつ / バッチ）に使う候補
+RAG_CANDIDATE_ECCNS = ["3A090", "4A090", "5A992", "5D992", "3A991"]
+
+
+def _arg(name, default=None):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+
+def run_pipeline(steps, pipeline_name, prompt_usage):
+    """ステップを実行し、{"wall_ms", "steps": {キー: {"ms", "first_token_ms"}}, "prompt_tokens"} を返す"""
+    pipeline = run_steps(steps, app._step_model_caller(pipeline_name))
+    failed = [key for key, result in pipeline.results.items() if result.error is not None]
+    if failed:
+        raise RuntimeError(f"{pipeline_name}: failed steps {failed}: {pipeline.results[failed[0]].error}")
+    results = [pipeline.results[step.key] for step in steps]
+    return {
+        "wall_ms": pipeline.elapsed_ms,
+        "steps": {
+            result.key: {"ms": result.elapsed_ms, "first_token_ms": result.first_token_ms}
+            for result in results if not result.skipped
+        },
+        "prompt_tokens": sum(report["prompt_tokens"] for report in prompt_usage.values()),
+    }
+
+
+def run_rag(rag, product, destination):
+    start = time.perf_counter()
+    result = rag.analyze_license_exception_applicability(eccn_number=RAG_ECCN, destination=destination, product_description=product)
+    if not result.get("success"):
+        raise RuntimeError(f"rag: {result.get('error')}")
+    return {"wall_ms": (time.perf_counter() - start) * 1000, "steps": {}, "prompt_tokens": 0}
+
+
+def run_retrieval(rag, product, destination, batch):
+    """ECCN候補ごとの許可例外の検索（RAG判定のGPT呼び出しは含まない）"""
+    queries = [(eccn, destination, product) for eccn in RAG_CANDIDATE_ECCNS]
+    start = time.perf_counter()
+    if batch:
+        rag.search_license_exceptions_batch(queries)
+    else:
+        for query in queries:
+            rag.search_license_exceptions(*query)
+    return {"wall_ms": (time.perf_counter() - start) * 1000, "steps": {}, "prompt_tokens": 0}
+
+
+def contract_pipelines(contract_text, sample_data, knowledge_base, rag):
+    """契約書1件分の (パイプライン名, 実行関数) のリスト"""
+    info = extract_contract_info(contract_text)
+    product, destination = info.get("Product Name", ""), info.get("Destination", "")
+    eccn_context = get_ranked_eccn_chunks(product, sample_data.get('eccn_json'))
+    chart_context = get_destination_chart_context(destination, sample_data.get('country_chart'), 50, CHAT_CHART_COLUMNS)
+    chat_args = (product, destination, "", eccn_context, chart_context, knowledge_base)
+
+    def contract_steps():
+        usage = {}
+        return run_pipeline(app.contract_analysis_steps(contract_text, sample_data, usage), 'contract', usage)
+
+    def contract_single():
+        usage = {}
+        return run_pipeline([app.contract_single_pass_step(contract_text, sample_data, knowledge_base, usage)], 'contract', usage)
+
+    def chat_steps():
+        usage = {}
+        return run_pipeline(app.chat_analysis_steps(*chat_args, prompt_usage=usage), 'chat', usage)
+
+    return [
+        ("contract:step-by-step", contract_steps),
+        ("contract:single-pass", contract_single),
+        ("chat:step-by-step", chat_steps),
+        ("rag:license-exceptions", lambda: run_rag(rag, product, destination)),
+        ("rag:retrieval-serial", lambda: run_retrieval(rag, product, destination, batch=False)),
+        ("rag:retrieval-batch", lambda: run_retrieval(rag, product, destination, batch=True)),
+    ]
+
+
+def summarize(runs):
+    """繰り返し実行の結果を中央値にまとめる"""
+    steps = {}
+    for key in runs[0]["steps"]:
+        first_tokens = [run["steps"][key]["first_token_ms"] for run in runs if run["steps"][key]["first_token_ms"] is not None]
+        steps[key] = {
+            "ms": statistics.median(run["steps"][key]["ms"] for run in runs),
+            "first_token_ms": statistics.median(first_tokens) if first_tokens else None,
+        }
+    return {
+        "wall_ms": statistics.median(run["wall_ms"] for run in runs),
+        "wall_ms_max": max(run["wall_ms"] for run in runs),
+        "steps": steps,
+        "prompt_tokens": runs[0]["prompt_tokens"],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """基準の結果より悪化した項目（所要時間・プロンプトのトークン数）を列挙"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("wall_ms", "prompt_tokens"):
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {base[metric]:,.0f} → {result[metric]:,.0f} (+{result[metric] / base[metric] - 1:.0%})")
+    return regressions
+
+
+def setup_backends():
+    """再生（既定）または記録のバックエンドを共有クライアント・RAGに設定し、(RAG, OpenAI代替, カセット) を返す"""
+    record_path = _arg("--record")
+    if record_path:
+        cassette = Cassette(Path(record_path))
+        backend = RecordingOpenAI(create_openai_client(), cassette)
+        use_openai_backend(backend)
+        rag = LicenseExceptionRAG()
+        rag.index = RecordingVectorIndex(rag.index, cassette)
+        return rag, backend, cassette
+
+    cassette_path = _arg("--cassette")
+    cassette = Cassette(Path(cassette_path)) if cassette_path else Cassette()
+    latency = LatencyModel(speedup=float(_arg("--speedup", 1)), use_recorded="--recorded-latency" in sys.argv)
+    backend = ReplayOpenAI(cassette, latency)
+    use_openai_backend(backend)
+    rag = LicenseExceptionRAG(index=ReplayVectorIndex(cassette, latency, backend.calls))
+    return rag, backend, cassette
+
+
+def main():
+    repeat = int(_arg("--repeat", 3))
+    tolerance = float(_arg("--tolerance", DEFAULT_TOLERANCE))
+    rag, backend, cassette = setup_backends()
+    sample_data = get_reference_data()
+    knowledge_base = app.get_full_knowledge_base()
+
+    mode = "record" if "--record" in sys.argv else f"replay ({len(cassette)} recorded responses)"
+    print(f"モード: {mode}、各パイプライン{repeat}回")
+    results = {}
+    for contract_path in sorted(SAMPLE_DIR.glob("*.txt")):
+        contract_text = contract_path.read_text(encoding="utf-8")
+        for name, run in contract_pipelines(contract_text, sample_data, knowledge_base, rag):
+            key = f"{contract_path.stem}/{name}"
+            results[key] = summarize([run() for _ in range(repeat)])
+
+    print(f"\n{'pipeline':<48}{'wall (ms)':>11}{'max (ms)':>10}{'prompt tokens':>15}")
+    for key, result in results.items():
+        prompt_tokens = f"{result['prompt_tokens']:,}" if result["prompt_tokens"] else "-"
+        print(f"{key:<48}{result['wall_ms']:>11,.0f}{result['wall_ms_max']:>10,.0f}{prompt_tokens:>15}")
+        for step, timing in result["steps"].items():
+            first_token = f"  first token {timing['first_token_ms']:,.0f} ms" if timing["first_token_ms"] is not None else ""
+            print(f"    {step:<44}{timing['ms']:>11,.0f}{first_token}")
+
+    if isinstance(backend, ReplayOpenAI):
+        replayed = sum(1 for call in backend.calls if call["replayed"])
+        print(f"\n再生した記録: {replayed} / {len(backend.calls)} 呼び出し（残りは合成応答）")
+
+    if _arg("--json"):
+        Path(_arg("--json")).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    if _arg("--baseline"):
+        baseline = json.loads(Path(_arg("--baseline")).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            print(f"\n⚠️ 基準より {tolerance:.0%} 以上悪化:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\n基準との差は許容範囲内（{tolerance:.0%}）")
+
+
+if __name__ == "__main__":
+    main()
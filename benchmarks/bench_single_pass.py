@@ -0,0 +1,103 @@
+"""
+シングルパス分析と段階的分析のベンチマーク
+同じ契約書・チャット相談を両方のモードで分析し、レイテンシ・GPT呼び出し回数・トークン数・概算コストを比較する
+
+OPENAI_API_KEY が設定されていない場合（または --dry-run 指定時）はAPIを呼び出さず、
+各モードで送信するプロンプトのトークン数のみを比較する（依存ステップは空の結果から組み立てる）。
+応答キャッシュは無効化して計測する。
+
+使い方:
+    python benchmarks/bench_single_pass.py               # 各モード3回
+    python benchmarks/bench_single_pass.py --repeat 5
+    python benchmarks/bench_single_pass.py --dry-run
+"""
+
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ["LLM_CACHE_ENABLED"] = "0"
+os.environ.setdefault("TELEMETRY_LOG", "0")
+
+import app
+from data_registry import get_reference_data
+from prompt_budget import count_tokens
+from prompt_context import CHAT_CHART_COLUMNS, get_destination_chart_context, get_ranked_eccn_chunks
+from step_executor import run_steps
+from telemetry import estimate_cost
+
+SAMPLE_CONTRACT = """
+Product Name: High-performance GPU accelerator boards (US-origin, incorporating NVIDIA chips)
+Destination: Vietnam
+需要者: Hanoi Advanced Computing Co., Ltd.
+End Use: Data center for AI model training
+Contract Value: USD 1,200,000
+Delivery Date: 2026-12-15
+"""
+
+SAMPLE_CHAT = ("Encryption software for VPN appliances", "Vietnam", "Distributed to a telecom operator")
+
+
+def build_cases(sample_data, knowledge_base):
+    """ベンチマークする (名前, 段階的分析のステップ, シングルパスのステップ, パイプライン名) のリスト"""
+    product, destination, additional = SAMPLE_CHAT
+    eccn_context = get_ranked_eccn_chunks(f"{product} {additional}", sample_data.get('eccn_json'))
+    chart_context = get_destination_chart_context(destination, sample_data.get('country_chart'), 50, CHAT_CHART_COLUMNS)
+    chat_args = (product, destination, additional, eccn_context, chart_context, knowledge_base)
+    return [
+        ("contract",
+         lambda: app.contract_analysis_steps(SAMPLE_CONTRACT, sample_data),
+         lambda: app.contract_single_pass_step(SAMPLE_CONTRACT, sample_data, knowledge_base),
+         "contract"),
+        ("chat",
+         lambda: app.chat_analysis_steps(*chat_args),
+         lambda: app.chat_single_pass_step(*chat_args),
+         "chat"),
+    ]
+
+
+def run_mode(steps, pipeline_name, dry_run):
+    """ステップを実行し、(経過ミリ秒, 呼び出し回数, 入力トークン数, 出力トークン数) を返す"""
+    calls = []
+    model_caller = app._step_model_caller(pipeline_name)
+
+    def call_model(step, prompt, on_token):
+        content = "" if dry_run else model_caller(step, prompt, on_token)
+        calls.append((count_tokens(step.system_prompt) + count_tokens(prompt), count_tokens(content)))
+        return content
+
+    start = time.perf_counter()
+    pipeline = run_steps(steps, call_model)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    failed = [key for key, result in pipeline.results.items() if result.error is not None]
+    if failed:
+        print(f"  ⚠️ failed steps: {failed}")
+    return elapsed_ms, len(calls), sum(c[0] for c in calls), sum(c[1] for c in calls)
+
+
+def main():
+    dry_run = "--dry-run" in sys.argv or not os.getenv("OPENAI_API_KEY")
+    repeat = 1 if dry_run else 3
+    if "--repeat" in sys.argv:
+        repeat = int(sys.argv[sys.argv.index("--repeat") + 1])
+
+    sample_data = get_reference_data()
+    knowledge_base = app.get_full_knowledge_base()
+    print(f"モデル: {app.ANALYSIS_MODEL}" + ("（dry run: APIを呼び出さずプロンプトのみ計測）" if dry_run else f"、各モード{repeat}回"))
+    print(f"{'case':<10}{'mode':<14}{'latency (ms)':>14}{'calls':>7}{'in tokens':>11}{'out tokens':>12}{'cost (USD)':>12}")
+
+    for name, build_steps, build_single, pipeline_name in build_cases(sample_data, knowledge_base):
+        for mode, build in (("step-by-step", build_steps), ("single-pass", lambda: [build_single()])):
+            runs = [run_mode(build(), pipeline_name, dry_run) for _ in range(repeat)]
+            latency = statistics.median(run[0] for run in runs)
+            calls, input_tokens, output_tokens = (round(statistics.mean(run[i] for run in runs)) for i in (1, 2, 3))
+            latency_text = "-" if dry_run else f"{latency:.0f}"
+            print(f"{name:<10}{mode:<14}{latency_text:>14}{calls:>7}{input_tokens:>11,}{output_tokens:>12,}"
+                  f"{estimate_cost(app.ANALYSIS_MODEL, input_tokens, output_tokens):>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
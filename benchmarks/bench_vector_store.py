@@ -0,0 +1,128 @@
+"""
+ベクトルストアのレイテンシ比較
+同じクエリをローカルのストア（全件比較・IVF）とPineconeのインデックスで検索し、
+1クエリあたりのレイテンシ（中央値・p95）とIVFの再現率（全件比較の上位k件のうち取得できた割合）を報告する。
+
+ローカルのストアは一時ディレクトリに作り、保存済みのストア（VECTOR_STORE_PATH）があればそのレコードを、
+無ければ乱数の合成レコードを登録する。PINECONE_API_KEY が設定されていない場合、Pineconeは計測しない。
+
+使い方:
+    python benchmarks/bench_vector_store.py
+    python benchmarks/bench_vector_store.py --synthetic 20000 --queries 500 --nprobe 16
+    python benchmarks/bench_vector_store.py --filter '{"exception": "LVS"}'
+"""
+
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEMETRY_LOG", "0")
+
+from dotenv import load_dotenv
+
+from vector_store import NAMESPACE, LocalVectorStore, copy_namespace, get_local_vector_store, open_pinecone_index
+
+DEFAULT_SYNTHETIC = 5000
+DEFAULT_DIMENSIONS = 1024
+DEFAULT_QUERIES = 200
+TOP_K = 5
+
+
+def _arg(name, default=None):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+
+def synthetic_records(count, dimensions, seed=0):
+    """クラスタ構造を持つ乱数のレコード（実際のembeddingと同様に近傍が偏る）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 100), dimensions))
+    vectors = centers[rng.integers(len(centers), size=count)] + 0.5 * rng.standard_normal((count, dimensions))
+    exceptions = ["LVS", "GBS", "TSR", "TMP", "ENC", "STA"]
+    return [
+        {"id": f"synthetic-{i}", "values": vector.astype(np.float32).tolist(), "metadata": {"exception": exceptions[i % len(exceptions)]}}
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def time_queries(index, queries, query_filter):
+    """各クエリの所要時間（ミリ秒）と取得したIDのリスト"""
+    timings, results = [], []
+    extra = {"filter": query_filter} if query_filter else {}
+    for query in queries:
+        start = time.perf_counter()
+        response = index.query(vector=query.tolist(), top_k=TOP_K, include_metadata=True, namespace=NAMESPACE, **extra)
+        timings.append((time.perf_counter() - start) * 1000)
+        results.append([match.id for match in response.matches])
+    return timings, results
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def main():
+    load_dotenv()
+    query_count = int(_arg("--queries", DEFAULT_QUERIES))
+    nprobe = int(_arg("--nprobe", 8))
+    query_filter = json.loads(_arg("--filter")) if _arg("--filter") else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        exact = LocalVectorStore(Path(directory), search="exact")
+        saved = get_local_vector_store()
+        if "--synthetic" not in sys.argv and saved.describe_index_stats().namespaces.get(NAMESPACE):
+            count = copy_namespace(saved, exact)
+            source = f"saved store ({count:,} records)"
+        else:
+            count = int(_arg("--synthetic", DEFAULT_SYNTHETIC))
+            exact.upsert(synthetic_records(count, DEFAULT_DIMENSIONS), namespace=NAMESPACE)
+            source = f"synthetic ({count:,} records)"
+        ivf = LocalVectorStore(Path(directory), search="ivf", nprobe=nprobe)
+
+        # 登録済みのベクトルの近傍をクエリにする
+        ids = [record_id for batch in exact.list(namespace=NAMESPACE) for record_id in batch]
+        stored = np.array([vector.values for vector in exact.fetch(ids=ids, namespace=NAMESPACE).vectors.values()], dtype=np.float32)
+        rng = np.random.default_rng(1)
+        queries = stored[rng.integers(len(stored), size=query_count)] + 0.05 * rng.standard_normal((query_count, stored.shape[1])).astype(np.float32)
+
+        # 初回の読み込み・IVFの構築は計測から除く
+        build_start = time.perf_counter()
+        ivf.query(vector=queries[0].tolist(), top_k=TOP_K, namespace=NAMESPACE)
+        build_ms = (time.perf_counter() - build_start) * 1000
+        exact.query(vector=queries[0].tolist(), top_k=TOP_K, namespace=NAMESPACE)
+
+        print(f"records: {source} · {query_count} queries · top_k {TOP_K}" + (f" · filter {query_filter}" if query_filter else ""))
+        print(f"{'backend':<28}{'p50 (ms)':>10}{'p95 (ms)':>10}{'mean (ms)':>11}{'recall@k':>10}")
+        exact_timings, exact_results = time_queries(exact, queries, query_filter)
+        rows = [("local exact", exact_timings, 1.0)]
+        ivf_timings, ivf_results = time_queries(ivf, queries, query_filter)
+        recall = statistics.mean(
+            len(set(found) & set(expected)) / len(expected) if expected else 1.0
+            for found, expected in zip(ivf_results, exact_results)
+        )
+        rows.append((f"local ivf (nprobe {nprobe})", ivf_timings, recall))
+
+        if os.getenv("PINECONE_API_KEY"):
+            pinecone = open_pinecone_index()
+            # Pineconeには同じレコードが無いため、インデックスの次元数の乱数ベクトルで検索する
+            remote_queries = rng.standard_normal((query_count, pinecone.describe_index_stats().dimension))
+            pinecone_timings, _ = time_queries(pinecone, remote_queries, query_filter)
+            rows.append(("pinecone", pinecone_timings, None))
+
+        for name, timings, row_recall in rows:
+            recall_text = "-" if row_recall is None else f"{row_recall:.3f}"
+            print(f"{name:<28}{percentile(timings, 50):>10.2f}{percentile(timings, 95):>10.2f}"
+                  f"{statistics.mean(timings):>11.2f}{recall_text:>10}")
+        print(f"\nIVF build (first query): {build_ms:,.0f} ms")
+        if not os.getenv("PINECONE_API_KEY"):
+            print("pinecone: skipped (PINECONE_API_KEY not set)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+カントリーチャートの国名解決の確認
+重複行（"Surinam" と "Suriname" 等）で、規制理由のある行が空行に隠れていないかを確かめる
+
+使い方:
+    python benchmarks/check_country_chart.py   # 問題があれば終了コード1
+"""
+
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from country_index import get_country_chart_index
+from prompt_context import get_destination_chart_context
+
+# 先頭の重複行が空行になっている国（仕向地の記載, チャート上の規制理由のある行の国名）
+DUPLICATE_ROW_COUNTRIES = [
+    ("Suriname", "Suriname"),
+    ("Saint Lucia", "St. Lucia"),
+    ("St. Kitts and Nevis", "St. Kitts and Nevis"),
+    ("Saint Vincent and the Grenadines", "St. Vincent and the Grenadines"),
+]
+
+
+def main():
+    chart_index = get_country_chart_index()
+    if chart_index is None:
+        print("カントリーチャートがありません")
+        sys.exit(1)
+
+    failures = []
+    for destination, chart_name in DUPLICATE_ROW_COUNTRIES:
+        expected = chart_index.row_bits[chart_index.country_names.index(chart_name)]
+        row = chart_index.row_for(destination)
+        bits = chart_index.row_bits[row] if row is not None else None
+        required = chart_index.license_required("NS 1, AT 1", destination)
+        context = get_destination_chart_context(destination)
+        ok = bits == expected and required is True and "No reason for control marked" not in context
+        print(f"{destination:<36}{'OK' if ok else 'NG':>4}  row={row} license_required(NS 1, AT 1)={required}")
+        if not ok:
+            failures.append(destination)
+
+    # 同じ国IDの行のうち、規制理由のある行があるのに空行が選ばれている国
+    rows_by_id = defaultdict(list)
+    for i, country_id in enumerate(chart_index.country_ids):
+        rows_by_id[country_id].append(i)
+    for country_id, rows in rows_by_id.items():
+        if not chart_index.row_bits[chart_index.row_index[country_id]] and any(chart_index.row_bits[i] for i in rows):
+            print(f"{country_id:<36}{'NG':>4}  空行が選ばれています: {[chart_index.country_names[i] for i in rows]}")
+            failures.append(country_id)
+
+    print(f"確認した国ID: {len(rows_by_id)}  問題: {len(failures)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+"""
+カントリーチャートのインデックス
+国名の別名索引（英語名・日本語名・ISOコード・チャートの脚注付き国名 → 国ID）と、
+国 × 規制理由のブール行列で、許可要否を定数時間で判定する
+"""
+
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from data_registry import get_registry
+from data_snapshot import build_country_matrix
+
+# "NS 1" / "NS1" / "ns-1" → ("NS", "1")、"NS" のように列番号が無い場合は ("NS", "")
+REASON_PATTERN = re.compile(r"^\s*([A-Za-z]{2})[\s\-_]*(\d?)\s*$")
+
+# カントリーチャートの国名末尾の脚注番号（例: "Albania 2 3"、"Korea  North 1"）
+FOOTNOTE_SUFFIX = re.compile(r"(\s+\d+)+\s*$")
+NON_WORD = re.compile(r"[^\w]+")
+CJK_CHARS = re.compile(r"[\u3040-\u30ff\u3400-\u9fff]")
+
+# 部分一致で照合する際の最大語数（"Democratic Republic of the Congo" 等）
+MAX_ALIAS_WORDS = 6
+
+
+def _strip_latin_accents(text: str) -> str:
+    """ラテン文字のアクセントのみ除去（日本語の濁点は残す）"""
+    chars = []
+    for ch in text:
+        if ord(ch) < 0x250:
+            ch = ''.join(c for c in unicodedata.normalize('NFKD', ch) if not unicodedata.combining(c))
+        chars.append(ch)
+    return ''.join(chars)
+
+
+def normalize_country_name(name: str) -> str:
+    """
+    国名を照合用に正規化
+
+    全角→半角・小文字化・アクセント除去・末尾の脚注番号除去・記号を空白に置換する。
+    例: "Albania 2 3" → "albania"、"Bosnia & Herzegovina" → "bosnia and herzegovina"
+    """
+    text = _strip_latin_accents(unicodedata.normalize('NFKC', name or '')).lower()
+    text = FOOTNOTE_SUFFIX.sub('', text)
+    text = text.replace('&', ' and ')
+    return NON_WORD.sub(' ', text).replace('_', ' ').strip()
+
+
+class CountryAliasIndex:
+    """
+    国名の別名索引（正規化した名前 → 国ID）
+
+    国IDはISO 3166-1 alpha-3コード。英語名・日本語名・別名・カントリーチャートの国名は
+    入力全体または入力中の語句で照合し、ISO2/ISO3コードは入力全体が一致した場合のみ採用する
+    （"in"・"no" のような一般語を国コードと誤認しないため）。
+    1つの国に決まらない入力（"Korea"・"朝鮮"・"Congo" 等）は resolve ではNoneとなり、
+    候補の国は resolve_candidates で取得する。
+    """
+
+    def __init__(self, alias_df: Optional[pd.DataFrame], extra_names: Iterable[str] = ()):
+        self.names: Dict[str, str] = {}
+        self.codes: Dict[str, str] = {}
+        self.countries: Dict[str, Dict[str, str]] = {}
+        self.unresolved: List[str] = []
+        self._cjk_names: List[Tuple[str, str]] = []
+        # 語 → その語を含む名前（曖昧な入力の候補の検索用）
+        self._name_words: Dict[str, set] = {}
+
+        if alias_df is not None:
+            for _, row in alias_df.iterrows():
+                country_id = row['iso3'].strip().upper()
+                self.countries[country_id] = {
+                    "iso2": row['iso2'].strip().upper(),
+                    "name_en": row['英語名'],
+                    "name_ja": row['日本語名'],
+                }
+                self.codes[country_id.lower()] = country_id
+                self.codes[row['iso2'].strip().lower()] = country_id
+                aliases = [row['英語名'], row['日本語名']] + [a for a in row['別名'].split('|') if a.strip()]
+                for alias in aliases:
+                    self._add_name(alias, country_id)
+
+        # カントリーチャート等の国名（脚注付き・表記揺れ）も既存の国IDに結び付ける
+        for name in extra_names:
+            if not normalize_country_name(name):
+                continue
+            country_id = self.resolve(name)
+            if country_id is None:
+                self.unresolved.append(name)
+            else:
+                self._add_name(name, country_id)
+
+        # 日本語名は語の区切りが無いため、最長一致の照合用に長い順で保持
+        self._cjk_names.sort(key=lambda item: len(item[0]), reverse=True)
+        self.resolve = lru_cache(maxsize=4096)(self._resolve_uncached)
+
+    def _add_name(self, name: str, country_id: str):
+        key = normalize_country_name(name)
+        if not key:
+            return
+        self.names.setdefault(key, country_id)
+        for word in key.split():
+            self._name_words.setdefault(word, set()).add(key)
+        if CJK_CHARS.search(key):
+            compact = key.replace(' ', '')
+            self.names.setdefault(compact, country_id)
+            self._cjk_names.append((compact, country_id))
+
+    def _resolve_uncached(self, text: str) -> Optional[str]:
+        key = normalize_country_name(text)
+        if not key:
+            return None
+
+        # 1. 入力全体が名前・コードに一致（O(1)）
+        country_id = self.names.get(key) or self.codes.get(key) or self.names.get(key.replace(' ', ''))
+        if country_id:
+            return country_id
+
+        # 2. 入力中の語句（長い語句優先）が名前に一致（例: "Hanoi, Vietnam"）
+        words = key.split()
+        for size in range(min(MAX_ALIAS_WORDS, len(words)), 0, -1):
+            for start in range(len(words) - size + 1):
+                country_id = self.names.get(' '.join(words[start:start + size]))
+                if country_id:
+                    return country_id
+
+        # 3. 日本語は最長一致の部分文字列で照合（例: "中国上海市"）
+        if CJK_CHARS.search(key):
+            compact = key.replace(' ', '')
+            for name, country_id in self._cjk_names:
+                if name in compact:
+                    return country_id
+        return None
+
+    def resolve(self, text: str) -> Optional[str]:
+        """
+        任意の国名文字列を国IDに解決
+
+        Args:
+            text: 国名（英語名・日本語名・ISO2/ISO3・チャートの国名等）
+
+        Returns:
+            国ID（ISO 3166-1 alpha-3）。解決できなければNone
+        """
+        return self._resolve_uncached(text)
+
+    def resolve_candidates(self, text: str) -> List[str]:
+        """
+        国名文字列に該当しうる国IDをすべて取得
+
+        resolve で1つの国に決まる場合はその国のみ。決まらない場合は、入力の語をすべて含む名前
+        （"Korea" → "Korea North"・"Korea South"）、日本語では入力を含む名前（"朝鮮" → "北朝鮮"）の国を返す。
+
+        Args:
+            text: 国名
+
+        Returns:
+            国IDのリスト（国ID順・重複なし。該当が無ければ空）
+        """
+        country_id = self.resolve(text)
+        if country_id is not None:
+            return [country_id]
+        key = normalize_country_name(text)
+        if not key:
+            return []
+
+        candidates = set()
+        words = key.split()
+        if words and all(word in self._name_words for word in words):
+            names = set.intersection(*(self._name_words[word] for word in words))
+            candidates.update(self.names[name] for name in names)
+        if CJK_CHARS.search(key):
+            compact = key.replace(' ', '')
+            candidates.update(country_id for name, country_id in self._cjk_names if compact in name)
+        return sorted(candidates)
+
+    def find_all(self, text: str) -> List[str]:
+        """
+        文中に含まれる国をすべて国IDに解決（例: "Vietnam and Thailand" → ["VNM", "THA"]）
+
+        長い語句を優先し、重なる位置の短い名前（"Guinea-Bissau" 中の "Guinea" 等）は採用しない。
+
+        Args:
+            text: 仕向地の記載等
+
+        Returns:
+            国IDのリスト（出現順・重複なし）
+        """
+        key = normalize_country_name(text)
+        if not key:
+            return []
+        whole = self.names.get(key) or self.codes.get(key)
+        if whole:
+            return [whole]
+
+        found: Dict[str, None] = {}
+        words = key.split()
+        i = 0
+        while i < len(words):
+            for size in range(min(MAX_ALIAS_WORDS, len(words) - i), 0, -1):
+                country_id = self.names.get(' '.join(words[i:i + size]))
+                if country_id:
+                    found.setdefault(country_id, None)
+                    i += size
+                    break
+            else:
+                i += 1
+
+        if CJK_CHARS.search(key):
+            compact = key.replace(' ', '')
+            taken = [False] * len(compact)
+            for name, country_id in self._cjk_names:
+                start = compact.find(name)
+                while start != -1:
+                    if not any(taken[start:start + len(name)]):
+                        taken[start:start + len(name)] = [True] * len(name)
+                        found.setdefault(country_id, None)
+                    start = compact.find(name, start + 1)
+        return list(found)
+
+    def display_name(self, country_id: str) -> str:
+        """国IDの表示名（英語名）"""
+        return self.countries.get(country_id, {}).get("name_en", country_id)
+
+
+class CountryChartIndex:
+    """
+    カントリーチャートの（国 × 規制理由）ブール行列
+
+    行列はスナップショットからメモリマップで読み込まれたものをそのまま使い、
+    国名・規制理由の索引は構築時に一度だけ作る。
+    """
+
+    def __init__(self, matrix: np.ndarray, country_names: Sequence[str], reason_columns: Sequence[str], aliases: Optional[CountryAliasIndex] = None):
+        self.matrix = matrix
+        self.country_names = list(country_names)
+        self.reason_columns = list(reason_columns)
+        self.reason_index = {reason: i for i, reason in enumerate(self.reason_columns)}
+        self.aliases = aliases if aliases is not None else CountryAliasIndex(None)
+
+        # 規制理由の種類（"NS" 等）→ 列番号（列番号の無い "NS" は NS 1・NS 2 の両方を対象にする）
+        self._reason_groups: Dict[str, List[int]] = {}
+        for i, reason in enumerate(self.reason_columns):
+            self._reason_groups.setdefault(reason.split()[0].upper(), []).append(i)
+
+        # 行ごとのビットマスク（列 i の 'X' をビット i に格納）で判定を定数時間にする
+        self.row_bits = [0] * len(self.country_names)
+        if self.reason_columns:
+            weights = 1 << np.arange(len(self.reason_columns), dtype=np.int64)
+            self.row_bits = [int(bits) for bits in np.asarray(matrix, dtype=np.int64) @ weights]
+
+        # 国ID（別名索引で解決できない国名は正規化した名前）→ 行番号
+        # 重複行（"Surinam" と "Suriname" 等）は先頭を採用し、先頭が空行なら規制理由のある行で置き換える
+        self.country_ids = [self.aliases.resolve(name) or normalize_country_name(name) for name in self.country_names]
+        self.row_index: Dict[str, int] = {}
+        for i, country_id in enumerate(self.country_ids):
+            row = self.row_index.setdefault(country_id, i)
+            if not self.row_bits[row] and self.row_bits[i]:
+                self.row_index[country_id] = i
+
+        self._columns_for = lru_cache(maxsize=1024)(self._columns_for_uncached)
+        self.row_for = lru_cache(maxsize=4096)(self._row_for_uncached)
+
+    @classmethod
+    def from_dataframe(cls, country_chart_df: pd.DataFrame, aliases: Optional[CountryAliasIndex] = None) -> "CountryChartIndex":
+        """カントリーチャートのDataFrameから構築"""
+        matrix, countries, reason_columns = build_country_matrix(country_chart_df)
+        return cls(matrix, countries, reason_columns, aliases)
+
+    def _columns_for_uncached(self, reasons: Tuple[str, ...]) -> Tuple[int, ...]:
+        columns = []
+        for reason in reasons:
+            if reason in self.reason_index:
+                columns.append(self.reason_index[reason])
+                continue
+            match = REASON_PATTERN.match(reason)
+            if not match:
+                continue
+            code, number = match.group(1).upper(), match.group(2)
+            if number:
+                column = self.reason_index.get(f"{code} {number}")
+                if column is not None:
+                    columns.append(column)
+            else:
+                columns.extend(self._reason_groups.get(code, []))
+        return tuple(sorted(set(columns)))
+
+    def columns_for(self, eccn_reasons: Union[str, Iterable[str]]) -> Tuple[int, ...]:
+        """
+        規制理由を列番号に変換
+
+        Args:
+            eccn_reasons: 規制理由（"NS 1"、"NS 1, AT 1"、["NS 1", "MT 1"] 等）
+
+        Returns:
+            列番号のタプル
+        """
+        if isinstance(eccn_reasons, str):
+            eccn_reasons = eccn_reasons.split(',')
+        return self._columns_for(tuple(reason.strip() for reason in eccn_reasons if reason and reason.strip()))
+
+    def _row_for_uncached(self, country: str) -> Optional[int]:
+        country_id = self.aliases.resolve(country) or normalize_country_name(country)
+        return self.row_index.get(country_id) if country_id else None
+
+    def required_reasons(self, eccn_reasons: Union[str, Iterable[str]], country: str) -> List[str]:
+        """
+        対象国で許可が必要（チャートに 'X'）な規制理由を返す
+
+        Args:
+            eccn_reasons: ECCNの規制理由
+            country: 仕向地
+
+        Returns:
+            許可が必要な規制理由列のリスト（国が見つからない場合は空）
+        """
+        row = self.row_for(country)
+        if row is None:
+            return []
+        bits = self.row_bits[row]
+        return [self.reason_columns[col] for col in self.columns_for(eccn_reasons) if bits >> col & 1]
+
+    def license_required(self, eccn_reasons: Union[str, Iterable[str]], country: str) -> Optional[bool]:
+        """
+        ECCNの規制理由と仕向地から許可の要否を判定
+
+        Returns:
+            許可が必要ならTrue、不要ならFalse、国がチャートに無ければNone
+        """
+        row = self.row_for(country)
+        if row is None:
+            return None
+        return bool(self.row_bits[row] & self.columns_mask(eccn_reasons))
+
+    def columns_mask(self, eccn_reasons: Union[str, Iterable[str]]) -> int:
+        """規制理由を列のビットマスクに変換"""
+        mask = 0
+        for column in self.columns_for(eccn_reasons):
+            mask |= 1 << column
+        return mask
+
+    def reason_column(self, reason: str) -> Optional[np.ndarray]:
+        """規制理由1列分のブール配列（全ての国）"""
+        column = self.reason_index.get(reason)
+        return None if column is None else np.asarray(self.matrix[:, column])
+
+    def restriction_counts(self) -> Dict[str, int]:
+        """規制理由ごとの許可が必要な国の数"""
+        counts = np.asarray(self.matrix).sum(axis=0)
+        return {reason: int(counts[i]) for i, reason in enumerate(self.reason_columns)}
+
+    def format_rows(self, rows: Iterable[int], key_columns: Sequence[str]) -> str:
+        """
+        指定行をプロンプト用のテキストに整形（許可が必要な規制理由のみ列挙）
+
+        Args:
+            rows: 行番号
+            key_columns: 表示する規制理由列
+
+        Returns:
+            "**国名**:\\n  - NS 1: X\\n..." 形式のテキスト
+        """
+        columns = [(reason, self.reason_index[reason]) for reason in key_columns if reason in self.reason_index]
+        text = ""
+        for row in rows:
+            text += f"\n**{self.country_names[row]}**:\n"
+            bits = self.row_bits[row]
+            for reason, column in columns:
+                if bits >> column & 1:
+                    text += f"  - {reason}: X\n"
+        return text
+
+
+def _build_alias_index(data) -> CountryAliasIndex:
+    extra_names = list(data.get('country_names', []))
+    countries = data.get('countries')
+    if countries is not None and '国名' in countries.columns:
+        extra_names.extend(countries['国名'].dropna().astype(str))
+    return CountryAliasIndex(data.get('country_aliases'), extra_names)
+
+
+def get_country_alias_index() -> CountryAliasIndex:
+    """共有レジストリのデータから構築した国名の別名索引を取得（バージョンごとに一度だけ構築）"""
+    return get_registry().get_derived("country_alias_index", _build_alias_index)
+
+
+def resolve_country(text: str) -> Optional[str]:
+    """
+    任意の国名文字列を国ID（ISO 3166-1 alpha-3）に解決
+
+    Args:
+        text: 国名（"Vietnam"、"ベトナム"、"VN"、"VNM"、"Albania 2 3" 等）
+
+    Returns:
+        国ID。解決できなければNone
+    """
+    return get_country_alias_index().resolve(text)
+
+
+def resolve_countries(text: str) -> List[str]:
+    """
+    文中に含まれる国をすべて国IDに解決
+
+    Args:
+        text: 仕向地の記載（"Vietnam, Thailand"、"ベトナム・タイ" 等）
+
+    Returns:
+        国IDのリスト（出現順・重複なし）
+    """
+    return get_country_alias_index().find_all(text)
+
+
+def get_country_chart_index(country_chart_df: Optional[pd.DataFrame] = None) -> Optional[CountryChartIndex]:
+    """
+    カントリーチャートのインデックスを取得
+
+    共有レジストリのチャートはバージョンごとに一度だけ構築する。
+
+    Args:
+        country_chart_df: カントリーチャートのDataFrame（省略時は共有レジストリのデータ）
+
+    Returns:
+        インデックス（チャートが無い場合はNone）
+    """
+    registry = get_registry()
+    data = registry.get()
+    if country_chart_df is None or country_chart_df is data.get('country_chart'):
+        if data.get('country_chart') is None:
+            return None
+        return registry.get_derived(
+            "country_chart_index",
+            lambda d: CountryChartIndex(d['country_matrix'], d['country_names'], d['reason_columns'], get_country_alias_index())
+        )
+
+    if country_chart_df.empty:
+        return None
+    return CountryChartIndex.from_dataframe(country_chart_df, get_country_alias_index())
+
+
+def license_required(eccn_reasons: Union[str, Iterable[str]], country: str) -> Optional[bool]:
+    """
+    ECCNの規制理由と仕向地から許可の要否を判定（共有レジストリのカントリーチャートを使用）
+
+    Args:
+        eccn_reasons: 規制理由（"NS 1"、"NS 1, AT 1"、["NS 1", "MT 1"] 等。"NS" のみの場合は NS 1・NS 2 両方）
+        country: 仕向地
+
+    Returns:
+        許可が必要ならTrue、不要ならFalse、国がチャートに無ければNone
+    """
+    index = get_country_chart_index()
+    if index is None:
+        return None
+    return index.license_required(eccn_reasons, country)
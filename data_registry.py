@@ -0,0 +1,243 @@
+"""
+参照データレジストリ
+ECCN JSON・カントリーチャート・サンプルCSV・規制テキストをプロセス内で一度だけ読み込み、全セッションで共有する
+"""
+
+import sys
+import threading
+import time
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+import pandas as pd
+
+from data_snapshot import (
+    compile_reference_data,
+    compute_version,
+    file_sha256,
+    load_or_build_snapshot,
+    load_source
+)
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# データキー → ソースファイル（BASE_DIRからの相対パス）
+SOURCE_FILES = {
+    'eccn_csv': Path("sample_data") / "eccn_list.csv",
+    'eccn_json': Path("eccnnumber.json"),
+    'country_chart': Path("11_12_2025_country_chart_export.csv"),
+    'countries': Path("sample_data") / "country_groups.csv",
+    'entities': Path("sample_data") / "entity_list_sample.csv",
+    'country_aliases': Path("sample_data") / "country_aliases.csv",
+    'general_prohibitions': Path("generalPohibition.text"),
+}
+
+
+def _estimate_memory(value: Any) -> int:
+    """データのおおよそのメモリ使用量（バイト）を返す"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+
+    # JSONはネスト構造を辿って合算
+    seen = set()
+    stack = [value]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return total
+
+
+class ReferenceDataRegistry:
+    """
+    読み取り専用の参照データレジストリ
+
+    ソースファイルの更新時刻・サイズが変わった場合のみ再読み込みし、
+    それ以外は全セッションに同じオブジェクトを返す。
+    返されるデータは共有されるため、呼び出し側で変更してはならない。
+    """
+
+    def __init__(self, base_dir: Path = BASE_DIR, source_files: Optional[Dict[str, Path]] = None, use_snapshot: bool = True):
+        self.base_dir = Path(base_dir)
+        self.source_files = dict(source_files or SOURCE_FILES)
+        self.use_snapshot = use_snapshot
+        self._lock = threading.RLock()
+        self._data: Mapping[str, Any] = MappingProxyType({})
+        self._fingerprints: Dict[str, Tuple[int, int]] = {}
+        self._version = ""
+        self._derived: Dict[str, Any] = {}
+        self._stats: Dict[str, Any] = {
+            "load_count": 0,
+            "loaded_at": None,
+            "load_mode": None,
+            "total_load_ms": 0.0,
+            "sources": {}
+        }
+
+    def _current_fingerprints(self) -> Dict[str, Tuple[int, int]]:
+        """各ソースファイルの (mtime_ns, size) を取得（存在しないファイルは除外）"""
+        fingerprints = {}
+        for key, rel_path in self.source_files.items():
+            path = self.base_dir / rel_path
+            try:
+                st_result = path.stat()
+            except OSError:
+                continue
+            fingerprints[key] = (st_result.st_mtime_ns, st_result.st_size)
+        return fingerprints
+
+    def _load_from_snapshot(self) -> Tuple[Dict[str, Any], str, str]:
+        """スナップショットから読み込む（古ければ再構築）"""
+        compiled, manifest = load_or_build_snapshot(self.base_dir, self.source_files)
+        return compiled, manifest["version"], "snapshot (rebuilt)" if manifest.get("rebuilt") else "snapshot"
+
+    def _load_from_sources(self, fingerprints: Dict[str, Tuple[int, int]], source_stats: Dict[str, Dict]) -> Tuple[Dict[str, Any], str, str]:
+        """ソースファイルを直接読み込む（スナップショットが使えない場合）"""
+        raw = {}
+        hashes = {}
+        for key in sorted(fingerprints):
+            path = self.base_dir / self.source_files[key]
+            start = time.perf_counter()
+            try:
+                hashes[key] = file_sha256(path)
+                raw[key] = load_source(path)
+            except Exception as e:
+                print(f"参照データの読み込みエラー ({path.name}): {str(e)}")
+                continue
+            source_stats[key] = {"load_ms": (time.perf_counter() - start) * 1000}
+        return compile_reference_data(raw), compute_version(hashes), "source"
+
+    def _reload(self, fingerprints: Dict[str, Tuple[int, int]]):
+        """全ソースを読み込み直し、バージョンと統計を更新"""
+        source_stats: Dict[str, Dict] = {}
+        total_start = time.perf_counter()
+
+        data = None
+        if self.use_snapshot:
+            try:
+                data, version, load_mode = self._load_from_snapshot()
+            except Exception as e:
+                print(f"スナップショットの読み込みエラー（ソースから読み込みます）: {str(e)}")
+        if data is None:
+            data, version, load_mode = self._load_from_sources(fingerprints, source_stats)
+
+        for key in self.source_files:
+            if key not in data:
+                continue
+            source_stats.setdefault(key, {"load_ms": None})
+            source_stats[key]["path"] = str(self.source_files[key])
+            source_stats[key]["memory_bytes"] = _estimate_memory(data[key])
+
+        self._data = MappingProxyType(data)
+        self._fingerprints = fingerprints
+        self._version = version
+        self._derived = {}
+        self._stats["load_count"] += 1
+        self._stats["loaded_at"] = time.time()
+        self._stats["load_mode"] = load_mode
+        self._stats["total_load_ms"] = (time.perf_counter() - total_start) * 1000
+        self._stats["sources"] = source_stats
+
+    def get(self) -> Mapping[str, Any]:
+        """
+        参照データを取得（必要に応じて再読み込み）
+
+        Returns:
+            データキー → DataFrame / dict の読み取り専用マッピング
+            （ソースデータに加え、eccn_records・country_matrix 等の派生データを含む）
+        """
+        fingerprints = self._current_fingerprints()
+        if fingerprints == self._fingerprints and self._version:
+            return self._data
+
+        with self._lock:
+            # ロック待ちの間に他スレッドが読み込み済みの場合がある
+            if fingerprints != self._fingerprints or not self._version:
+                self._reload(fingerprints)
+            return self._data
+
+    @property
+    def version(self) -> str:
+        """現在の参照データのバージョン（ソース内容のハッシュ）"""
+        self.get()
+        return self._version
+
+    def get_derived(self, name: str, builder: Callable[[Mapping[str, Any]], Any]) -> Any:
+        """
+        参照データから作る派生オブジェクト（検索インデックス等）を取得
+
+        派生オブジェクトはデータのバージョンごとに一度だけ構築され、再読み込み時に破棄される。
+
+        Args:
+            name: 派生オブジェクトの名前
+            builder: 参照データを受け取って派生オブジェクトを構築する関数
+
+        Returns:
+            構築済みの派生オブジェクト
+        """
+        data = self.get()
+        derived = self._derived
+        if name in derived:
+            return derived[name]
+
+        with self._lock:
+            if self._data is not data:
+                # 構築待ちの間に再読み込みされた場合は最新データで構築
+                data = self._data
+            if name not in self._derived:
+                self._derived[name] = builder(data)
+            return self._derived[name]
+
+    def invalidate(self):
+        """次回の get() で強制的に再読み込みさせる"""
+        with self._lock:
+            self._fingerprints = {}
+            self._version = ""
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        読み込み時間・メモリ使用量の統計を取得
+
+        Returns:
+            統計情報の辞書
+        """
+        self.get()
+        with self._lock:
+            sources = {key: dict(value) for key, value in self._stats["sources"].items()}
+            return {
+                "version": self._version,
+                "load_count": self._stats["load_count"],
+                "loaded_at": self._stats["loaded_at"],
+                "load_mode": self._stats["load_mode"],
+                "total_load_ms": self._stats["total_load_ms"],
+                "total_memory_bytes": sum(s["memory_bytes"] for s in sources.values()),
+                "sources": sources,
+            }
+
+
+_registry: Optional[ReferenceDataRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ReferenceDataRegistry:
+    """プロセス全体で共有されるレジストリを取得"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ReferenceDataRegistry()
+    return _registry
+
+
+def get_reference_data() -> Mapping[str, Any]:
+    """共有参照データを取得（load_sample_data() 互換のキー構成）"""
+    return get_registry().get()
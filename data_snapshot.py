@@ -0,0 +1,288 @@
+"""
+参照データのバイナリスナップショット
+ECCN JSON・カントリーチャート・サンプルCSVを事前コンパイルし、起動時に数ミリ秒で開けるようにする
+
+使い方:
+    python data_snapshot.py          # スナップショットを（再）構築
+    python data_snapshot.py --check  # 有効性のみ確認
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# スナップショット形式のバージョン（構造を変えたら上げる）
+SNAPSHOT_FORMAT_VERSION = 1
+
+SNAPSHOT_DIRNAME = Path(".cache") / "reference_snapshot"
+MANIFEST_FILE = "manifest.json"
+DATA_FILE = "data.pickle"
+MATRIX_FILE = "country_matrix.npy"
+
+# カントリーチャートの規制理由列（CB 1〜AT 2）
+REASON_COLUMN_SLICE = slice(1, 17)
+
+
+def file_sha256(path: Path) -> str:
+    """ファイル内容のSHA-256を取得"""
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def compute_version(source_hashes: Dict[str, str]) -> str:
+    """ソースファイルのハッシュから参照データのバージョン文字列を計算"""
+    digest = hashlib.sha256()
+    for key in sorted(source_hashes):
+        digest.update(key.encode('utf-8'))
+        digest.update(bytes.fromhex(source_hashes[key]))
+    return digest.hexdigest()[:16]
+
+
+# ファイル別のCSV読み込みオプション（国コード "NA"（ナミビア）を欠損値にしない等）
+CSV_READ_OPTIONS = {
+    "country_aliases.csv": {"keep_default_na": False, "dtype": str},
+}
+
+
+def load_source(path: Path) -> Any:
+    """ソースファイルを1つ読み込む（JSON・CSV、規制テキスト .text / .txt は文字列のまま）"""
+    if path.suffix == ".json":
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    if path.suffix in (".text", ".txt"):
+        return path.read_text(encoding='utf-8')
+    return pd.read_csv(path, **CSV_READ_OPTIONS.get(path.name, {}))
+
+
+def flatten_eccn_records(eccn_json: Optional[Dict]) -> List[Dict]:
+    """
+    ECCN JSONのカテゴリー → プロダクトグループ → アイテムの入れ子構造を平坦化
+
+    Args:
+        eccn_json: ECCN JSONデータ
+
+    Returns:
+        ECCNレコードのリスト（ECCN番号を持たない注記アイテムは除外）
+    """
+    records = []
+    if not eccn_json or 'ccl_categories' not in eccn_json:
+        return records
+
+    for category in eccn_json['ccl_categories']:
+        for group in category.get('product_groups', []):
+            for item in group.get('items', []):
+                if 'eccn' not in item:
+                    continue
+                records.append({
+                    "eccn": item.get('eccn', ''),
+                    "description": item.get('description', ''),
+                    "reason_for_control": item.get('reason_for_control', ''),
+                    "category_number": category.get('category_number', ''),
+                    "category_title": category.get('title', ''),
+                    "group_letter": group.get('group_letter', ''),
+                    "group_title": group.get('group_title', ''),
+                })
+    return records
+
+
+def build_country_matrix(country_chart: Optional[pd.DataFrame]) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    カントリーチャートを（国 × 規制理由）のブール行列に変換
+
+    Returns:
+        (ブール行列, 国名リスト, 規制理由列リスト)
+    """
+    if country_chart is None or country_chart.empty:
+        return np.zeros((0, 0), dtype=bool), [], []
+
+    reason_columns = list(country_chart.columns[REASON_COLUMN_SLICE])
+    matrix = (country_chart[reason_columns] == 'X').to_numpy(dtype=bool)
+    countries = country_chart.iloc[:, 0].fillna('').astype(str).tolist()
+    return matrix, countries, reason_columns
+
+
+def compile_reference_data(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    読み込んだソースデータに平坦化レコード・行列・インデックスを追加
+
+    Args:
+        raw: データキー → 読み込み済みデータ
+
+    Returns:
+        派生データを含む辞書
+    """
+    compiled = dict(raw)
+    records = flatten_eccn_records(raw.get('eccn_json'))
+    compiled['eccn_records'] = records
+    compiled['eccn_record_index'] = {record['eccn']: i for i, record in enumerate(records)}
+
+    matrix, countries, reason_columns = build_country_matrix(raw.get('country_chart'))
+    compiled['country_matrix'] = matrix
+    compiled['country_names'] = countries
+    compiled['reason_columns'] = reason_columns
+    compiled['country_row_index'] = {name: i for i, name in enumerate(countries)}
+    return compiled
+
+
+def _source_entries(base_dir: Path, source_files: Dict[str, Path]) -> Dict[str, Dict]:
+    """存在するソースファイルの (パス, mtime, サイズ) を取得"""
+    entries = {}
+    for key, rel_path in source_files.items():
+        path = base_dir / rel_path
+        try:
+            st_result = path.stat()
+        except OSError:
+            continue
+        entries[key] = {
+            "path": str(rel_path),
+            "mtime_ns": st_result.st_mtime_ns,
+            "size": st_result.st_size,
+        }
+    return entries
+
+
+def _read_manifest(snapshot_dir: Path) -> Optional[Dict]:
+    try:
+        with open(snapshot_dir / MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_snapshot_valid(base_dir: Path, source_files: Dict[str, Path], snapshot_dir: Path) -> bool:
+    """
+    スナップショットがソースファイルと一致しているか確認
+
+    mtime・サイズが一致すれば有効。mtimeのみ異なる場合は内容のハッシュで判定する。
+    """
+    manifest = _read_manifest(snapshot_dir)
+    if not manifest or manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        return False
+
+    current = _source_entries(base_dir, source_files)
+    recorded = manifest.get("sources", {})
+    if set(current) != set(recorded):
+        return False
+
+    for key, entry in current.items():
+        saved = recorded[key]
+        if entry["path"] != saved.get("path") or entry["size"] != saved.get("size"):
+            return False
+        if entry["mtime_ns"] != saved.get("mtime_ns"):
+            if file_sha256(base_dir / source_files[key]) != saved.get("sha256"):
+                return False
+    return True
+
+
+def build_snapshot(base_dir: Path, source_files: Dict[str, Path], snapshot_dir: Optional[Path] = None) -> Dict:
+    """
+    ソースファイルからスナップショットを構築して書き出す
+
+    Args:
+        base_dir: ソースファイルの基準ディレクトリ
+        source_files: データキー → ソースファイル（基準ディレクトリからの相対パス）
+        snapshot_dir: 出力先（省略時は base_dir/.cache/reference_snapshot）
+
+    Returns:
+        書き出したマニフェスト
+    """
+    base_dir = Path(base_dir)
+    snapshot_dir = Path(snapshot_dir) if snapshot_dir else base_dir / SNAPSHOT_DIRNAME
+    start = time.perf_counter()
+
+    sources = _source_entries(base_dir, source_files)
+    raw = {}
+    for key, entry in sources.items():
+        path = base_dir / source_files[key]
+        entry["sha256"] = file_sha256(path)
+        raw[key] = load_source(path)
+
+    compiled = compile_reference_data(raw)
+    matrix = compiled.pop('country_matrix')
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "version": compute_version({key: entry["sha256"] for key, entry in sources.items()}),
+        "built_at": time.time(),
+        "sources": sources,
+    }
+
+    # 一時ディレクトリに書いてから置き換え（読み込み中のプロセスが壊れたファイルを見ないように）
+    snapshot_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = snapshot_dir.with_name(f"{snapshot_dir.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+    with open(tmp_dir / DATA_FILE, 'wb') as f:
+        pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+    np.save(tmp_dir / MATRIX_FILE, matrix)
+    manifest["build_ms"] = (time.perf_counter() - start) * 1000
+    with open(tmp_dir / MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    old_dir = snapshot_dir.with_name(f"{snapshot_dir.name}.old-{os.getpid()}")
+    if snapshot_dir.exists():
+        os.replace(snapshot_dir, old_dir)
+    os.replace(tmp_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def open_snapshot(snapshot_dir: Path) -> Tuple[Dict[str, Any], Dict]:
+    """
+    スナップショットを開く（国×規制理由の行列はメモリマップで読み込む）
+
+    Returns:
+        (コンパイル済みデータ, マニフェスト)
+    """
+    snapshot_dir = Path(snapshot_dir)
+    manifest = _read_manifest(snapshot_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"スナップショットがありません: {snapshot_dir}")
+
+    with open(snapshot_dir / DATA_FILE, 'rb') as f:
+        compiled = pickle.load(f)
+    compiled['country_matrix'] = np.load(snapshot_dir / MATRIX_FILE, mmap_mode='r')
+    return compiled, manifest
+
+
+def load_or_build_snapshot(base_dir: Path, source_files: Dict[str, Path], snapshot_dir: Optional[Path] = None) -> Tuple[Dict[str, Any], Dict]:
+    """
+    有効なスナップショットを開き、古い・存在しない場合は再構築してから開く
+
+    Returns:
+        (コンパイル済みデータ, マニフェスト)  ※マニフェストの "rebuilt" は今回再構築したかどうか
+    """
+    base_dir = Path(base_dir)
+    snapshot_dir = Path(snapshot_dir) if snapshot_dir else base_dir / SNAPSHOT_DIRNAME
+    rebuilt = not is_snapshot_valid(base_dir, source_files, snapshot_dir)
+    if rebuilt:
+        build_snapshot(base_dir, source_files, snapshot_dir)
+    compiled, manifest = open_snapshot(snapshot_dir)
+    manifest["rebuilt"] = rebuilt
+    return compiled, manifest
+
+
+if __name__ == "__main__":
+    from data_registry import BASE_DIR, SOURCE_FILES
+
+    target_dir = BASE_DIR / SNAPSHOT_DIRNAME
+    if "--check" in sys.argv:
+        valid = is_snapshot_valid(BASE_DIR, SOURCE_FILES, target_dir)
+        print(f"スナップショット: {'有効' if valid else '要再構築'} ({target_dir})")
+        sys.exit(0 if valid else 1)
+
+    result = build_snapshot(BASE_DIR, SOURCE_FILES, target_dir)
+    print(f"スナップショットを構築しました: {target_dir}")
+    print(f"  バージョン: {result['version']}")
+    print(f"  構築時間: {result['build_ms']:.1f} ms")
+    start = time.perf_counter()
+    open_snapshot(target_dir)
+    print(f"  読み込み時間: {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,437 @@
+"""
+ECCN検索インデックス
+ECCN番号・説明・カテゴリー名の転置インデックス（BM25ランキング）、ECCN番号の直接引きテーブル、
+ワイルドカード検索用のECCN番号トライ
+"""
+
+import itertools
+import math
+import re
+import string
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from data_registry import get_registry
+from data_snapshot import flatten_eccn_records
+
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+")
+
+# ECCN番号（例: 5A002）と範囲指定（例: "1A001 - 1A008 (Range)"）
+ECCN_CODE_PATTERN = re.compile(r"\b(\d[A-Z]\d{3})\b")
+ECCN_RANGE_PATTERN = re.compile(r"\b(\d[A-Z]\d{3})\s*-\s*(\d[A-Z]\d{3})\b")
+
+# ECCN番号パターンのワイルドカード（1文字: x / ?、以降すべて: *）
+SINGLE_WILDCARDS = {"X", "?"}
+# ECCN番号の文字数と、各位置に現れうる文字（カテゴリー数字・グループ文字・3桁番号）
+ECCN_LENGTH = 5
+DIGITS = set(string.digits)
+ECCN_CHARS = DIGITS | set("ABCDE")
+ECCN_PATTERN_SYNTAX = re.compile(r"^[0-9X?*][0-9A-EX?*]{0,4}$")
+
+# フィールドごとの重み（ECCN番号の一致を最優先）
+FIELD_WEIGHTS = {
+    "eccn": 3.0,
+    "description": 1.0,
+    "category_title": 0.5,
+}
+
+# 前方一致で展開する語彙数の上限
+MAX_PREFIX_EXPANSIONS = 64
+
+
+def tokenize(text: str) -> List[str]:
+    """テキストを小文字の英数字トークンに分割"""
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class ECCNSearchIndex:
+    """
+    ECCNレコードの転置インデックス
+
+    クエリの各語は完全一致または前方一致（"5A00" → "5a001" 等）で照合し、
+    BM25でスコアリングした上位の結果を返す。
+    """
+
+    def __init__(self, records: List[Dict], k1: float = 1.5, b: float = 0.75):
+        self.records = records
+        self.k1 = k1
+        self.b = b
+
+        # 語 → {レコード番号: 重み付き出現頻度}
+        term_freqs: Dict[str, Dict[int, float]] = defaultdict(lambda: defaultdict(float))
+        doc_lengths = []
+        for doc_id, record in enumerate(records):
+            length = 0.0
+            for field, weight in FIELD_WEIGHTS.items():
+                tokens = tokenize(record.get(field, ''))
+                length += len(tokens) * weight
+                for token in tokens:
+                    term_freqs[token][doc_id] += weight
+            doc_lengths.append(length)
+
+        self.doc_lengths = doc_lengths
+        self.avg_doc_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+        self.postings: Dict[str, List[Tuple[int, float]]] = {
+            term: sorted(docs.items()) for term, docs in term_freqs.items()
+        }
+        self.vocabulary = sorted(self.postings)
+
+        doc_count = len(records)
+        self.idf = {
+            term: math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+        # BM25の文書長正規化項を事前計算
+        self._length_norm = [
+            self.k1 * (1 - self.b + self.b * (length / self.avg_doc_length)) if self.avg_doc_length else self.k1
+            for length in doc_lengths
+        ]
+
+    def _expand(self, term: str) -> List[str]:
+        """語を完全一致＋前方一致の語彙に展開"""
+        start = bisect_left(self.vocabulary, term)
+        expanded = []
+        for i in range(start, min(start + MAX_PREFIX_EXPANSIONS, len(self.vocabulary))):
+            candidate = self.vocabulary[i]
+            if not candidate.startswith(term):
+                break
+            expanded.append(candidate)
+        return expanded
+
+    def _score_term(self, term: str) -> Dict[int, float]:
+        """1語分のBM25スコア（前方一致の語は少し減点）"""
+        scores: Dict[int, float] = {}
+        for candidate in self._expand(term):
+            idf = self.idf[candidate]
+            factor = 1.0 if candidate == term else 0.8
+            for doc_id, tf in self.postings[candidate]:
+                score = factor * idf * tf * (self.k1 + 1) / (tf + self._length_norm[doc_id])
+                if score > scores.get(doc_id, 0.0):
+                    scores[doc_id] = score
+        return scores
+
+    def search(self, query: str, top_k: Optional[int] = 10) -> List[Tuple[int, float]]:
+        """
+        クエリで検索
+
+        Args:
+            query: 検索クエリ
+            top_k: 返す件数（Noneの場合は全件）
+
+        Returns:
+            (レコード番号, スコア) のリスト（スコアの降順）。
+            全ての語に一致するレコードを優先し、無ければいずれかの語に一致するレコードを返す。
+            検索できる語が無いクエリは空のリスト。
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            # 英数字の語を含まないクエリ（"暗号"・"!!" 等）はどのレコードにも一致しない（ECCNデータは英語のみ）
+            return []
+
+        term_scores = [self._score_term(term) for term in terms]
+        matched_all = set(term_scores[0]).intersection(*term_scores[1:])
+        candidates = matched_all or set().union(*term_scores)
+
+        hits = [
+            (doc_id, sum(scores.get(doc_id, 0.0) for scores in term_scores))
+            for doc_id in candidates
+        ]
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return hits if top_k is None else hits[:top_k]
+
+
+def normalize_eccn(eccn_number: str) -> str:
+    """
+    ECCN番号を正規化（大文字化・空白除去、"5A002.a.1" のような下位項目は本体番号に丸める）
+
+    Args:
+        eccn_number: ECCN番号
+
+    Returns:
+        正規化されたECCN番号（例: "5A002", "EAR99"）
+    """
+    cleaned = re.sub(r"\s+", "", eccn_number or "").upper()
+    match = re.match(r"\d[A-Z]\d{3}", cleaned)
+    return match.group(0) if match else cleaned
+
+
+def expand_eccn_entry(eccn_field: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    複数番号・範囲を含むECCN欄を個別番号と範囲に展開
+
+    例: "0A998, 0A999" → (["0A998", "0A999"], [])
+        "1A001 - 1A008 (Range)" → ([], [("1A001", "1A008")])
+
+    Returns:
+        (個別ECCN番号のリスト, (開始, 終了) の範囲リスト)
+    """
+    text = (eccn_field or "").upper()
+    ranges = ECCN_RANGE_PATTERN.findall(text)
+    remaining = ECCN_RANGE_PATTERN.sub(" ", text)
+    codes = ECCN_CODE_PATTERN.findall(remaining)
+    if not codes and not ranges and text.strip():
+        codes = [normalize_eccn(text)]
+    return codes, ranges
+
+
+class ECCNLookupTable:
+    """
+    正規化ECCN番号 → レコードの直接引きテーブル
+
+    "0A998, 0A999" のような複数番号の欄は個別番号に展開して登録する。
+    範囲指定の欄（"1A001 - 1A008 (Range)"）はカテゴリー＋グループ（"1A"）ごとに保持し、
+    5文字のECCN番号が個別番号で見つからない場合のみ照合する。
+    """
+
+    def __init__(self, records: List[Dict]):
+        self.records = records
+        self.exact: Dict[str, int] = {}
+        self.ranges: Dict[str, List[Tuple[str, str, int]]] = defaultdict(list)
+
+        for doc_id, record in enumerate(records):
+            codes, ranges = expand_eccn_entry(record.get('eccn', ''))
+            for code in codes:
+                # 同じ番号が複数欄にある場合は最初の欄を採用
+                self.exact.setdefault(code, doc_id)
+            for range_start, range_end in ranges:
+                self.ranges[range_start[:2]].append((range_start, range_end, doc_id))
+
+    def lookup_id(self, eccn_number: str) -> Optional[int]:
+        """ECCN番号に対応するレコード番号を返す（見つからなければNone）"""
+        code = normalize_eccn(eccn_number)
+        doc_id = self.exact.get(code)
+        if doc_id is not None:
+            return doc_id
+        # 範囲は5文字の完全なECCN番号のみ照合する（"1C5" 等の途中までの番号は範囲に一致させない）
+        if not ECCN_CODE_PATTERN.fullmatch(code):
+            return None
+        for range_start, range_end, range_doc_id in self.ranges.get(code[:2], ()):
+            if range_start <= code <= range_end:
+                return range_doc_id
+        return None
+
+    def lookup(self, eccn_number: str) -> Optional[Dict]:
+        """ECCN番号に対応するレコードを返す（見つからなければNone）"""
+        doc_id = self.lookup_id(eccn_number)
+        return self.records[doc_id] if doc_id is not None else None
+
+
+def normalize_eccn_pattern(pattern: str) -> str:
+    """
+    ECCN番号パターンを5文字基準の形に正規化
+
+    - "5A0*" → "5A0*"（* は以降すべてに一致）
+    - "4D"   → "4D*"（ワイルドカードを含まない短いパターンは前方一致）
+    - "x9xx" → "X?9XX"（4文字でグループ文字が省略された形式は「カテゴリー・系列・番号」とみなす）
+    """
+    cleaned = re.sub(r"\s+", "", pattern or "").upper()
+    if len(cleaned) == 4 and "*" not in cleaned and cleaned[1].isdigit():
+        cleaned = cleaned[0] + "?" + cleaned[1:]
+    if len(cleaned) < 5 and not cleaned.endswith("*"):
+        cleaned += "*"
+    return cleaned
+
+
+def _pattern_positions(pattern: str) -> Optional[List[Set[str]]]:
+    """
+    正規化したパターンの5文字それぞれに一致しうる文字の集合（5文字に一致しないパターンはNone）
+
+    例: "1C5XX" → [{"1"}, {"C"}, {"5"}, 数字, 数字]、"4D*" → [{"4"}, {"D"}, 全文字, 全文字, 全文字]
+    """
+    positions: List[Set[str]] = []
+    for ch in pattern:
+        if ch == "*":
+            if len(positions) > ECCN_LENGTH:
+                return None
+            return positions + [set(ECCN_CHARS)] * (ECCN_LENGTH - len(positions))
+        positions.append(set(ECCN_CHARS) if ch in SINGLE_WILDCARDS else {ch})
+    return positions if len(positions) == ECCN_LENGTH else None
+
+
+def is_eccn_pattern(keyword: str) -> bool:
+    """キーワードがワイルドカードを含むECCN番号パターンかどうか"""
+    cleaned = re.sub(r"\s+", "", keyword or "").upper()
+    if not ECCN_PATTERN_SYNTAX.match(cleaned):
+        return False
+    has_wildcard = "*" in cleaned or any(ch in SINGLE_WILDCARDS for ch in cleaned)
+    has_literal = any(ch not in SINGLE_WILDCARDS and ch != "*" for ch in cleaned)
+    return has_wildcard and has_literal
+
+
+class ECCNCodeTrie:
+    """
+    ECCN番号（カテゴリー数字・グループ文字・3桁番号）の文字トライ
+
+    "5A0*"（前方一致）、"4D*"（カテゴリー4のDグループ＝ソフトウェア）、
+    "x9xx"（全カテゴリーの900番台）のようなパターン検索をマイクロ秒単位で行う。
+    範囲指定の欄（"1C298 - 1C999"）はカテゴリー・グループごとに保持し、
+    パターンに一致しうる番号が範囲内にあれば一致とする（"1C5xx" → 1C298〜1C999）。
+    """
+
+    def __init__(self, records: List[Dict]):
+        self.records = records
+        self.root: Dict = {}
+        self.code_count = 0
+        # カテゴリー・グループ（例: "1C"）→ (開始番号, 終了番号, 範囲の表記, レコード番号)
+        self.ranges: Dict[str, List[Tuple[int, int, str, int]]] = defaultdict(list)
+
+        for doc_id, record in enumerate(records):
+            codes, ranges = expand_eccn_entry(record.get('eccn', ''))
+            for code in codes:
+                self._insert(code, doc_id)
+            for range_start, range_end in ranges:
+                if range_start[:2] == range_end[:2]:
+                    self.ranges[range_start[:2]].append((int(range_start[2:]), int(range_end[2:]), f"{range_start}-{range_end}", doc_id))
+                else:
+                    # カテゴリー・グループをまたぐ範囲は両端の番号で登録
+                    self._insert(range_start, doc_id)
+                    self._insert(range_end, doc_id)
+
+    def _insert(self, code: str, doc_id: int):
+        node = self.root
+        for ch in code:
+            node = node.setdefault(ch, {})
+        ids = node.setdefault(None, {})
+        if not ids:
+            self.code_count += 1
+        # 葉ノード: ECCN番号 → レコード番号（キー None に格納）
+        ids.setdefault(code, doc_id)
+
+    def _collect(self, node: Dict, results: List[Tuple[str, int]]):
+        """ノード以下の全ECCN番号を収集"""
+        for key, child in node.items():
+            if key is None:
+                results.extend(child.items())
+            else:
+                self._collect(child, results)
+
+    def _walk(self, node: Dict, pattern: str, pos: int, results: List[Tuple[str, int]]):
+        if pos == len(pattern):
+            if None in node:
+                results.extend(node[None].items())
+            return
+        ch = pattern[pos]
+        if ch == "*":
+            self._collect(node, results)
+        elif ch in SINGLE_WILDCARDS:
+            for key, child in node.items():
+                if key is not None:
+                    self._walk(child, pattern, pos + 1, results)
+        elif ch in node:
+            self._walk(node[ch], pattern, pos + 1, results)
+
+    def match(self, pattern: str) -> List[Tuple[str, int]]:
+        """
+        パターンに一致するECCN番号を検索
+
+        Args:
+            pattern: ECCN番号パターン（x / ? は任意の1文字、* は以降すべて）
+
+        Returns:
+            (ECCN番号, レコード番号) のリスト（番号順）
+        """
+        normalized = normalize_eccn_pattern(pattern)
+        results: List[Tuple[str, int]] = []
+        self._walk(self.root, normalized, 0, results)
+        results.extend(self._match_ranges(normalized))
+        return sorted(results)
+
+    def _match_ranges(self, pattern: str) -> List[Tuple[str, int]]:
+        """パターンに一致しうる番号を含む範囲の欄（(範囲の表記, レコード番号) のリスト）"""
+        positions = _pattern_positions(pattern)
+        if positions is None:
+            return []
+        numbers = sorted(
+            int(''.join(digits))
+            for digits in itertools.product(*(sorted(allowed & DIGITS) for allowed in positions[2:]))
+        )
+        if not numbers:
+            return []
+        matches = []
+        for prefix, entries in self.ranges.items():
+            if prefix[0] not in positions[0] or prefix[1] not in positions[1]:
+                continue
+            for range_start, range_end, label, doc_id in entries:
+                # 範囲内で最小の一致しうる番号が終了番号以下なら重なる
+                i = bisect_left(numbers, range_start)
+                if i < len(numbers) and numbers[i] <= range_end:
+                    matches.append((label, doc_id))
+        return matches
+
+    def query(self, category: Optional[str] = None, group: Optional[str] = None, series: Optional[str] = None) -> List[Tuple[str, int]]:
+        """
+        構造化条件で検索
+
+        Args:
+            category: カテゴリー数字（"0"〜"9"）
+            group: プロダクトグループ文字（"A"〜"E"、例: "D" = ソフトウェア）
+            series: 3桁番号の先頭桁（例: "9" = 900番台、"6" = 600番台）
+
+        Returns:
+            (ECCN番号, レコード番号) のリスト（番号順）
+        """
+        pattern = f"{category or '?'}{(group or '?').upper()}{series or '?'}*"
+        return self.match(pattern)
+
+
+# レジストリ外のECCN JSON用の小さなキャッシュ（(名前, id) → (データ, インデックス)）
+_adhoc_indexes: Dict[Tuple[str, int], Tuple[Dict, object]] = {}
+_ADHOC_CACHE_SIZE = 8
+
+
+def _get_index(name: str, eccn_json: Optional[Dict], factory: Callable[[List[Dict]], object]):
+    """ECCN JSONに対応する派生インデックスを取得（共有レジストリのデータはバージョンごとに一度だけ構築）"""
+    registry = get_registry()
+    if eccn_json is None or eccn_json is registry.get().get('eccn_json'):
+        return registry.get_derived(name, lambda data: factory(data.get('eccn_records', [])))
+
+    key = (name, id(eccn_json))
+    cached = _adhoc_indexes.get(key)
+    if cached is not None and cached[0] is eccn_json:
+        return cached[1]
+
+    index = factory(flatten_eccn_records(eccn_json))
+    if len(_adhoc_indexes) >= _ADHOC_CACHE_SIZE:
+        _adhoc_indexes.pop(next(iter(_adhoc_indexes)))
+    _adhoc_indexes[key] = (eccn_json, index)
+    return index
+
+
+def get_eccn_search_index(eccn_json: Optional[Dict] = None) -> ECCNSearchIndex:
+    """
+    ECCN JSONに対応する検索インデックスを取得
+
+    Args:
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
+
+    Returns:
+        検索インデックス
+    """
+    return _get_index("eccn_search_index", eccn_json, ECCNSearchIndex)
+
+
+def get_eccn_lookup_table(eccn_json: Optional[Dict] = None) -> ECCNLookupTable:
+    """
+    ECCN JSONに対応する直接引きテーブルを取得
+
+    Args:
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
+
+    Returns:
+        直接引きテーブル
+    """
+    return _get_index("eccn_lookup_table", eccn_json, ECCNLookupTable)
+
+
+def get_eccn_code_trie(eccn_json: Optional[Dict] = None) -> ECCNCodeTrie:
+    """
+    ECCN JSONに対応するECCN番号トライを取得
+
+    Args:
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
+
+    Returns:
+        ECCN番号トライ
+    """
+    return _get_index("eccn_code_trie", eccn_json, ECCNCodeTrie)
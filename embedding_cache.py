@@ -0,0 +1,250 @@
+"""
+embeddingの永続キャッシュ
+モデル・次元数・入力テキストのハッシュをキーに、embeddingをfloat32のBLOBとしてSQLiteに保存する。
+よく使うベクトルはメモリ上のLRUに保持し、ディスクの読み出しも省く。
+
+embeddingは参照データに依存しないため、参照データのバージョンが変わっても破棄しない。
+
+環境変数:
+    EMBEDDING_CACHE_ENABLED       0 で無効化（既定: 1）
+    EMBEDDING_CACHE_MEMORY_ITEMS  メモリ上に保持する件数（既定: 512）
+    EMBEDDING_CACHE_MAX_ENTRIES   ディスクに保存する最大件数（超えた分は最終利用が古い順に削除、既定: 20000）
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from data_registry import BASE_DIR
+from prompt_budget import count_tokens
+from telemetry import call_label, record_call
+
+CACHE_PATH = BASE_DIR / ".cache" / "embeddings.sqlite3"
+DEFAULT_MEMORY_ITEMS = 512
+DEFAULT_MAX_ENTRIES = 20000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    dimensions INTEGER NOT NULL,
+    embedding BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used_at);
+"""
+
+
+def make_embedding_key(model: str, text: str, dimensions: Optional[int] = None) -> str:
+    """モデル・次元数・入力テキストからキャッシュキー（SHA-256）を作成"""
+    payload = json.dumps({"model": model, "dimensions": dimensions, "input": text}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    メモリ上のLRUとSQLiteの2段のembeddingキャッシュ
+
+    ヒット率はメモリ・ディスクの別に集計する（プロセス内の累計）。
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, memory_items: int = DEFAULT_MEMORY_ITEMS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = Path(path)
+        self.memory_items = memory_items
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        キャッシュされたembeddingを取得
+
+        Args:
+            key: キャッシュキー（make_embedding_key）
+
+        Returns:
+            float32のベクトル（無い場合はNone）
+        """
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return vector
+            row = self._conn.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+            self._conn.execute("UPDATE embeddings SET last_used_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self._counters["disk_hits"] += 1
+            return vector
+
+    def put(self, key: str, vector: np.ndarray, model: str):
+        """embeddingを保存し、上限を超えた分を最終利用が古い順に削除"""
+        vector = np.asarray(vector, dtype=np.float32)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, model, dimensions, embedding, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, int(vector.shape[0]), vector.tobytes(), now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+            self._remember(key, vector)
+
+    def clear(self):
+        """保存済みのembeddingとカウンターをすべて削除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._memory.clear()
+            self._counters = {field: 0 for field in self._counters}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        キャッシュの統計を取得
+
+        Returns:
+            件数・サイズ・メモリ/ディスクのヒット数・ミス数・ヒット率
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            counters = dict(self._counters)
+            memory_entries = len(self._memory)
+        try:
+            size_bytes = self.path.stat().st_size
+        except OSError:
+            size_bytes = 0
+        lookups = sum(counters.values())
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "memory_entries": memory_entries,
+            "memory_items": self.memory_items,
+            "size_bytes": size_bytes,
+            **counters,
+            "hit_rate": (counters["memory_hits"] + counters["disk_hits"]) / lookups if lookups else 0.0,
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """プロセス全体で共有されるembeddingキャッシュを取得（無効化されている場合はNone）"""
+    global _cache
+    if os.getenv("EMBEDDING_CACHE_ENABLED", "1") == "0":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(
+                    memory_items=int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", DEFAULT_MEMORY_ITEMS)),
+                    max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+                )
+    return _cache
+
+
+def cached_embeddings(
+    client,
+    texts: Sequence[str],
+    model: str,
+    dimensions: Optional[int] = None,
+    label: Optional[str] = None
+) -> List[np.ndarray]:
+    """
+    キャッシュを経由して複数のテキストをembedding
+
+    キャッシュに無いテキストだけを1回の embeddings リクエストにまとめて送る（同じテキストは1度だけ送る）。
+    キャッシュの有無にかかわらずfloat32のベクトルを返す（ヒット時とミス時で同じ値になるようにする）。
+
+    Args:
+        client: OpenAIクライアント
+        texts: 入力テキスト
+        model: embeddingモデル名
+        dimensions: 次元数（省略時はモデルの既定）
+        label: 計測に付けるラベル（例: "rag:query_embedding"）
+
+    Returns:
+        入力と同じ順のfloat32のベクトル
+    """
+    start = time.perf_counter()
+    cache = get_embedding_cache()
+    keys = [make_embedding_key(model, text, dimensions) for text in texts]
+    vectors: Dict[str, np.ndarray] = {}
+    if cache is not None:
+        for key, text in dict(zip(keys, texts)).items():
+            vector = cache.get(key)
+            if vector is not None:
+                vectors[key] = vector
+                # キャッシュヒットもコスト0の呼び出しとして計測に含める
+                record_call("embedding", model, (time.perf_counter() - start) * 1000,
+                            prompt_tokens=count_tokens(text), cached=True, label=label)
+
+    # キャッシュに無いテキスト（重複を除く）
+    missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+    if missing:
+        # dimensions は指定した場合のみ渡す
+        extra = {"dimensions": dimensions} if dimensions is not None else {}
+        with call_label(label):
+            response = client.embeddings.create(model=model, input=list(missing.values()), **extra)
+        missing_keys = list(missing)
+        for item in response.data:
+            key = missing_keys[item.index]
+            vectors[key] = np.asarray(item.embedding, dtype=np.float32)
+            if cache is not None:
+                cache.put(key, vectors[key], model)
+    return [vectors[key] for key in keys]
+
+
+def cached_embedding(
+    client,
+    text: str,
+    model: str,
+    dimensions: Optional[int] = None,
+    label: Optional[str] = None
+) -> np.ndarray:
+    """
+    キャッシュを経由して1つのテキストをembedding（cached_embeddings の1件版）
+
+    Args:
+        client: OpenAIクライアント
+        text: 入力テキスト
+        model: embeddingモデル名
+        dimensions: 次元数（省略時はモデルの既定）
+        label: 計測に付けるラベル（例: "rag:query_embedding"）
+
+    Returns:
+        float32のベクトル
+    """
+    return cached_embeddings(client, [text], model, dimensions, label)[0]
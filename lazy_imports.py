@@ -0,0 +1,106 @@
+"""
+重いライブラリの遅延インポートと起動時間レポート
+PyPDF2・pdfplumber・plotly・pinecone・openai 等は機能の初回利用時に読み込む
+
+使い方:
+    python lazy_imports.py            # app.py のインポート時間をモジュール別に表示
+    python lazy_imports.py --top 50   # 上位50件を表示
+"""
+
+import importlib
+import re
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import Dict, List
+
+# モジュール名 → 初回インポートにかかった時間（ms）
+_import_times: Dict[str, float] = {}
+_import_lock = threading.Lock()
+
+
+def lazy_import(module_name: str) -> ModuleType:
+    """
+    モジュールを初回利用時にインポートし、所要時間を記録
+
+    Args:
+        module_name: モジュール名（例: "plotly.express"）
+
+    Returns:
+        インポートされたモジュール
+    """
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+
+    with _import_lock:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        _import_times.setdefault(module_name, (time.perf_counter() - start) * 1000)
+    return module
+
+
+def get_lazy_import_report() -> List[Dict]:
+    """
+    遅延インポートされたモジュールと所要時間を取得
+
+    Returns:
+        [{"module": モジュール名, "import_ms": 所要時間}] （時間の降順）
+    """
+    return [
+        {"module": name, "import_ms": ms}
+        for name, ms in sorted(_import_times.items(), key=lambda item: item[1], reverse=True)
+    ]
+
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_startup_imports(script: str = "app") -> List[Dict]:
+    """
+    `python -X importtime` でスクリプトを別プロセスでインポートし、トップレベルパッケージ別に集計
+
+    Args:
+        script: インポートするモジュール名（既定: app）
+
+    Returns:
+        [{"module": パッケージ名, "self_ms": 自身の時間, "cumulative_ms": 累積時間}] （累積時間の降順）
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {script}"],
+        cwd=Path(__file__).resolve().parent,
+        capture_output=True,
+        text=True
+    )
+
+    packages: Dict[str, Dict] = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        top_level = name.split('.')[0]
+        entry = packages.setdefault(top_level, {"module": top_level, "self_ms": 0.0, "cumulative_ms": 0.0})
+        entry["self_ms"] += int(self_us) / 1000
+        # 累積時間はパッケージの最上位（最も浅い）インポートのみ採用
+        depth = len(indent) - 1
+        if name == top_level or depth == 0:
+            entry["cumulative_ms"] = max(entry["cumulative_ms"], int(cumulative_us) / 1000)
+
+    return sorted(packages.values(), key=lambda entry: entry["cumulative_ms"], reverse=True)
+
+
+if __name__ == "__main__":
+    top = 25
+    if "--top" in sys.argv:
+        top = int(sys.argv[sys.argv.index("--top") + 1])
+
+    report = measure_startup_imports("app")
+    total_ms = sum(entry["self_ms"] for entry in report)
+    print(f"app.py インポート時間（合計 {total_ms:.0f} ms）")
+    print(f"{'module':<32}{'cumulative (ms)':>18}{'self (ms)':>12}")
+    for entry in report[:top]:
+        print(f"{entry['module']:<32}{entry['cumulative_ms']:>18.1f}{entry['self_ms']:>12.1f}")
@@ -0,0 +1,293 @@
+"""
+GPT応答の永続キャッシュ
+モデル・メッセージ・temperature・max_tokens のハッシュをキーに、chat.completions の応答をSQLiteに保存する
+
+環境変数:
+    LLM_CACHE_ENABLED      0 でキャッシュを無効化（既定: 1）
+    LLM_CACHE_TTL_SECONDS  応答の有効期間（秒、既定: 7日）
+    LLM_CACHE_MAX_ENTRIES  保存する最大件数（超えた分は最終利用が古い順に削除、既定: 2000）
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from data_registry import BASE_DIR, get_registry
+from prompt_budget import count_tokens
+from telemetry import call_label, count_message_tokens, record_call
+
+CACHE_PATH = BASE_DIR / ".cache" / "llm_responses.sqlite3"
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 2000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    step TEXT,
+    data_version TEXT,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL,
+    hit_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used_at);
+"""
+
+
+def make_cache_key(
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[Dict[str, Any]] = None
+) -> str:
+    """モデル・メッセージ・パラメータからキャッシュキー（SHA-256）を作成"""
+    params = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+    # 応答形式を指定しない呼び出しは従来と同じキーになるようにする
+    if response_format is not None:
+        params["response_format"] = response_format
+    payload = json.dumps(params, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    SQLiteに保存するGPT応答キャッシュ
+
+    期限切れの応答は読み出し時に無視し、件数が上限を超えたら最終利用が古いものから削除する。
+    参照データのバージョンが変わった場合、旧バージョンで作った応答は破棄する。
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data_version: Optional[str] = None
+        # ステップ名 → {"hits": 件数, "misses": 件数}（プロセス内の累計）
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def _count(self, step: Optional[str], field: str):
+        counters = self._counters.setdefault(step or "other", {"hits": 0, "misses": 0})
+        counters[field] += 1
+
+    def sync_data_version(self, version: str) -> int:
+        """
+        参照データのバージョンを通知し、異なるバージョンで保存された応答を破棄
+
+        Args:
+            version: 現在の参照データのバージョン
+
+        Returns:
+            削除した件数
+        """
+        if version == self._data_version:
+            return 0
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM responses WHERE data_version IS NOT ?", (version,))
+            self._conn.commit()
+            self._data_version = version
+            return cursor.rowcount
+
+    def get(self, key: str, step: Optional[str] = None) -> Optional[str]:
+        """
+        キャッシュされた応答を取得
+
+        Args:
+            key: キャッシュキー
+            step: ヒット・ミスを集計するステップ名
+
+        Returns:
+            応答本文（無い・期限切れの場合はNone）
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content FROM responses WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self._count(step, "misses")
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_used_at = ?, hit_count = hit_count + 1 WHERE key = ?",
+                (now, key)
+            )
+            self._conn.commit()
+            self._count(step, "hits")
+            return row[0]
+
+    def put(self, key: str, content: str, model: str, step: Optional[str] = None):
+        """応答を保存し、上限を超えた分と期限切れの応答を削除"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, step, data_version, content, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, step, self._data_version, content, now, now)
+            )
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def clear(self):
+        """保存済みの応答とカウンターをすべて削除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._counters = {}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        キャッシュの統計を取得
+
+        Returns:
+            件数・サイズ・ステップ別のヒット/ミス数
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            steps = {step: dict(counts) for step, counts in self._counters.items()}
+        try:
+            size_bytes = self.path.stat().st_size
+        except OSError:
+            size_bytes = 0
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "size_bytes": size_bytes,
+            "data_version": self._data_version,
+            "hits": sum(c["hits"] for c in steps.values()),
+            "misses": sum(c["misses"] for c in steps.values()),
+            "steps": steps,
+        }
+
+
+def _is_json(content: str) -> bool:
+    """JSONモードの応答が完結しているか（max_tokens で途切れた応答は保存しない）"""
+    try:
+        json.loads(content)
+    except ValueError:
+        return False
+    return True
+
+
+_cache: Optional[LLMResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """プロセス全体で共有される応答キャッシュを取得（無効化されている場合はNone）"""
+    global _cache
+    if os.getenv("LLM_CACHE_ENABLED", "1") == "0":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMResponseCache(
+                    ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+                    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+                )
+    # 参照データが更新されていれば旧データで作った応答を破棄
+    _cache.sync_data_version(get_registry().version)
+    return _cache
+
+
+def cached_chat_completion(
+    client,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    step: Optional[str] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    response_format: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    キャッシュを経由して chat.completions を呼び出す
+
+    on_token を指定した場合はストリーミングで呼び出し、受信したトークンごとに通知する
+    （キャッシュヒット時は応答全体を1回で通知する）。
+
+    Args:
+        client: OpenAIクライアント
+        model: モデル名
+        messages: メッセージ
+        temperature: temperature
+        max_tokens: 最大トークン数
+        step: ヒット・ミスを集計するステップ名（例: "contract:step2b"）
+        on_token: ストリーミング時のコールバック
+        response_format: 応答形式（例: {"type": "json_object"}）。JSONモードの応答はJSONとして読めるものだけ保存する
+
+    Returns:
+        応答本文
+    """
+    start = time.perf_counter()
+    cache = get_llm_cache()
+    key = make_cache_key(model, messages, temperature, max_tokens, response_format)
+    # response_format は指定した場合のみ渡す
+    extra = {"response_format": response_format} if response_format is not None else {}
+    if cache is not None:
+        content = cache.get(key, step)
+        if content is not None:
+            if on_token is not None:
+                on_token(content)
+            # キャッシュヒットもコスト0の呼び出しとして計測に含める
+            record_call("chat", model, (time.perf_counter() - start) * 1000,
+                        prompt_tokens=count_message_tokens(messages), completion_tokens=count_tokens(content),
+                        cached=True, label=step)
+            return content
+
+    with call_label(step):
+        content = _create_completion(client, model, messages, temperature, max_tokens, on_token, extra)
+
+    if cache is not None and content and (response_format is None or _is_json(content)):
+        cache.put(key, content, model, step)
+    return content
+
+
+def _create_completion(client, model, messages, temperature, max_tokens, on_token, extra) -> str:
+    """chat.completions を呼び出して応答本文を返す（on_token 指定時はストリーミング）"""
+    if on_token is None:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **extra
+        )
+        content = response.choices[0].message.content or ""
+    else:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            **extra
+        )
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_token(delta)
+        content = ''.join(parts)
+    return content
@@ -0,0 +1,376 @@
+"""
+OpenAI・Pineconeのオフライン代替（記録と再生）
+実際のAPI呼び出しをカセット（JSONL）に記録し、記録した応答を指定したレイテンシ分布で再生する。
+APIキーやネットワークが無い環境でも分析パイプライン全体のレイテンシを計測できる。
+
+記録に無いリクエストは決定的な合成応答で代替する（chat: 文章またはJSONオブジェクト、
+embedding: 入力から決まる単位ベクトル、Pinecone: 同じnamespaceの記録済み結果）。
+
+環境変数:
+    LLM_REPLAY_CASSETTE         設定するとアプリのOpenAI・Pinecone呼び出しをこのカセットの再生に置き換える
+    LLM_REPLAY_SPEEDUP          再生速度の倍率（既定: 1）
+    LLM_REPLAY_RECORDED_LATENCY 1 で記録時の実測レイテンシで再生（既定: 分布から生成）
+
+使い方:
+    LLM_REPLAY_CASSETTE=benchmarks/cassettes/sample.jsonl streamlit run app.py       # アプリをオフラインで再生
+    python benchmarks/bench_pipelines.py --record benchmarks/cassettes/sample.jsonl  # 実APIで記録
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from llm_cache import make_cache_key
+from prompt_budget import count_tokens
+
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+
+# 合成応答の長さ（max_tokens に対する割合。max_tokens の指定が無い場合はトークン数の既定値）
+SYNTHETIC_RESPONSE_RATIO = 0.6
+SYNTHETIC_RESPONSE_TOKENS = 300
+
+# ストリーミング再生時に1チャンクへまとめるトークン数
+TOKENS_PER_CHUNK = 4
+
+
+@dataclass
+class LatencyModel:
+    """
+    再生時のレイテンシ分布
+
+    最初のトークンまでの時間は中央値 first_token_ms・対数標準偏差 sigma の対数正規分布、
+    以降は tokens_per_second の速度で出力する。speedup で全体を縮める（10 なら10倍速）。
+    use_recorded が真の場合、記録済みの応答は記録時の実測値で再生する。
+    """
+    first_token_ms: float = 600.0
+    sigma: float = 0.35
+    tokens_per_second: float = 50.0
+    embedding_ms: float = 150.0
+    vector_query_ms: float = 80.0
+    speedup: float = 1.0
+    use_recorded: bool = False
+    seed: Optional[int] = 0
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    def sample_ms(self, median_ms: float) -> float:
+        """中央値 median_ms の対数正規分布から待ち時間（ms）を取得"""
+        with self._lock:
+            return median_ms * self._random.lognormvariate(0.0, self.sigma)
+
+    def sleep_ms(self, ms: float):
+        if ms > 0:
+            time.sleep(ms / 1000 / self.speedup)
+
+
+def _hash(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def chat_key(kwargs: Dict[str, Any]) -> str:
+    """chat.completions.create の引数から記録のキーを作成（応答キャッシュと同じ構成）"""
+    return make_cache_key(
+        kwargs.get("model"),
+        kwargs.get("messages"),
+        kwargs.get("temperature"),
+        kwargs.get("max_tokens"),
+        kwargs.get("response_format")
+    )
+
+
+def embedding_key(kwargs: Dict[str, Any]) -> str:
+    """embeddings.create の引数から記録のキーを作成"""
+    return _hash({"model": kwargs.get("model"), "input": kwargs.get("input"), "dimensions": kwargs.get("dimensions")})
+
+
+def vector_query_key(namespace: Optional[str], top_k: int, vector: Sequence[float]) -> str:
+    """Pineconeのクエリから記録のキーを作成（ベクトルは丸めて比較する）"""
+    return _hash({"namespace": namespace, "top_k": top_k, "vector": [round(float(v), 5) for v in vector]})
+
+
+class Cassette:
+    """
+    記録した応答のJSONLファイル
+
+    1行が1件の記録: {"kind": "chat" | "embedding" | "vector_query", "key", "response", "first_token_ms", "elapsed_ms"}
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path) if path else None
+        self._records: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        if self.path is not None and self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records.setdefault(record["kind"], {})[record["key"]] = record
+
+    def get(self, kind: str, key: str) -> Optional[Dict[str, Any]]:
+        return self._records.get(kind, {}).get(key)
+
+    def latest(self, kind: str, predicate=lambda record: True) -> Optional[Dict[str, Any]]:
+        """条件に合う最後の記録を取得"""
+        for record in reversed(self.records(kind)):
+            if predicate(record):
+                return record
+        return None
+
+    def records(self, kind: str) -> List[Dict[str, Any]]:
+        """種類ごとの記録（記録した順）"""
+        return list(self._records.get(kind, {}).values())
+
+    def add(self, kind: str, key: str, response: Any, elapsed_ms: float, first_token_ms: Optional[float] = None, **extra):
+        """記録を追加し、ファイルがあれば追記"""
+        record = {"kind": kind, "key": key, "response": response, "elapsed_ms": elapsed_ms, "first_token_ms": first_token_ms, **extra}
+        with self._lock:
+            self._records.setdefault(kind, {})[key] = record
+            if self.path is not None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def __len__(self) -> int:
+        return sum(len(records) for records in self._records.values())
+
+
+def _synthetic_text(kwargs: Dict[str, Any]) -> str:
+    """記録に無いchatリクエストの決定的な合成応答"""
+    max_tokens = kwargs.get("max_tokens")
+    tokens = int(max_tokens * SYNTHETIC_RESPONSE_RATIO) if max_tokens else SYNTHETIC_RESPONSE_TOKENS
+    seed = chat_key(kwargs)[:8]
+    sentence = f"Synthetic replay response {seed}: analysis text standing in for a recorded answer. "
+    # 概ね tokens トークンになるまで繰り返す
+    text = (sentence * max(1, tokens // max(count_tokens(sentence), 1))).strip()
+    if (kwargs.get("response_format") or {}).get("type") == "json_object":
+        return json.dumps({"synthetic": text})
+    return text
+
+
+def _synthetic_embedding(kwargs: Dict[str, Any]) -> List[float]:
+    """入力から決まる単位ベクトル（同じ入力には同じベクトルを返す）"""
+    dimensions = kwargs.get("dimensions") or DEFAULT_EMBEDDING_DIMENSIONS
+    seed = int(embedding_key(kwargs)[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+
+def _split_chunks(content: str) -> List[str]:
+    """ストリーミング再生用に応答をおおよそ TOKENS_PER_CHUNK トークンずつに分割"""
+    size = TOKENS_PER_CHUNK * 4
+    return [content[i:i + size] for i in range(0, len(content), size)] or [""]
+
+
+def _chat_response(content: str, prompt_tokens: int) -> SimpleNamespace:
+    completion_tokens = count_tokens(content)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason="stop")],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                              total_tokens=prompt_tokens + completion_tokens)
+    )
+
+
+def _chat_chunk(delta: str) -> SimpleNamespace:
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta), finish_reason=None)])
+
+
+def _prompt_tokens(messages: Sequence[Dict[str, str]]) -> int:
+    return sum(count_tokens(message.get("content") or "") for message in messages or [])
+
+
+class ReplayOpenAI:
+    """
+    記録済みの応答を再生するOpenAIクライアントの代替
+
+    chat.completions.create（ストリーミング含む）と embeddings.create のみ提供する。
+    calls に呼び出しごとの {"kind", "replayed", "latency_ms"} を記録する。
+    """
+
+    def __init__(self, cassette: Cassette, latency: Optional[LatencyModel] = None):
+        self.cassette = cassette
+        self.latency = latency or LatencyModel()
+        self.calls: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+        self.embeddings = SimpleNamespace(create=self._create_embedding)
+
+    def _log(self, kind: str, replayed: bool, latency_ms: float):
+        with self._lock:
+            self.calls.append({"kind": kind, "replayed": replayed, "latency_ms": latency_ms})
+
+    def _create_chat(self, **kwargs):
+        record = self.cassette.get("chat", chat_key(kwargs))
+        content = record["response"] if record else _synthetic_text(kwargs)
+        if record and self.latency.use_recorded:
+            first_token_ms = record.get("first_token_ms") or record["elapsed_ms"]
+            total_ms = record["elapsed_ms"]
+        else:
+            first_token_ms = self.latency.sample_ms(self.latency.first_token_ms)
+            total_ms = first_token_ms + count_tokens(content) / self.latency.tokens_per_second * 1000
+        self._log("chat", record is not None, total_ms)
+
+        if kwargs.get("stream"):
+            return self._stream(content, first_token_ms, total_ms)
+        self.latency.sleep_ms(total_ms)
+        return _chat_response(content, _prompt_tokens(kwargs.get("messages")))
+
+    def _stream(self, content: str, first_token_ms: float, total_ms: float) -> Iterator[SimpleNamespace]:
+        chunks = _split_chunks(content)
+        self.latency.sleep_ms(first_token_ms)
+        interval_ms = (total_ms - first_token_ms) / len(chunks)
+        for i, chunk in enumerate(chunks):
+            if i:
+                self.latency.sleep_ms(interval_ms)
+            yield _chat_chunk(chunk)
+
+    def _create_embedding(self, **kwargs):
+        # 複数の入力は1回のリクエストとして再生する（記録は入力ごと）
+        inputs = [kwargs.get("input")] if isinstance(kwargs.get("input"), str) else list(kwargs.get("input") or [])
+        records = [self.cassette.get("embedding", embedding_key({**kwargs, "input": text})) for text in inputs]
+        vectors = [
+            record["response"] if record else _synthetic_embedding({**kwargs, "input": text})
+            for text, record in zip(inputs, records)
+        ]
+        replayed = all(record is not None for record in records)
+        if replayed and self.latency.use_recorded:
+            latency_ms = max(record["elapsed_ms"] for record in records)
+        else:
+            latency_ms = self.latency.sample_ms(self.latency.embedding_ms)
+        self._log("embedding", replayed, latency_ms)
+        self.latency.sleep_ms(latency_ms)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=vector, index=i) for i, vector in enumerate(vectors)])
+
+
+class ReplayVectorIndex:
+    """
+    記録済みの検索結果を再生するPineconeインデックスの代替（query のみ）
+
+    記録に無いクエリには同じnamespaceの最後の記録を返す（記録が無ければ空の結果）。
+    """
+
+    def __init__(self, cassette: Cassette, latency: Optional[LatencyModel] = None, calls: Optional[List[Dict[str, Any]]] = None):
+        self.cassette = cassette
+        self.latency = latency or LatencyModel()
+        self.calls = calls if calls is not None else []
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = False, namespace: Optional[str] = None, **kwargs):
+        record = self.cassette.get("vector_query", vector_query_key(namespace, top_k, vector))
+        replayed = record is not None
+        if record is None:
+            record = self.cassette.latest("vector_query", lambda r: r.get("namespace") == namespace)
+        matches = record["response"] if record else []
+        latency_ms = record["elapsed_ms"] if replayed and self.latency.use_recorded else self.latency.sample_ms(self.latency.vector_query_ms)
+        self.calls.append({"kind": "vector_query", "replayed": replayed, "latency_ms": latency_ms})
+        self.latency.sleep_ms(latency_ms)
+        return SimpleNamespace(matches=[
+            SimpleNamespace(id=match["id"], score=match["score"], metadata=match.get("metadata") if include_metadata else None)
+            for match in matches[:top_k]
+        ])
+
+    def describe_index_stats(self, **kwargs):
+        """記録済みの検索結果に含まれるベクトル数（namespaceごと）"""
+        ids: Dict[Optional[str], set] = {}
+        for record in self.cassette.records("vector_query"):
+            ids.setdefault(record.get("namespace"), set()).update(match["id"] for match in record["response"])
+        return SimpleNamespace(
+            dimension=None,
+            total_vector_count=sum(len(namespace_ids) for namespace_ids in ids.values()),
+            namespaces={namespace: SimpleNamespace(vector_count=len(namespace_ids)) for namespace, namespace_ids in ids.items()},
+        )
+
+
+_env_cassette: Optional[Cassette] = None
+_env_lock = threading.Lock()
+
+
+def get_env_cassette() -> Optional[Cassette]:
+    """LLM_REPLAY_CASSETTE で指定されたカセットを取得（未設定の場合はNone）"""
+    global _env_cassette
+    path = os.getenv("LLM_REPLAY_CASSETTE")
+    if not path:
+        return None
+    if _env_cassette is None:
+        with _env_lock:
+            if _env_cassette is None:
+                _env_cassette = Cassette(Path(path))
+    return _env_cassette
+
+
+def env_latency_model() -> LatencyModel:
+    """環境変数の設定で再生時のレイテンシ分布を作成"""
+    return LatencyModel(
+        speedup=float(os.getenv("LLM_REPLAY_SPEEDUP", 1)),
+        use_recorded=os.getenv("LLM_REPLAY_RECORDED_LATENCY", "0") == "1"
+    )
+
+
+class RecordingOpenAI:
+    """実際のOpenAIクライアントの応答と所要時間をカセットに記録するラッパー"""
+
+    def __init__(self, client, cassette: Cassette):
+        self.client = client
+        self.cassette = cassette
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+        self.embeddings = SimpleNamespace(create=self._create_embedding)
+
+    def _create_chat(self, **kwargs):
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(kwargs, response, start)
+        content = response.choices[0].message.content or ""
+        self.cassette.add("chat", chat_key(kwargs), content, (time.perf_counter() - start) * 1000)
+        return response
+
+    def _record_stream(self, kwargs: Dict[str, Any], stream, start: float) -> Iterator[Any]:
+        parts = []
+        first_token_ms = None
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        self.cassette.add("chat", chat_key(kwargs), ''.join(parts), (time.perf_counter() - start) * 1000, first_token_ms)
+
+    def _create_embedding(self, **kwargs):
+        start = time.perf_counter()
+        response = self.client.embeddings.create(**kwargs)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        inputs = [kwargs.get("input")] if isinstance(kwargs.get("input"), str) else list(kwargs.get("input") or [])
+        for item in sorted(response.data, key=lambda item: item.index):
+            self.cassette.add("embedding", embedding_key({**kwargs, "input": inputs[item.index]}), list(item.embedding), elapsed_ms)
+        return response
+
+
+class RecordingVectorIndex:
+    """実際のPineconeインデックスの検索結果と所要時間をカセットに記録するラッパー"""
+
+    def __init__(self, index, cassette: Cassette):
+        self.index = index
+        self.cassette = cassette
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = False, namespace: Optional[str] = None, **kwargs):
+        start = time.perf_counter()
+        results = self.index.query(vector=vector, top_k=top_k, include_metadata=include_metadata, namespace=namespace, **kwargs)
+        matches = [
+            {"id": match.id, "score": float(match.score), "metadata": dict(match.metadata or {})}
+            for match in results.matches
+        ]
+        self.cassette.add("vector_query", vector_query_key(namespace, top_k, vector), matches,
+                          (time.perf_counter() - start) * 1000, namespace=namespace)
+        return results
+
+    def describe_index_stats(self, **kwargs):
+        return self.index.describe_index_stats(**kwargs)
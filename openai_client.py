@@ -0,0 +1,336 @@
+"""
+プロセス全体で共有するOpenAIクライアント
+HTTP接続プール・タイムアウト・429/5xx時のジッター付き指数バックオフ・同時リクエスト数の上限をまとめて適用し、
+呼び出しごとの所要時間・待ち時間・トークン数を telemetry に記録する
+
+環境変数:
+    OPENAI_TIMEOUT_SECONDS          リクエストのタイムアウト（秒、既定: 60）
+    OPENAI_CONNECT_TIMEOUT_SECONDS  接続のタイムアウト（秒、既定: 10）
+    OPENAI_MAX_RETRIES              再試行の最大回数（既定: 4）
+    OPENAI_MAX_CONCURRENCY          プロセス全体の同時リクエスト数の上限（既定: 8）
+    OPENAI_MAX_CONNECTIONS          接続プールの最大接続数（既定: 20）
+    LLM_REPLAY_CASSETTE             記録済みの応答を再生する（llm_replay を参照）
+"""
+
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from lazy_imports import lazy_import
+from llm_replay import ReplayOpenAI, env_latency_model, get_env_cassette
+from prompt_budget import count_tokens
+from telemetry import count_message_tokens, record_call
+
+DEFAULT_TIMEOUT_SECONDS = 60.0
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10.0
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_CONNECTIONS = 20
+
+# バックオフの初期値・上限（秒）。待ち時間は 0〜min(上限, 初期値×2^試行回数) の一様乱数（フルジッター）
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+
+# 再試行するHTTPステータス（タイムアウト・競合・レート制限・サーバーエラー）
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """レート制限応答の Retry-After ヘッダー（秒）を取得"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """再試行すべきエラーか（接続エラー・タイムアウト・429・5xx）"""
+    openai = lazy_import("openai")
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+class _HeldStream:
+    """
+    ストリーミング応答を読み終える（または破棄される）まで同時実行数の枠を保持するイテレーター
+
+    受信した本文と最初のトークンの時刻を集め、終了時に on_close(本文, 最初のトークンの時刻) を呼ぶ。
+    """
+
+    def __init__(self, stream, release: Callable[[], None], on_close: Optional[Callable[[str, Optional[float]], None]] = None):
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._release = release
+        self._on_close = on_close
+        self._released = False
+        self._parts = []
+        self._first_token_at: Optional[float] = None
+
+    def __iter__(self) -> Iterator[Any]:
+        return self
+
+    def __next__(self) -> Any:
+        try:
+            chunk = next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+        choices = getattr(chunk, "choices", None)
+        delta = choices[0].delta.content if choices else None
+        if delta:
+            if self._first_token_at is None:
+                self._first_token_at = time.perf_counter()
+            self._parts.append(delta)
+        return chunk
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        close = getattr(self._stream, "close", None)
+        if close is not None:
+            close()
+        self._release()
+        if self._on_close is not None:
+            self._on_close(''.join(self._parts), self._first_token_at)
+
+    def __del__(self):
+        self.close()
+
+
+class PooledOpenAIClient:
+    """
+    OpenAIクライアントのラッパー
+
+    chat.completions.create・embeddings.create を同じインターフェースで提供し、
+    呼び出しごとに同時実行数の枠を確保して、再試行可能なエラーはバックオフして再試行する。
+    ストリーミング応答は最後のチャンクを受信するまで枠を保持する。
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_base: float = BACKOFF_BASE_SECONDS,
+        backoff_max: float = BACKOFF_MAX_SECONDS,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._counters = {"requests": 0, "retries": 0, "failures": 0}
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=lambda **kwargs: self.request(client.chat.completions.create, kind="chat", **kwargs)
+        ))
+        self.embeddings = SimpleNamespace(
+            create=lambda **kwargs: self.request(client.embeddings.create, kind="embedding", **kwargs)
+        )
+
+    def _count(self, field: str, delta: int = 1):
+        with self._lock:
+            self._counters[field] += delta
+
+    def _acquire(self) -> float:
+        """枠を確保し、待った時間（ms）を返す"""
+        start = time.perf_counter()
+        self._semaphore.acquire()
+        with self._lock:
+            self._in_flight += 1
+        return (time.perf_counter() - start) * 1000
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._semaphore.release()
+
+    def backoff_seconds(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """attempt 回目の再試行前の待ち時間（Retry-After があればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = _retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def request(self, create: Callable[..., Any], kind: str = "chat", **kwargs) -> Any:
+        """
+        同時実行数の枠を確保してAPIを呼び出し、再試行可能なエラーはバックオフして再試行
+
+        待機中は枠を解放するため、バックオフ中のリクエストが他の呼び出しを妨げない。
+        完了時（ストリーミングは読み終えた時）に所要時間・待ち時間・トークン数を telemetry に記録する。
+
+        Args:
+            create: 呼び出すSDKのメソッド（例: client.chat.completions.create）
+            kind: 計測上の種類（"chat" / "embedding"）
+            **kwargs: メソッドの引数（stream=True の場合はチャンクのイテレーターを返す）
+
+        Returns:
+            SDKの応答
+        """
+        self._count("requests")
+        start = time.perf_counter()
+        queue_ms = 0.0
+        attempt = 0
+        while True:
+            queue_ms += self._acquire()
+            try:
+                response = create(**kwargs)
+            except Exception as e:
+                self._release()
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self._count("failures")
+                    self._record(kind, kwargs, start, queue_ms, attempt, error=e)
+                    raise
+                self._count("retries")
+                self._sleep(self.backoff_seconds(attempt, e))
+                attempt += 1
+                continue
+            if kwargs.get("stream"):
+                return _HeldStream(
+                    response,
+                    self._release,
+                    lambda content, first_token_at: self._record(
+                        kind, kwargs, start, queue_ms, attempt, content=content, first_token_at=first_token_at
+                    )
+                )
+            self._release()
+            self._record(kind, kwargs, start, queue_ms, attempt, response=response)
+            return response
+
+    def _record(
+        self,
+        kind: str,
+        kwargs: Dict[str, Any],
+        start: float,
+        queue_ms: float,
+        retries: int,
+        response: Any = None,
+        content: Optional[str] = None,
+        first_token_at: Optional[float] = None,
+        error: Optional[Exception] = None
+    ):
+        """呼び出しの計測結果を記録（トークン数は応答の usage、無ければ tiktoken で数える）"""
+        usage = getattr(response, "usage", None)
+        if kind == "embedding":
+            input_text = kwargs.get("input")
+            prompt_tokens = getattr(usage, "prompt_tokens", None) or sum(
+                count_tokens(text) for text in ([input_text] if isinstance(input_text, str) else input_text or [])
+            )
+            completion_tokens = 0
+        else:
+            prompt_tokens = getattr(usage, "prompt_tokens", None) or count_message_tokens(kwargs.get("messages"))
+            if content is None and response is not None:
+                content = response.choices[0].message.content or ""
+            completion_tokens = getattr(usage, "completion_tokens", None) or count_tokens(content or "")
+        record_call(
+            kind,
+            kwargs.get("model"),
+            (time.perf_counter() - start) * 1000,
+            queue_ms=queue_ms,
+            first_token_ms=(first_token_at - start) * 1000 if first_token_at is not None else None,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            retries=retries,
+            error=str(error) if error is not None else None
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """リクエスト数・再試行数・失敗数・実行中のリクエスト数を取得"""
+        with self._lock:
+            return {**self._counters, "in_flight": self._in_flight, "max_concurrency": self.max_concurrency}
+
+
+_client: Optional[PooledOpenAIClient] = None
+_client_lock = threading.Lock()
+
+
+def create_openai_client() -> PooledOpenAIClient:
+    """環境変数の設定で接続プール付きのクライアントを作成（openai・httpxはここで読み込む）"""
+    # 再生用のカセットが指定されていればAPIの代わりに記録済みの応答を返す
+    cassette = get_env_cassette()
+    if cassette is not None:
+        backend = ReplayOpenAI(cassette, env_latency_model())
+        return PooledOpenAIClient(backend, max_concurrency=_env_int("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+
+    openai = lazy_import("openai")
+    httpx = lazy_import("httpx")
+    max_connections = _env_int("OPENAI_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)
+    http_client = httpx.Client(
+        timeout=httpx.Timeout(
+            _env_float("OPENAI_TIMEOUT_SECONDS", DEFAULT_TIMEOUT_SECONDS),
+            connect=_env_float("OPENAI_CONNECT_TIMEOUT_SECONDS", DEFAULT_CONNECT_TIMEOUT_SECONDS)
+        ),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    )
+    # SDK自身の再試行は無効にし、再試行はラッパーで一元管理する
+    client = openai.OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=http_client,
+        timeout=http_client.timeout,
+        max_retries=0
+    )
+    return PooledOpenAIClient(
+        client,
+        max_concurrency=_env_int("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY),
+        max_retries=_env_int("OPENAI_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+    )
+
+
+def use_openai_backend(backend) -> PooledOpenAIClient:
+    """
+    SDK互換のバックエンド（記録・再生用の代替等）を共有クライアントとして設定
+
+    Args:
+        backend: chat.completions.create・embeddings.create を持つオブジェクト
+
+    Returns:
+        設定した共有クライアント
+    """
+    global _client
+    with _client_lock:
+        _client = PooledOpenAIClient(
+            backend,
+            max_concurrency=_env_int("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY),
+            max_retries=_env_int("OPENAI_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+        )
+    return _client
+
+
+def get_openai_client_stats() -> Optional[Dict[str, int]]:
+    """共有クライアントの統計を取得（まだ作成されていない場合はNone）"""
+    return _client.stats() if _client is not None else None
+
+
+def get_openai_client() -> PooledOpenAIClient:
+    """プロセス全体（全Streamlitセッション）で共有されるOpenAIクライアントを取得"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_openai_client()
+    return _client
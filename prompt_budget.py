@@ -0,0 +1,213 @@
+"""
+プロンプトのトークン予算管理
+文字数の切り詰めではなくトークン数で各セグメントに予算を割り当て、優先度の高い内容から詰める
+
+tiktoken のエンコーディングを読み込めない環境（オフライン等）では、文字種別の概算でトークン数を数える。
+"""
+
+import re
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from lazy_imports import lazy_import
+
+DEFAULT_MODEL = "gpt-4-turbo-preview"
+FALLBACK_ENCODING = "cl100k_base"
+
+# 概算時の1トークンあたりの文字数（英数字）。日本語等は1文字1トークンとして数える
+ASCII_CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_name: Optional[str] = None
+_encoding_lock = threading.Lock()
+
+_BLOCK_SEPARATOR = re.compile(r"\n{2,}")
+
+
+def _get_encoding():
+    """tiktoken のエンコーディングを取得（初回のみ読み込み。失敗した場合はNone）"""
+    global _encoding, _encoding_name
+    if _encoding_name is None:
+        with _encoding_lock:
+            if _encoding_name is None:
+                try:
+                    tiktoken = lazy_import("tiktoken")
+                    try:
+                        _encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
+                    except KeyError:
+                        _encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+                    _encoding_name = f"tiktoken:{_encoding.name}"
+                except Exception as e:
+                    print(f"tiktoken のエンコーディングを読み込めません（概算で数えます）: {str(e)}")
+                    _encoding = None
+                    _encoding_name = "estimate"
+    return _encoding
+
+
+def tokenizer_name() -> str:
+    """トークン数の計算方法（"tiktoken:cl100k_base" または "estimate"）"""
+    _get_encoding()
+    return _encoding_name
+
+
+def _estimate_tokens(text: str) -> int:
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return -(-ascii_chars // ASCII_CHARS_PER_TOKEN) + (len(text) - ascii_chars)
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """
+    テキストのトークン数を取得
+
+    Args:
+        text: テキスト
+
+    Returns:
+        トークン数
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    テキストを先頭から指定トークン数以内に切り詰める
+
+    Args:
+        text: テキスト
+        max_tokens: 最大トークン数
+
+    Returns:
+        切り詰めたテキスト
+    """
+    if max_tokens <= 0 or not text:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        # 途中で切れたマルチバイト文字は除去される
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]).rstrip('\ufffd')
+
+    # 概算時は二分探索で収まる最長の接頭辞を求める
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def split_blocks(text: str) -> List[str]:
+    """空行区切りのブロック（段落・国ごとの行等）に分割（連結すると元のテキストに戻る）"""
+    if not text:
+        return []
+    blocks = []
+    start = 0
+    for match in _BLOCK_SEPARATOR.finditer(text):
+        blocks.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        blocks.append(text[start:])
+    return blocks
+
+
+@dataclass
+class PromptSegment:
+    """
+    プロンプトに埋め込む内容
+
+    chunks は価値の高い順に並べ、予算内に収まる分だけ先頭から採用する
+    （収まらなかった最初のチャンクは予算の残りまで切り詰めて含める）。
+    """
+    name: str
+    chunks: Sequence[str]
+    priority: int = 0
+    max_tokens: Optional[int] = None
+
+    @classmethod
+    def text(cls, name: str, text: str, priority: int = 0, max_tokens: Optional[int] = None) -> "PromptSegment":
+        """1つのテキストからセグメントを作成（先頭から切り詰める）"""
+        return cls(name, [text] if text else [], priority, max_tokens)
+
+    @classmethod
+    def blocks(cls, name: str, text: str, priority: int = 0, max_tokens: Optional[int] = None) -> "PromptSegment":
+        """空行区切りのブロック単位で詰めるセグメントを作成"""
+        return cls(name, split_blocks(text), priority, max_tokens)
+
+
+def _fill_chunks(chunks: Sequence[str], allowed: int) -> Tuple[str, int, bool]:
+    """チャンクを先頭から予算内で連結（戻り値: テキスト, 使用トークン数, 切り詰めたか）"""
+    parts = []
+    used = 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if used + tokens <= allowed:
+            parts.append(chunk)
+            used += tokens
+            continue
+        partial = truncate_to_tokens(chunk, allowed - used)
+        if partial:
+            parts.append(partial)
+            used += count_tokens(partial)
+        return ''.join(parts), used, True
+    return ''.join(parts), used, False
+
+
+def fit_prompt(template: str, segments: Sequence[PromptSegment], budget: int) -> Tuple[str, Dict]:
+    """
+    テンプレートの {セグメント名} をトークン予算内に収めた内容で置き換える
+
+    テンプレートの固定部分のトークン数を差し引いた残りを、優先度の高いセグメントから順に割り当てる。
+
+    Args:
+        template: "{contract}" のようなプレースホルダーを含むプロンプト
+        segments: 埋め込むセグメント
+        budget: プロンプト全体のトークン予算
+
+    Returns:
+        (プロンプト, 使用量レポート)
+        レポート: {"budget", "prompt_tokens", "fixed_tokens", "tokenizer",
+                   "segments": {名前: {"used", "available", "truncated"}}}
+    """
+    fixed = template
+    for segment in segments:
+        fixed = fixed.replace("{" + segment.name + "}", "")
+    fixed_tokens = count_tokens(fixed)
+    remaining = max(budget - fixed_tokens, 0)
+
+    filled: Dict[str, str] = {}
+    report_segments: Dict[str, Dict] = {}
+    for segment in sorted(segments, key=lambda s: -s.priority):
+        allowed = remaining if segment.max_tokens is None else min(remaining, segment.max_tokens)
+        text, used, truncated = _fill_chunks(segment.chunks, allowed)
+        remaining -= used
+        filled[segment.name] = text
+        report_segments[segment.name] = {
+            "used": used,
+            "available": sum(count_tokens(chunk) for chunk in segment.chunks),
+            "truncated": truncated,
+        }
+
+    # 一度の置換で埋め込む（埋め込んだ内容に含まれる "{名前}" は置換しない）
+    placeholder = re.compile("|".join(re.escape("{" + segment.name + "}") for segment in segments)) if segments else None
+    prompt = placeholder.sub(lambda m: filled[m.group(0)[1:-1]], template) if placeholder else template
+
+    report = {
+        "budget": budget,
+        "prompt_tokens": count_tokens(prompt),
+        "fixed_tokens": fixed_tokens,
+        "tokenizer": tokenizer_name(),
+        "segments": {segment.name: report_segments[segment.name] for segment in segments},
+    }
+    return prompt, report
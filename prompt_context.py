@@ -0,0 +1,336 @@
+"""
+GPTプロンプト用の参照データコンテキスト
+ECCNデータベース・カントリーチャート・規制テキストを参照データのバージョンごとに一度だけ組み立てて再利用する
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from country_index import CountryChartIndex, get_country_chart_index, resolve_countries
+from data_registry import get_registry
+from eccn_index import get_eccn_search_index
+from regulations import RegulationSearchIndex, chunk_regulation_text, rank_regulation_chunks
+
+ECCN_CONTEXT_HEADER = "[ECCN Number Database (Complete)]\n"
+COUNTRY_CHART_CONTEXT_HEADER = (
+    "\n[Country Chart (Complete)]\n"
+    "Below is actual US EAR Country Chart data. 'X' indicates license required.\n\n"
+)
+
+DESTINATION_CHART_CONTEXT_HEADER = (
+    "\n[Country Chart (Destination)]\n"
+    "Below is actual US EAR Country Chart data for the destination. 'X' indicates license required; "
+    "reasons for control not listed are not marked for this country.\n\n"
+)
+
+REGULATION_CONTEXT_HEADER = (
+    "[EAR Part 736 – General Prohibitions (excerpts)]\n"
+    "Below are excerpts from the regulation text. Cite the paragraph (e.g. § 736.2(b)(5)) for each determination.\n\n"
+)
+
+# General Prohibitionsの分析で必ず含める項（GP4〜GP8）
+GP_CHECK_CITATIONS = tuple(f"§ 736.2(b)({number})" for number in range(4, 9))
+
+# 1プロダクトグループあたりの最大アイテム数・説明の最大文字数（トークン制限を考慮）
+MAX_ITEMS_PER_GROUP = 10
+MAX_DESCRIPTION_CHARS = 200
+
+CATEGORY_DIGIT = re.compile(r"\d")
+
+# 関連度順に並べる際に検索するクエリの最大文字数・採用する検索結果の件数
+RANKING_QUERY_CHARS = 1000
+RANKING_TOP_K = 50
+
+# 契約書分析・チャット分析で使うカントリーチャートの主要な規制理由列
+CONTRACT_CHART_COLUMNS = ('NS 1', 'NS 2', 'MT 1', 'NP 1', 'NP 2', 'CB 1', 'AT 1')
+CHAT_CHART_COLUMNS = ('NS 1', 'NS 2', 'MT 1', 'NP 1', 'NP 2', 'CB 1', 'CB 2', 'AT 1', 'AT 2')
+
+
+def build_eccn_context(eccn_json: Optional[Dict], category: Optional[str] = None) -> str:
+    """
+    ECCN JSONからプロンプト用のデータベーステキストを組み立てる
+
+    Args:
+        eccn_json: ECCN JSONデータ
+        category: カテゴリー番号（例: "3"）。指定時はそのカテゴリーのみ（"5" は Part 1・Part 2 の両方）
+
+    Returns:
+        ECCNデータベースのテキスト（データが無い場合は空文字列）
+    """
+    if not eccn_json or 'ccl_categories' not in eccn_json:
+        return ""
+
+    parts = [ECCN_CONTEXT_HEADER]
+    for cat in eccn_json['ccl_categories']:
+        if category is not None and _category_digit(str(cat.get('category_number', ''))) != category:
+            continue
+        parts.append(f"\n## Category {cat.get('category_number', '')}: {cat.get('title', '')}\n")
+        for group in cat.get('product_groups', []):
+            parts.append(f"\n### {group.get('group_title', '')}\n")
+            for item in group.get('items', [])[:MAX_ITEMS_PER_GROUP]:
+                parts.append(f"- **{item.get('eccn', '')}**: {item.get('description', '')[:MAX_DESCRIPTION_CHARS]}...\n")
+    return ''.join(parts)
+
+
+def build_eccn_context_chunks(eccn_json: Optional[Dict]) -> Tuple[List[str], Dict[Tuple[str, str], int]]:
+    """
+    ECCNデータベースのテキストをプロダクトグループ単位のチャンクに分割して組み立てる
+
+    各チャンクはカテゴリー見出しを含み、単独でプロンプトに埋め込める。
+
+    Returns:
+        (チャンクのリスト, (カテゴリー番号, グループ名) → チャンク番号)
+    """
+    chunks: List[str] = []
+    positions: Dict[Tuple[str, str], int] = {}
+    if not eccn_json or 'ccl_categories' not in eccn_json:
+        return chunks, positions
+
+    for cat in eccn_json['ccl_categories']:
+        for group in cat.get('product_groups', []):
+            lines = [f"\n## Category {cat.get('category_number', '')}: {cat.get('title', '')}\n### {group.get('group_title', '')}\n"]
+            for item in group.get('items', [])[:MAX_ITEMS_PER_GROUP]:
+                lines.append(f"- **{item.get('eccn', '')}**: {item.get('description', '')[:MAX_DESCRIPTION_CHARS]}...\n")
+            positions.setdefault((cat.get('category_number', ''), group.get('group_title', '')), len(chunks))
+            chunks.append(''.join(lines))
+    return chunks, positions
+
+
+def get_ranked_eccn_chunks(query: str, eccn_json: Optional[Dict] = None) -> List[str]:
+    """
+    ECCNデータベースのチャンクを、クエリ（品目・契約書）との関連度が高いグループから順に取得
+
+    BM25検索で一致したECCNを含むプロダクトグループを先頭に、残りを元の順序で並べる。
+    トークン予算内で先頭から詰めると、関連するグループが優先して残る。
+
+    Args:
+        query: 品目名・契約書の本文等（先頭の RANKING_QUERY_CHARS 文字で検索）
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
+
+    Returns:
+        見出し + 関連度順のチャンク
+    """
+    registry = get_registry()
+    if eccn_json is not None and eccn_json is not registry.get().get('eccn_json'):
+        chunks, positions = build_eccn_context_chunks(eccn_json)
+    else:
+        chunks, positions = registry.get_derived(
+            "prompt_context:eccn_chunks",
+            lambda data: build_eccn_context_chunks(data.get('eccn_json'))
+        )
+    if not chunks:
+        return []
+
+    search_index = get_eccn_search_index(eccn_json)
+    order: Dict[int, None] = {}
+    for doc_id, score in search_index.search((query or '')[:RANKING_QUERY_CHARS], top_k=RANKING_TOP_K):
+        if score <= 0:
+            continue
+        record = search_index.records[doc_id]
+        position = positions.get((record['category_number'], record['group_title']))
+        if position is not None:
+            order.setdefault(position, None)
+    for position in range(len(chunks)):
+        order.setdefault(position, None)
+    return [ECCN_CONTEXT_HEADER] + [chunks[position] for position in order]
+
+
+def build_regulation_index(text: Optional[str]) -> Tuple[List, Optional[RegulationSearchIndex]]:
+    """General Prohibitionsの規制テキストのチャンクとBM25検索を組み立てる"""
+    chunks = chunk_regulation_text(text, "generalPohibition") if text else []
+    return chunks, RegulationSearchIndex(chunks) if chunks else None
+
+
+def get_ranked_regulation_chunks(query: str, pinned_citations: Sequence[str] = GP_CHECK_CITATIONS) -> List[str]:
+    """
+    General Prohibitions（EAR Part 736）の規制テキストのチャンクを、分析に関連する項から順に取得
+
+    pinned_citations の項（既定: GP4〜GP8）を先頭に、クエリのBM25検索で一致した項（pinned_citations の下位の項を優先）、
+    残りを本文の順に並べる。
+    トークン予算内で先頭から詰めると、判定に使う条文が優先して残る。
+
+    Args:
+        query: 品目・仕向地・用途等（先頭の RANKING_QUERY_CHARS 文字で検索）
+        pinned_citations: 必ず先頭に置く引用（例: "§ 736.2(b)(4)"）
+
+    Returns:
+        見出し + 関連度順のチャンク（"[引用] 本文"）
+    """
+    chunks, search_index = get_registry().get_derived(
+        "prompt_context:regulation_chunks",
+        lambda data: build_regulation_index(data.get('general_prohibitions'))
+    )
+    if not chunks:
+        return []
+    ranked = rank_regulation_chunks(chunks, search_index, (query or '')[:RANKING_QUERY_CHARS], pinned_citations, RANKING_TOP_K)
+    return [REGULATION_CONTEXT_HEADER] + [f"[{chunk.citation}] {chunk.text}\n\n" for chunk in ranked]
+
+
+def build_country_chart_context(country_chart: Optional[pd.DataFrame], max_rows: int, key_columns: Sequence[str], destination: Optional[str] = None) -> str:
+    """
+    カントリーチャートからプロンプト用のテキストを組み立てる
+
+    Args:
+        country_chart: カントリーチャートのDataFrame
+        max_rows: 先頭から含める国の数
+        key_columns: 含める規制理由列
+        destination: 仕向地。指定時は該当国の行を先頭に含める
+
+    Returns:
+        カントリーチャートのテキスト（データが無い場合は空文字列）
+    """
+    chart_index = get_country_chart_index(country_chart)
+    if chart_index is None:
+        return ""
+
+    rows = list(range(min(max_rows, len(chart_index.country_names))))
+    destination_row = chart_index.row_for(destination) if destination else None
+    if destination_row is not None:
+        rows = [destination_row] + [row for row in rows if row != destination_row]
+    return COUNTRY_CHART_CONTEXT_HEADER + chart_index.format_rows(rows, list(key_columns))
+
+
+def build_chart_notes(country_chart: Optional[pd.DataFrame]) -> List[List[str]]:
+    """
+    カントリーチャートの各行の特記事項（Special Case 列と脚注列）を取得
+
+    Returns:
+        行ごとの注記テキストのリスト
+    """
+    if country_chart is None or country_chart.empty:
+        return []
+    note_columns = [
+        column for column in country_chart.columns
+        if column == 'Special Case' or str(column).startswith('Footnote')
+    ]
+    notes = country_chart[note_columns].fillna('').astype(str).to_numpy() if note_columns else None
+    return [
+        [' '.join(note.split()) for note in notes[row] if note.strip()] if notes is not None else []
+        for row in range(len(country_chart))
+    ]
+
+
+def build_destination_chart_context(chart_index: CountryChartIndex, notes: Sequence[Sequence[str]], rows: Sequence[int]) -> str:
+    """
+    仕向地の行のみのカントリーチャートテキストを組み立てる（全規制理由列と脚注を含む）
+
+    Args:
+        chart_index: カントリーチャートのインデックス
+        notes: 行ごとの注記（build_chart_notes の戻り値）
+        rows: 仕向地の行番号
+
+    Returns:
+        カントリーチャートのテキスト
+    """
+    text = DESTINATION_CHART_CONTEXT_HEADER
+    for row in rows:
+        text += chart_index.format_rows([row], chart_index.reason_columns)
+        if not chart_index.row_bits[row]:
+            text += "  - No reason for control marked\n"
+        for note in (notes[row] if row < len(notes) else []):
+            text += f"  - Note: {note}\n"
+    return text
+
+
+def _category_digit(text: str) -> Optional[str]:
+    """"Category 5 - Part 1"・"3"・"3A001" 等から先頭のカテゴリー番号（1桁）を取得"""
+    match = CATEGORY_DIGIT.search(text)
+    return match.group(0) if match else None
+
+
+def _normalize_category(category: Optional[str]) -> Optional[str]:
+    """カテゴリー番号またはECCN番号（"3A001" 等）からカテゴリー番号を取得"""
+    category = (category or '').strip()
+    return _category_digit(category) if category else None
+
+
+def get_eccn_context(eccn_json: Optional[Dict] = None, category: Optional[str] = None) -> str:
+    """
+    プロンプト用のECCNデータベーステキストを取得（共有データはバージョン・カテゴリーごとに一度だけ構築）
+
+    Args:
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
+        category: カテゴリー番号またはECCN番号（省略時は全カテゴリー）
+
+    Returns:
+        ECCNデータベースのテキスト
+    """
+    category = _normalize_category(category)
+    registry = get_registry()
+    if eccn_json is not None and eccn_json is not registry.get().get('eccn_json'):
+        return build_eccn_context(eccn_json, category)
+
+    return registry.get_derived(
+        f"prompt_context:eccn:{category or 'all'}",
+        lambda data: build_eccn_context(data.get('eccn_json'), category)
+    )
+
+
+def get_country_chart_context(country_chart: Optional[pd.DataFrame] = None, max_rows: int = 30, key_columns: Sequence[str] = CONTRACT_CHART_COLUMNS, destination: Optional[str] = None) -> str:
+    """
+    プロンプト用のカントリーチャートテキストを取得
+
+    共有データの仕向地を含まないテキストはバージョンごとに一度だけ構築する。
+    仕向地の行を先頭に置くテキストは呼び出しごとに組み立てる（仕向地ごとの結果は保持しない）。
+
+    Args:
+        country_chart: カントリーチャートのDataFrame（省略時は共有レジストリのデータ）
+        max_rows: 先頭から含める国の数
+        key_columns: 含める規制理由列
+        destination: 仕向地（国名・日本語名・ISOコード）
+
+    Returns:
+        カントリーチャートのテキスト
+    """
+    registry = get_registry()
+    if country_chart is not None and country_chart is not registry.get().get('country_chart'):
+        return build_country_chart_context(country_chart, max_rows, key_columns, destination)
+
+    chart_index = get_country_chart_index()
+    if chart_index is not None and destination and chart_index.row_for(destination) is not None:
+        return build_country_chart_context(registry.get().get('country_chart'), max_rows, key_columns, destination)
+
+    return registry.get_derived(
+        f"prompt_context:chart:{max_rows}:{','.join(key_columns)}",
+        lambda data: build_country_chart_context(data.get('country_chart'), max_rows, key_columns)
+    )
+
+
+def get_destination_chart_context(destination: Optional[str], country_chart: Optional[pd.DataFrame] = None, fallback_rows: int = 30, fallback_columns: Sequence[str] = CONTRACT_CHART_COLUMNS) -> str:
+    """
+    仕向地の行と脚注のみのカントリーチャートテキストを取得（共有データの脚注はバージョンごとに一度だけ構築）
+
+    仕向地の記載に含まれる国（複数可）を別名索引で解決し、該当行だけを含める。
+    数行のテキストは呼び出しごとに組み立てる（仕向地の組み合わせごとの結果は保持しない）。
+    解決できる国が無い場合は先頭 fallback_rows 行の従来のテキストを返す。
+
+    Args:
+        destination: 仕向地の記載（"Vietnam"、"ベトナム・タイ"、"Hanoi, Vietnam" 等）
+        country_chart: カントリーチャートのDataFrame（省略時は共有レジストリのデータ）
+        fallback_rows: 仕向地を解決できない場合に含める先頭からの国の数
+        fallback_columns: 仕向地を解決できない場合に含める規制理由列
+
+    Returns:
+        カントリーチャートのテキスト
+    """
+    registry = get_registry()
+    shared = country_chart is None or country_chart is registry.get().get('country_chart')
+    chart_index = get_country_chart_index(country_chart)
+    if chart_index is None:
+        return ""
+
+    rows = []
+    for country_id in resolve_countries(destination or ''):
+        row = chart_index.row_index.get(country_id)
+        if row is not None and row not in rows:
+            rows.append(row)
+    if not rows:
+        return get_country_chart_context(country_chart, fallback_rows, fallback_columns, destination)
+
+    if not shared:
+        return build_destination_chart_context(chart_index, build_chart_notes(country_chart), rows)
+
+    notes = registry.get_derived("prompt_context:chart_notes", lambda data: build_chart_notes(data.get('country_chart')))
+    return build_destination_chart_context(chart_index, notes, rows)
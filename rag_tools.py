@@ -1,41 +1,150 @@
 """
 RAG (Retrieval-Augmented Generation) ツール
-Pineconeを使用した許可例外判断システム
+Pinecone（またはローカルのベクトルストア）を使用した許可例外判断システム
+
+LicenseExceptionRAG はプロセス全体（全Streamlitセッション）で1つを共有する（get_license_exception_rag）。
+ベクトルストア・OpenAIの接続は初回利用時に1度だけ確立し、以降の判定では接続済みのクライアントを再利用する。
+インスタンスは検索ごとの状態を持たないため、複数のスレッドから同時に使用できる。
 """
 
-import os
-from typing import Dict, List, Optional, Tuple
-from pinecone import Pinecone
-from openai import OpenAI
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 import streamlit as st
 
+from embedding_cache import cached_embedding, cached_embeddings
+from llm_cache import cached_chat_completion
+from llm_replay import ReplayVectorIndex, env_latency_model, get_env_cassette
+from telemetry import measure
+from openai_client import get_openai_client
+from regulations import REGULATION_NAMESPACE
+from vector_store import EMBEDDING_DIMENSIONS, EMBEDDING_MODEL, INDEX_NAME, NAMESPACE, open_vector_index, vector_store_name
+
+# バッチ検索でベクトル検索を並行実行する数の上限
+MAX_PARALLEL_QUERIES = 8
+# 1回の分析で検索するECCN候補の上限
+MAX_CANDIDATE_ECCNS = 3
+# 許可例外の分析に添える規制条文（regulations namespace）の件数
+REGULATION_TOP_K = 3
+
+
+def build_query_text(eccn_number: str, destination: str, product_description: str) -> str:
+    """許可例外検索のクエリテキスト（embeddingのキャッシュキーになるため書式を変えない）"""
+    return f"""
+        ECCN Number: {eccn_number}
+        Destination: {destination}
+        Product: {product_description}
+        
+        What license exceptions are available for this export?
+        """
+
+
+@dataclass
+class LicenseExceptionBatch:
+    """
+    バッチ検索の結果
+    
+    results は入力の組ごとの検索結果（スコア順）。複数の組で一致したレコードは records に1件だけ保持する
+    （スコアは組の中で最も高いもの）。
+    """
+    results: Dict[Tuple[str, str, str], List[Any]]
+    records: Dict[str, Any]
+    matched_by: Dict[str, List[Tuple[str, str, str]]]
+    
+    @classmethod
+    def from_matches(cls, results: Dict[Tuple[str, str, str], List[Any]]) -> "LicenseExceptionBatch":
+        records: Dict[str, Any] = {}
+        matched_by: Dict[str, List[Tuple[str, str, str]]] = {}
+        for query, matches in results.items():
+            for match in matches:
+                matched_by.setdefault(match.id, []).append(query)
+                if match.id not in records or match.score > records[match.id].score:
+                    records[match.id] = match
+        return cls(results=results, records=records, matched_by=matched_by)
+    
+    def shared_ids(self) -> List[str]:
+        """複数の組で一致したレコードのID"""
+        return [record_id for record_id, queries in self.matched_by.items() if len(queries) > 1]
+    
+    def format_context(self) -> str:
+        """
+        重複を除いた検索結果をGPTに渡すテキストに整形（各レコードに一致した組を付記）
+        
+        Returns:
+            整形されたテキスト
+        """
+        formatted_text = ""
+        records = sorted(self.records.values(), key=lambda match: match.score, reverse=True)
+        for i, match in enumerate(records, 1):
+            formatted_text += f"\n【検索結果 {i}】（関連度: {match.score:.3f}）\n"
+            formatted_text += f"ID: {match.id}\n"
+            queries = ", ".join(f"{eccn} → {destination}" for eccn, destination, _ in self.matched_by[match.id])
+            formatted_text += f"該当: {queries}\n"
+            if match.metadata:
+                for key, value in match.metadata.items():
+                    formatted_text += f"{key}: {value}\n"
+            formatted_text += "\n" + "-" * 80 + "\n"
+        return formatted_text
+
+
 class LicenseExceptionRAG:
     """
     許可例外（License Exceptions）判断用RAGシステム
     """
     
-    def __init__(self):
+    def __init__(self, index=None):
         """
-        PineconeとOpenAIクライアントを初期化
+        ベクトルストアとOpenAIクライアントを初期化
+        
+        Args:
+            index: 検索に使うインデックス（省略時は VECTOR_STORE で設定したベクトルストアに接続。記録・再生用の代替を渡せる）
         """
-        self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
-        self.openai_api_key = os.getenv("OPENAI_API_KEY")
+        # 再生用のカセットが指定されていれば記録済みの検索結果を返す
+        if index is None:
+            cassette = get_env_cassette()
+            if cassette is not None:
+                index = ReplayVectorIndex(cassette, env_latency_model())
         
-        if not self.pinecone_api_key:
-            raise ValueError("PINECONE_API_KEY が設定されていません")
+        if index is None:
+            # Pinecone（既定）またはローカルのストアに接続（pinecone・openaiはRAG初回利用時に読み込む）
+            index = open_vector_index()
+        self.index = index
+        self.store_name = vector_store_name(index)
         
-        # Pinecone接続
-        self.pc = Pinecone(api_key=self.pinecone_api_key)
-        # インデックス名は環境に応じて変更してください
-        # ユーザーのPineconeホストURLから判断: license-exceptions
-        self.index = self.pc.Index("license-exceptions")
+        # OpenAI接続（プロセス全体で共有するクライアント。再試行・同時実行数の上限を含む）
+        self.openai_client = get_openai_client()
+        self.last_health: Optional[Dict[str, Any]] = None
+    
+    def health_check(self) -> Dict[str, Any]:
+        """
+        インデックスへの接続を確認（接続の確立も兼ねる）
         
-        # OpenAI接続
-        self.openai_client = OpenAI(api_key=self.openai_api_key)
+        Returns:
+            {"ok", "store", "latency_ms", "vector_count"（namespace内のベクトル数）, "error", "checked_at"}
+        """
+        start = time.perf_counter()
+        try:
+            with measure("vector_query", "rag:health_check", model=f"{self.store_name}:{INDEX_NAME}"):
+                stats = self.index.describe_index_stats()
+            namespace_stats = (getattr(stats, "namespaces", None) or {}).get(NAMESPACE)
+            vector_count = getattr(namespace_stats, "vector_count", 0)
+            health = {"ok": True, "vector_count": vector_count, "error": None}
+            if self.store_name == "local" and not vector_count:
+                health.update(ok=False, error="ローカルのベクトルストアにレコードがありません（python vector_store.py export）")
+        except Exception as e:
+            health = {"ok": False, "vector_count": None, "error": str(e)}
+        health["store"] = self.store_name
+        health["latency_ms"] = (time.perf_counter() - start) * 1000
+        health["checked_at"] = time.time()
+        self.last_health = health
+        return health
     
     def create_query_embedding(self, query_text: str) -> List[float]:
         """
-        クエリテキストからembeddingを生成
+        クエリテキストからembeddingを生成（同じクエリはembeddingキャッシュから返す）
         
         Args:
             query_text: クエリテキスト
@@ -43,19 +152,41 @@ class LicenseExceptionRAG:
         Returns:
             embedding vector
         """
-        response = self.openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=query_text,
-            dimensions=1024  # Pineconeインデックスの次元数に合わせる
+        vector = cached_embedding(
+            self.openai_client,
+            query_text,
+            model=EMBEDDING_MODEL,
+            dimensions=EMBEDDING_DIMENSIONS,
+            label="rag:query_embedding"
         )
-        return response.data[0].embedding
+        return vector.tolist()
+    
+    def _query_index(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        filter: Optional[Dict[str, Any]],
+        namespace: str = NAMESPACE
+    ) -> List[Any]:
+        """ベクトルストアで検索（namespaceを指定。フィルタは指定した場合のみ渡す）"""
+        extra = {"filter": filter} if filter else {}
+        with measure("vector_query", "rag:vector_query", model=f"{self.store_name}:{INDEX_NAME}"):
+            results = self.index.query(
+                vector=query_embedding,
+                top_k=top_k,
+                include_metadata=True,
+                namespace=namespace,  # namespace指定
+                **extra
+            )
+        return results.matches
     
     def search_license_exceptions(
         self, 
         eccn_number: str, 
         destination: str, 
         product_description: str,
-        top_k: int = 5
+        top_k: int = 5,
+        filter: Optional[Dict[str, Any]] = None
     ) -> List[Dict]:
         """
         許可例外を検索
@@ -65,31 +196,88 @@ class LicenseExceptionRAG:
             destination: 仕向地
             product_description: 品目説明
             top_k: 取得する上位結果数
+            filter: メタデータのフィルタ（Pinecone形式。例: {"exception": {"$in": ["LVS", "GBS"]}}）
             
         Returns:
             検索結果のリスト
         """
         # クエリテキストを構築
-        query_text = f"""
-        ECCN Number: {eccn_number}
-        Destination: {destination}
-        Product: {product_description}
+        query_text = build_query_text(eccn_number, destination, product_description)
         
-        What license exceptions are available for this export?
+        # Embedding生成
+        query_embedding = self.create_query_embedding(query_text)
+        
+        return self._query_index(query_embedding, top_k, filter)
+    
+    def search_regulations(
+        self,
+        eccn_number: str,
+        destination: str,
+        product_description: str,
+        top_k: int = REGULATION_TOP_K
+    ) -> List[Any]:
         """
+        regulations namespace（python regulations.py ingest で取り込んだ条文）を検索
         
-        # Embedding生成
+        許可例外の検索と同じクエリテキストを使うため、embeddingはキャッシュから再利用される。
+        条文を取り込んでいない場合は空のリストを返す。
+        
+        Args:
+            eccn_number: ECCN番号
+            destination: 仕向地
+            product_description: 品目説明
+            top_k: 取得する上位結果数
+            
+        Returns:
+            検索結果のリスト
+        """
+        query_text = build_query_text(eccn_number, destination, product_description)
         query_embedding = self.create_query_embedding(query_text)
+        return self._query_index(query_embedding, top_k, None, namespace=REGULATION_NAMESPACE)
+    
+    def search_license_exceptions_batch(
+        self,
+        queries: Sequence[Tuple[str, str, str]],
+        top_k: int = 5,
+        filter: Optional[Dict[str, Any]] = None,
+        max_workers: int = MAX_PARALLEL_QUERIES
+    ) -> "LicenseExceptionBatch":
+        """
+        複数の (ECCN番号, 仕向地, 品目説明) の許可例外をまとめて検索
+        
+        embeddingは1回のリクエストにまとめ（キャッシュ済みのクエリは送らない）、ベクトル検索は並行実行する。
+        同じ組は1度だけ検索する。
+        
+        Args:
+            queries: (ECCN番号, 仕向地, 品目説明) のリスト（契約書の品目・ECCNの候補ごと）
+            top_k: 組ごとに取得する上位結果数
+            filter: メタデータのフィルタ（Pinecone形式）
+            max_workers: ベクトル検索の同時実行数の上限
+            
+        Returns:
+            組ごとの検索結果と、重複を除いたレコード
+        """
+        unique_queries = list(dict.fromkeys(tuple(query) for query in queries))
+        if not unique_queries:
+            return LicenseExceptionBatch(results={}, records={}, matched_by={})
         
-        # Pineconeで検索（namespaceを指定）
-        results = self.index.query(
-            vector=query_embedding,
-            top_k=top_k,
-            include_metadata=True,
-            namespace="license_exceptions"  # namespace指定
+        vectors = cached_embeddings(
+            self.openai_client,
+            [build_query_text(*query) for query in unique_queries],
+            model=EMBEDDING_MODEL,
+            dimensions=EMBEDDING_DIMENSIONS,
+            label="rag:query_embedding"
         )
         
-        return results.matches
+        # ワーカースレッドでも呼び出し元のトレースに計測されるようにコンテキストを引き継ぐ
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_queries))), thread_name_prefix="rag-query") as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._query_index, vector.tolist(), top_k, filter)
+                for vector in vectors
+            ]
+            matches = [future.result() for future in futures]
+        
+        return LicenseExceptionBatch.from_matches(dict(zip(unique_queries, matches)))
     
     def analyze_license_exception_applicability(
         self,
@@ -97,30 +285,55 @@ class LicenseExceptionRAG:
         destination: str,
         product_description: str,
         end_user: Optional[str] = None,
-        end_use: Optional[str] = None
+        end_use: Optional[str] = None,
+        candidate_eccns: Optional[Sequence[str]] = None
     ) -> Dict:
         """
         許可例外の適用可否を分析
         
+        candidate_eccns を指定した場合は、候補ごとの検索をまとめて行い（search_license_exceptions_batch）、
+        重複を除いた結果を1回のGPT呼び出しで判断する。
+        
         Args:
             eccn_number: ECCN番号
             destination: 仕向地
             product_description: 品目説明
             end_user: エンドユーザー（オプション）
             end_use: 用途（オプション）
+            candidate_eccns: ECCN番号の候補（オプション。先頭の MAX_CANDIDATE_ECCNS 件を検索）
             
         Returns:
             分析結果（許可例外、適用可否、根拠）
         """
         # RAGで関連情報を取得
-        search_results = self.search_license_exceptions(
-            eccn_number=eccn_number,
+        shared_ids: List[str] = []
+        candidates = list(dict.fromkeys(candidate_eccns or ()))[:MAX_CANDIDATE_ECCNS]
+        if candidates:
+            batch = self.search_license_exceptions_batch(
+                [(candidate, destination, product_description) for candidate in candidates]
+            )
+            search_results = sorted(batch.records.values(), key=lambda match: match.score, reverse=True)
+            shared_ids = batch.shared_ids()
+            context_text = batch.format_context()
+            eccn_number = ", ".join(candidates)
+        else:
+            search_results = self.search_license_exceptions(
+                eccn_number=eccn_number,
+                destination=destination,
+                product_description=product_description
+            )
+            # 検索結果をテキスト化
+            context_text = self._format_search_results(search_results)
+        regulation_results = self.search_regulations(
+            eccn_number=candidates[0] if candidates else eccn_number,
             destination=destination,
             product_description=product_description
         )
-        
-        # 検索結果をテキスト化
-        context_text = self._format_search_results(search_results)
+        regulation_text = self._format_regulation_results(regulation_results)
+        regulation_section = f"""
+【関連する規制条文（RAG検索結果）】
+{regulation_text}
+""" if regulation_text else ""
         
         # GPTで判断
         analysis_prompt = f"""
@@ -137,7 +350,7 @@ class LicenseExceptionRAG:
 
 【関連する許可例外情報（RAG検索結果）】
 {context_text}
-
+{regulation_section}
 【分析指示】
 以下の形式で回答してください：
 
@@ -164,7 +377,8 @@ class LicenseExceptionRAG:
 """
         
         try:
-            response = self.openai_client.chat.completions.create(
+            analysis_result = cached_chat_completion(
+                self.openai_client,
                 model="gpt-4-turbo-preview",
                 messages=[
                     {
@@ -177,15 +391,16 @@ class LicenseExceptionRAG:
                     }
                 ],
                 temperature=0.2,
-                max_tokens=2000
+                max_tokens=2000,
+                step="rag:license_exceptions"
             )
             
-            analysis_result = response.choices[0].message.content
-            
             return {
                 "success": True,
                 "analysis": analysis_result,
                 "search_results": search_results,
+                "shared_ids": shared_ids,
+                "regulation_results": regulation_results,
                 "context_used": context_text,
                 "eccn_number": eccn_number,
                 "destination": destination
@@ -201,10 +416,10 @@ class LicenseExceptionRAG:
     
     def _format_search_results(self, results) -> str:
         """
-        Pinecone検索結果をテキスト形式に整形
+        ベクトルストアの検索結果をテキスト形式に整形
         
         Args:
-            results: Pinecone検索結果
+            results: 検索結果
             
         Returns:
             整形されたテキスト
@@ -227,52 +442,100 @@ class LicenseExceptionRAG:
         
         return formatted_text
     
-    def display_license_exception_analysis(
-        self,
-        analysis_result: Dict
-    ):
+    def _format_regulation_results(self, results) -> str:
         """
-        Streamlitで許可例外分析結果を表示
+        regulations namespaceの検索結果を「引用 + 条文」の形式に整形
         
         Args:
-            analysis_result: analyze_license_exception_applicability()の返り値
+            results: 検索結果
+            
+        Returns:
+            整形されたテキスト（結果がない場合は空文字列）
         """
-        if not analysis_result.get("success"):
-            st.error(f"❌ 分析エラー: {analysis_result.get('error', '不明なエラー')}")
-            return
-        
-        st.markdown("### 📋 許可例外（License Exceptions）分析結果")
+        blocks = []
+        for match in results:
+            metadata = match.metadata or {}
+            if not metadata.get("text"):
+                continue
+            blocks.append(f"[{metadata.get('citation', match.id)}]\n{metadata['text']}")
+        return "\n\n".join(blocks)
+
+_rag: Optional[LicenseExceptionRAG] = None
+_rag_lock = threading.Lock()
+
+
+def get_license_exception_rag() -> LicenseExceptionRAG:
+    """
+    プロセス全体で共有されるLicenseExceptionRAGを取得
+    
+    初回は接続を確認してから共有する。接続できない場合は例外を送出し、次の呼び出しで再度接続を試みる。
+    
+    Returns:
+        接続済みのLicenseExceptionRAG
+    """
+    global _rag
+    if _rag is None:
+        with _rag_lock:
+            if _rag is None:
+                rag = LicenseExceptionRAG()
+                health = rag.health_check()
+                if not health["ok"]:
+                    raise RuntimeError(f"ベクトルストアに接続できません: {health['error']}")
+                _rag = rag
+    return _rag
+
+
+def get_license_exception_rag_health() -> Optional[Dict[str, Any]]:
+    """共有インスタンスの直近の接続確認結果（まだ作成されていない場合はNone）"""
+    return _rag.last_health if _rag is not None else None
+
+
+def display_license_exception_analysis(analysis_result: Dict):
+    """
+    Streamlitで許可例外分析結果を表示（RAGの接続は不要）
+    
+    Args:
+        analysis_result: analyze_license_exception_applicability()の返り値
+    """
+    if not analysis_result.get("success"):
+        st.error(f"❌ 分析エラー: {analysis_result.get('error', '不明なエラー')}")
+        return
+    
+    st.markdown("### 📋 許可例外（License Exceptions）分析結果")
+    
+    # 分析結果を表示
+    st.markdown(analysis_result["analysis"])
+    
+    st.markdown("---")
+    
+    # RAG検索の詳細を表示
+    with st.expander("🔍 RAG検索詳細（判断根拠のデータソース）"):
+        st.markdown("#### 📚 ベクトルストアから取得した関連情報")
         
-        # 分析結果を表示
-        st.markdown(analysis_result["analysis"])
+        search_results = analysis_result.get("search_results", [])
+        shared_ids = analysis_result.get("shared_ids", [])
+        if shared_ids:
+            st.caption(f"ECCN {analysis_result.get('eccn_number', '')} の検索で共通のレコード {len(shared_ids)} 件は1件にまとめています")
         
-        st.markdown("---")
+        if search_results:
+            for i, match in enumerate(search_results, 1):
+                st.markdown(f"""
+                **検索結果 {i}** - 関連度: {match.score:.3f}
+                
+                **ID**: {match.id}
+                """)
+                
+                # メタデータを表示
+                if match.metadata:
+                    st.json(match.metadata)
+                
+                st.markdown("---")
+        else:
+            st.info("検索結果がありません")
         
-        # RAG検索の詳細を表示
-        with st.expander("🔍 RAG検索詳細（判断根拠のデータソース）"):
-            st.markdown("#### 📚 Pineconeから取得した関連情報")
-            
-            search_results = analysis_result.get("search_results", [])
-            
-            if search_results:
-                for i, match in enumerate(search_results, 1):
-                    st.markdown(f"""
-                    **検索結果 {i}** - 関連度: {match.score:.3f}
-                    
-                    **ID**: {match.id}
-                    """)
-                    
-                    # メタデータを表示
-                    if match.metadata:
-                        st.json(match.metadata)
-                    
-                    st.markdown("---")
-            else:
-                st.info("検索結果がありません")
-            
-            # 使用されたコンテキストを表示
-            with st.expander("📄 GPTに提供されたコンテキスト全文"):
-                st.text(analysis_result.get("context_used", ""))
+        # 使用されたコンテキストを表示
+        with st.expander("📄 GPTに提供されたコンテキスト全文"):
+            st.text(analysis_result.get("context_used", ""))
 
 
 def check_license_exception_with_rag(
@@ -280,7 +543,8 @@ def check_license_exception_with_rag(
     destination: str,
     product_description: str,
     end_user: Optional[str] = None,
-    end_use: Optional[str] = None
+    end_use: Optional[str] = None,
+    candidate_eccns: Optional[Sequence[str]] = None
 ) -> Tuple[bool, Dict]:
     """
     RAGを使用して許可例外をチェック（簡易インターフェース）
@@ -291,20 +555,21 @@ def check_license_exception_with_rag(
         product_description: 品目説明
         end_user: エンドユーザー
         end_use: 用途
+        candidate_eccns: ECCN番号の候補（指定時は候補ごとにまとめて検索）
         
     Returns:
         (成功フラグ, 分析結果)
     """
     try:
-        rag = LicenseExceptionRAG()
+        rag = get_license_exception_rag()
         result = rag.analyze_license_exception_applicability(
             eccn_number=eccn_number,
             destination=destination,
             product_description=product_description,
             end_user=end_user,
-            end_use=end_use
+            end_use=end_use,
+            candidate_eccns=candidate_eccns
         )
         return (result.get("success", False), result)
     except Exception as e:
         return (False, {"error": str(e)})
-
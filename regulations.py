@@ -0,0 +1,505 @@
+"""
+規制テキストのチャンク分割と取り込み
+EARの条文テキスト（generalPohibition.text 等）を節・項（§ 736.2(b)(1) 等）の構造に沿ったチャンクに分割し、
+General Prohibitionsの分析ステップへの埋め込み（BM25で関連度順）とベクトルストアへの登録に使う。
+
+取り込みは差分のみ: チャンクの内容（embeddingモデル・次元数を含む）のハッシュをメタデータに保存し、
+内容が変わらないチャンクはembeddingを作り直さない。元のテキストから消えたチャンクはストアから削除する。
+
+使い方:
+    python regulations.py chunks                        # チャンクの一覧（引用・トークン数）
+    python regulations.py ingest                        # VECTOR_STORE のストアに差分を登録
+    python regulations.py ingest --store local --dry-run
+    python regulations.py ingest path/to/part740.text   # 任意の規制テキストを取り込む
+"""
+
+import hashlib
+import math
+import re
+import sys
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from data_registry import BASE_DIR
+from eccn_index import tokenize
+from prompt_budget import count_tokens
+
+REGULATION_FILES = [BASE_DIR / "generalPohibition.text"]
+REGULATION_NAMESPACE = "regulations"
+DEFAULT_MAX_CHUNK_TOKENS = 350
+EMBED_BATCH_SIZE = 64
+UPSERT_BATCH_SIZE = 100
+FETCH_BATCH_SIZE = 100
+
+# ページのヘッダー・フッター（"General Prohibitions Part 736-page 3" 等）と脚注の行
+PAGE_LINE = re.compile(r"Part \d+\s*[-–—]\s*page \d+|^Export Administration Regulations Bureau of Industry and Security")
+FOOTNOTE_LINE = re.compile(r"^\d{1,2} See ")
+
+# 節の見出し（"§ 736.2 GENERAL PROHIBITIONS AND"）・補則の見出し（"SUPPLEMENT NO. 1 TO PART 736 - GENERAL ORDERS"）
+# 目次の行（"§ 736.1 INTRODUCTION ....... 1"）は点線を含むため一致しない。目次の見出しは本文の同じ見出しで置き換える
+SECTION_HEADING = re.compile(r"^§\s*(\d+\.\d+)\s+([A-Z][A-Z0-9 ,;’'\-–—()]*)$")
+SUPPLEMENT_HEADING = re.compile(r"^SUPPLEMENT NO\.\s*(\d+) TO PART (\d+)\s*[-–—]?\s*(.*)$")
+TITLE_CONTINUATION = re.compile(r"^[A-Z][A-Z0-9 ,;’'\-–—()]*$")
+
+# 項の記号（"(a) " "(1) " "(ii) " "(A) "）。改行で行頭に来た参照（"(b)(8)(ii) of this section"）や
+# 小文字で続く文中の列挙は記号として扱わない
+PARAGRAPH_MARKER = re.compile(r"^\(([a-z]|[0-9]{1,3}|[ivxl]{1,6}|[A-Z])\)\s+(?=[A-Z0-9\[“\"‘'(])")
+# 文の区切り（"General Order No. 3" 等の略語では区切らない）
+SENTENCE_END = re.compile(r"(?<!\bNo\.)(?<!\bU\.S\.)(?<=[.;:])\s+")
+ROMAN_NUMERAL = re.compile(r"^(x{0,3})(ix|iv|v?i{0,3})$")
+ROMAN_VALUES = [(10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i")]
+
+# 項の階層: (a) → (1) → (i) → (A) → (1)
+LETTER, NUMBER, ROMAN, UPPER, SUBNUMBER = range(5)
+
+# BM25のパラメータ
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+@dataclass
+class RegulationChunk:
+    """規制テキストの1チャンク（節・項の単位）"""
+    id: str
+    citation: str
+    section: str
+    section_title: str
+    heading: str
+    text: str
+    source: str
+
+    @property
+    def content(self) -> str:
+        """引用・見出しを付けたチャンクの本文（プロンプト・embeddingの入力）"""
+        header = f"{self.citation} {self.section_title}"
+        if self.heading:
+            header += f" > {self.heading}"
+        return f"{header}\n{self.text}"
+
+    def content_hash(self, model: str = "", dimensions: Optional[int] = None) -> str:
+        """内容とembeddingの設定のハッシュ（取り込み時の差分判定に使う）"""
+        payload = f"{model}\n{dimensions}\n{self.content}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+@dataclass
+class _Node:
+    """節または項（子の項を持つ）"""
+    level: int
+    marker: str
+    path: List[str]
+    lines: List[str] = field(default_factory=list)
+    children: List["_Node"] = field(default_factory=list)
+
+
+def _to_roman(number: int) -> str:
+    parts = []
+    for value, numeral in ROMAN_VALUES:
+        while number >= value:
+            parts.append(numeral)
+            number -= value
+    return ''.join(parts)
+
+
+def _from_roman(numeral: str) -> int:
+    for number in range(1, 40):
+        if _to_roman(number) == numeral:
+            return number
+    return 0
+
+
+def _marker_level(token: str, open_markers: Dict[int, str]) -> int:
+    """項の記号の階層（"i" "v" "x" は直前の項から小文字の記号かローマ数字かを判定）"""
+    if token.isdigit():
+        # (A) の下の (1) は (b)(7)(i)(A)(1) のように5段目の項として扱う
+        previous_subnumber = open_markers.get(SUBNUMBER)
+        if previous_subnumber and int(previous_subnumber) + 1 == int(token):
+            return SUBNUMBER
+        if UPPER in open_markers and token == "1":
+            return SUBNUMBER
+        return NUMBER
+    if token.isupper():
+        return UPPER
+    is_roman = bool(ROMAN_NUMERAL.match(token))
+    if not is_roman:
+        return LETTER
+    if len(token) > 1:
+        return ROMAN
+    previous_roman = open_markers.get(ROMAN)
+    if previous_roman and _to_roman(_from_roman(previous_roman) + 1) == token:
+        return ROMAN
+    previous_letter = open_markers.get(LETTER)
+    if previous_letter and chr(ord(previous_letter) + 1) == token:
+        return LETTER
+    return ROMAN
+
+
+def _join_lines(lines: Sequence[str]) -> str:
+    """PDFから抽出した折り返しの行を1つの文に戻す（行末のハイフンは次の語とつなげる）"""
+    text = ""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if text.endswith("-") and line[:1].islower():
+            text += line
+        elif text:
+            text += " " + line
+        else:
+            text = line
+    return text
+
+
+def _clean_lines(text: str) -> List[str]:
+    """ページのヘッダー・フッター・脚注の行を除く"""
+    return [
+        line.rstrip() for line in text.splitlines()
+        if line.strip() and not PAGE_LINE.search(line) and not FOOTNOTE_LINE.match(line)
+    ]
+
+
+def parse_regulation_sections(text: str) -> List[Tuple[str, str, _Node]]:
+    """
+    規制テキストを節ごとの項の木に分割
+
+    Returns:
+        (節の番号, 節の見出し, 節の木) のリスト（本文の順）
+    """
+    sections: Dict[str, Tuple[str, str, _Node]] = {}
+    current: Optional[_Node] = None
+    stack: List[_Node] = []
+    open_markers: Dict[int, str] = {}
+    title_open = False
+
+    for line in _clean_lines(text):
+        stripped = line.strip()
+        section_match = SECTION_HEADING.match(stripped)
+        supplement_match = SUPPLEMENT_HEADING.match(stripped)
+        if section_match or supplement_match:
+            if section_match:
+                key, citation, title = section_match.group(1), f"§ {section_match.group(1)}", section_match.group(2)
+            else:
+                number, part = supplement_match.group(1), supplement_match.group(2)
+                key, citation, title = f"supp{number}-{part}", f"Supplement No. {number} to Part {part}", supplement_match.group(3)
+            current = _Node(level=-1, marker="", path=[])
+            # 同じ節が再び現れた場合（目次の後の本文）は後の方で置き換える
+            sections.pop(key, None)
+            sections[key] = (citation, title.strip(" -–—"), current)
+            stack = [current]
+            open_markers = {}
+            title_open = True
+            continue
+        if current is None:
+            continue
+        if title_open and TITLE_CONTINUATION.match(stripped):
+            citation, title, node = sections[key]
+            sections[key] = (citation, f"{title} {stripped}".strip(" -–—"), node)
+            continue
+        title_open = False
+
+        marker_match = PARAGRAPH_MARKER.match(stripped)
+        if marker_match:
+            token = marker_match.group(1)
+            level = _marker_level(token, open_markers)
+            while len(stack) > 1 and stack[-1].level >= level:
+                stack.pop()
+            parent = stack[-1]
+            node = _Node(level=level, marker=token, path=parent.path + [token])
+            node.lines.append(stripped[marker_match.end():])
+            parent.children.append(node)
+            stack.append(node)
+            open_markers = {lvl: marker for lvl, marker in open_markers.items() if lvl < level}
+            open_markers[level] = token
+        else:
+            stack[-1].lines.append(stripped)
+
+    return [(citation, title, node) for citation, title, node in sections.values()]
+
+
+def _render(node: _Node) -> str:
+    """項とその子の項のテキスト"""
+    own = _join_lines(node.lines)
+    parts = [f"({node.marker}) {own}" if node.marker else own]
+    parts.extend(_render(child) for child in node.children)
+    return "\n".join(part for part in parts if part)
+
+
+def _first_sentence(text: str, max_chars: int = 100) -> str:
+    sentence = re.split(SENTENCE_END, text, maxsplit=1)[0]
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars].rstrip() + "…"
+
+
+def _split_text(text: str, max_tokens: int) -> List[str]:
+    """長いテキストを文の区切りで max_tokens 以下に分割"""
+    parts, current = [], ""
+    for sentence in re.split(SENTENCE_END, text):
+        candidate = f"{current} {sentence}".strip()
+        if current and count_tokens(candidate) > max_tokens:
+            parts.append(current)
+            current = sentence
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+def chunk_regulation_text(text: str, source: str, max_tokens: int = DEFAULT_MAX_CHUNK_TOKENS) -> List[RegulationChunk]:
+    """
+    規制テキストを節・項の構造に沿ったチャンクに分割
+
+    項とその子の項が max_tokens に収まれば1チャンクにし、収まらなければ項の本文と子の項を別々のチャンクにする。
+    子の無い長い項は文の区切りで分割する。各チャンクには親の項の最初の文を見出しとして付ける。
+
+    Args:
+        text: 規制テキスト
+        source: 出典名（チャンクIDの接頭辞。例: "generalPohibition"）
+        max_tokens: 1チャンクのトークン数の上限
+
+    Returns:
+        本文の順のチャンク
+    """
+    chunks: List[RegulationChunk] = []
+
+    def add(section_key: str, citation: str, title: str, node: _Node, headings: List[str], body: str):
+        paragraph = ''.join(f"({marker})" for marker in node.path)
+        parts = _split_text(body, max_tokens) if count_tokens(body) > max_tokens else [body]
+        for i, part in enumerate(parts, 1):
+            suffix = f"-p{i}" if len(parts) > 1 else ""
+            chunks.append(RegulationChunk(
+                id=f"{source}#{section_key}{paragraph}{suffix}",
+                citation=f"{citation}{paragraph}",
+                section=citation,
+                section_title=title,
+                heading=" > ".join(headings),
+                text=part,
+                source=source,
+            ))
+
+    def visit(section_key: str, citation: str, title: str, node: _Node, headings: List[str]):
+        body = _render(node)
+        if not node.children or count_tokens(body) <= max_tokens:
+            if body:
+                add(section_key, citation, title, node, headings, body)
+            return
+        own = _join_lines(node.lines)
+        if own:
+            add(section_key, citation, title, node, headings, f"({node.marker}) {own}" if node.marker else own)
+        child_headings = headings + [_first_sentence(own)] if own and node.marker else headings
+        for child in node.children:
+            visit(section_key, citation, title, child, child_headings)
+
+    for citation, title, root in parse_regulation_sections(text):
+        section_key = citation.replace("§ ", "") if citation.startswith("§") else \
+            "supp" + citation.split()[2] + "-" + citation.split()[-1]
+        visit(section_key, citation, title, root, [])
+    return chunks
+
+
+def load_regulation_chunks(paths: Iterable[Path] = REGULATION_FILES, max_tokens: int = DEFAULT_MAX_CHUNK_TOKENS) -> List[RegulationChunk]:
+    """規制テキストのファイルを読み込んでチャンクに分割（出典名はファイル名）"""
+    chunks = []
+    for path in paths:
+        path = Path(path)
+        chunks.extend(chunk_regulation_text(path.read_text(encoding='utf-8'), path.stem, max_tokens))
+    return chunks
+
+
+class RegulationSearchIndex:
+    """チャンクのBM25検索"""
+
+    def __init__(self, chunks: Sequence[RegulationChunk]):
+        self.chunks = chunks
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.lengths = []
+        for doc_id, chunk in enumerate(chunks):
+            tokens = tokenize(chunk.content)
+            self.lengths.append(len(tokens))
+            for token in tokens:
+                self.postings[token][doc_id] = self.postings[token].get(doc_id, 0) + 1
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[int, float]]:
+        """
+        クエリとの関連度が高いチャンクを検索
+
+        Returns:
+            (チャンク番号, スコア) のリスト（スコアの降順）
+        """
+        scores: Dict[int, float] = defaultdict(float)
+        n = len(self.chunks)
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, freq in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / (self.average_length or 1))
+                scores[doc_id] += idf * freq * (BM25_K1 + 1) / (freq + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+
+
+def rank_regulation_chunks(
+    chunks: Sequence[RegulationChunk],
+    search_index: RegulationSearchIndex,
+    query: str,
+    pinned_citations: Sequence[str] = (),
+    top_k: int = 10
+) -> List[RegulationChunk]:
+    """
+    チャンクを関連度順に並べる
+
+    pinned_citations の項のチャンクを先頭に、次にその下位の項（例: "§ 736.2(b)(4)" → (b)(4)(i) 等）のうち
+    クエリのBM25検索で一致したもの、検索の上位、残りを本文の順に並べる。
+
+    Args:
+        chunks: チャンク
+        search_index: chunks のBM25検索
+        query: 品目・仕向地・用途等
+        pinned_citations: 必ず先頭に置く引用
+        top_k: BM25検索で取得する件数
+
+    Returns:
+        並べ替えたチャンク
+    """
+    order: Dict[int, None] = {}
+    for citation in pinned_citations:
+        for i, chunk in enumerate(chunks):
+            if chunk.citation == citation:
+                order.setdefault(i, None)
+    hits = [doc_id for doc_id, score in search_index.search(query, top_k=top_k) if score > 0]
+    for doc_id in hits:
+        if any(chunks[doc_id].citation.startswith(citation + "(") for citation in pinned_citations):
+            order.setdefault(doc_id, None)
+    for doc_id in hits:
+        order.setdefault(doc_id, None)
+    for i in range(len(chunks)):
+        order.setdefault(i, None)
+    return [chunks[i] for i in order]
+
+
+def _batches(items: Sequence[Any], size: int) -> Iterable[Sequence[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def ingest_regulations(
+    index,
+    client,
+    chunks: Sequence[RegulationChunk],
+    model: str,
+    dimensions: Optional[int] = None,
+    namespace: str = REGULATION_NAMESPACE,
+    dry_run: bool = False
+) -> Dict[str, int]:
+    """
+    チャンクをベクトルストアに差分登録
+
+    保存済みのチャンクのハッシュと比べ、新規・変更のチャンクだけを EMBED_BATCH_SIZE 件ずつembeddingして登録する。
+    取り込んだ出典のうち、今回のチャンクに無いIDはストアから削除する。
+
+    Args:
+        index: ベクトルストア（PineconeのIndex互換）
+        client: OpenAIクライアント
+        chunks: 登録するチャンク
+        model: embeddingモデル名
+        dimensions: embeddingの次元数
+        namespace: 登録先のnamespace
+        dry_run: 差分の集計のみ（embedding・登録・削除はしない）
+
+    Returns:
+        {"chunks", "unchanged", "embedded", "deleted"} の件数
+    """
+    from embedding_cache import cached_embeddings
+
+    hashes = {chunk.id: chunk.content_hash(model, dimensions) for chunk in chunks}
+    stored: Dict[str, Optional[str]] = {}
+    for ids in _batches(list(hashes), FETCH_BATCH_SIZE):
+        fetched = index.fetch(ids=list(ids), namespace=namespace)
+        for record_id, vector in fetched.vectors.items():
+            stored[record_id] = (vector.metadata or {}).get("content_hash")
+    changed = [chunk for chunk in chunks if stored.get(chunk.id) != hashes[chunk.id]]
+
+    # 取り込んだ出典の保存済みIDのうち、今回のチャンクに無いもの
+    stale = []
+    for source in sorted({chunk.source for chunk in chunks}):
+        for ids in index.list(namespace=namespace, prefix=f"{source}#"):
+            stale.extend(record_id for record_id in ids if record_id not in hashes)
+
+    report = {"chunks": len(chunks), "unchanged": len(chunks) - len(changed), "embedded": len(changed), "deleted": len(stale)}
+    if dry_run:
+        return report
+
+    records = []
+    for batch in _batches(changed, EMBED_BATCH_SIZE):
+        vectors = cached_embeddings(client, [chunk.content for chunk in batch], model, dimensions, label="ingest:regulations")
+        records.extend(
+            {
+                "id": chunk.id,
+                "values": vector.tolist(),
+                "metadata": {
+                    "citation": chunk.citation,
+                    "section": chunk.section,
+                    "section_title": chunk.section_title,
+                    "heading": chunk.heading,
+                    "text": chunk.text,
+                    "source": chunk.source,
+                    "content_hash": hashes[chunk.id],
+                },
+            }
+            for chunk, vector in zip(batch, vectors)
+        )
+    for batch in _batches(records, UPSERT_BATCH_SIZE):
+        index.upsert(vectors=list(batch), namespace=namespace)
+    if stale:
+        for ids in _batches(stale, UPSERT_BATCH_SIZE):
+            index.delete(ids=list(ids), namespace=namespace)
+    return report
+
+
+def _main(argv: List[str]) -> int:
+    from dotenv import load_dotenv
+
+    command = argv[0] if argv else ""
+    options = {"--store": None}
+    paths = []
+    rest = argv[1:]
+    while rest:
+        arg = rest.pop(0)
+        if arg in options:
+            options[arg] = rest.pop(0)
+        elif arg.startswith("--"):
+            options[arg] = True
+        else:
+            paths.append(Path(arg))
+    chunks = load_regulation_chunks(paths or REGULATION_FILES)
+
+    if command == "chunks":
+        for chunk in chunks:
+            print(f"{count_tokens(chunk.content):>5}  {chunk.citation}  {chunk.heading[:60]}")
+        print(f"\n{len(chunks)} chunks")
+        return 0
+    if command == "ingest":
+        load_dotenv()
+        from openai_client import get_openai_client
+        from vector_store import EMBEDDING_DIMENSIONS, EMBEDDING_MODEL, open_vector_index
+
+        report = ingest_regulations(
+            open_vector_index(options["--store"]),
+            get_openai_client(),
+            chunks,
+            EMBEDDING_MODEL,
+            EMBEDDING_DIMENSIONS,
+            dry_run=bool(options.get("--dry-run"))
+        )
+        print(f"{report['chunks']} chunks: {report['unchanged']} unchanged, "
+              f"{report['embedded']} embedded, {report['deleted']} deleted" + (" (dry run)" if options.get("--dry-run") else ""))
+        return 0
+    print(__doc__)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,205 @@
+"""
+チャット相談のセマンティックキャッシュ
+品目・仕向地・追加情報をembeddingし、言い回しが違うだけの過去の質問には保存済みの分析結果を返す
+
+環境変数:
+    SEMANTIC_CACHE_ENABLED      0 で無効化（既定: 1）
+    SEMANTIC_CACHE_THRESHOLD    キャッシュを返すコサイン類似度の下限（既定: 0.92）
+    SEMANTIC_CACHE_MAX_ENTRIES  保存する最大件数（既定: 500）
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from country_index import normalize_country_name, resolve_country
+from data_registry import BASE_DIR, get_registry
+from telemetry import call_label
+
+CACHE_PATH = BASE_DIR / ".cache" / "semantic_chat_cache.sqlite3"
+EMBEDDING_MODEL = "text-embedding-3-small"
+DEFAULT_THRESHOLD = 0.92
+DEFAULT_MAX_ENTRIES = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scope TEXT NOT NULL,
+    data_version TEXT,
+    query TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_answers_scope ON answers(scope);
+"""
+
+
+def build_chat_query(product: str, destination: str, additional_info: str = "") -> str:
+    """チャット相談の入力をembedding用の1つのテキストにまとめる"""
+    parts = [f"Product: {product.strip()}", f"Destination: {(destination or '').strip() or 'Not specified'}"]
+    if additional_info and additional_info.strip():
+        parts.append(f"Additional: {additional_info.strip()}")
+    return "\n".join(parts)
+
+
+def chat_cache_scope(destination: str) -> str:
+    """
+    キャッシュの照合範囲（仕向地）を取得
+
+    仕向地が異なる質問は類似度に関係なく別扱いにする（"Vietnam" と "ベトナム" は同じ国ID）。
+    """
+    destination = (destination or '').strip()
+    if not destination:
+        return ""
+    return resolve_country(destination) or normalize_country_name(destination)
+
+
+def embed_text(client, text: str) -> np.ndarray:
+    """テキストをembeddingし、正規化したベクトルを返す"""
+    with call_label("chat:semantic_cache"):
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    embeddingの類似度で過去の分析結果を引くキャッシュ
+
+    回答はSQLiteに保存し、照合用のベクトルは照合範囲（仕向地）ごとにメモリ上の行列として保持する。
+    参照データのバージョンが変わった場合、旧バージョンの回答は破棄する。
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, threshold: float = DEFAULT_THRESHOLD, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data_version: Optional[str] = None
+        # 照合範囲 → (回答ID配列, ベクトル行列)
+        self._vectors: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def sync_data_version(self, version: str):
+        """参照データのバージョンを通知し、異なるバージョンの回答を破棄"""
+        if version == self._data_version:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE data_version IS NOT ?", (version,))
+            self._conn.commit()
+            self._data_version = version
+            self._vectors = {}
+
+    def _scope_vectors(self, scope: str) -> Tuple[np.ndarray, np.ndarray]:
+        """照合範囲のベクトル行列を取得（初回のみSQLiteから読み込む）"""
+        cached = self._vectors.get(scope)
+        if cached is None:
+            rows = self._conn.execute("SELECT id, embedding FROM answers WHERE scope = ?", (scope,)).fetchall()
+            ids = np.array([row[0] for row in rows], dtype=np.int64)
+            matrix = (
+                np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+                if rows else np.zeros((0, 0), dtype=np.float32)
+            )
+            cached = self._vectors[scope] = (ids, matrix)
+        return cached
+
+    def lookup(self, embedding: np.ndarray, scope: str) -> Optional[Dict]:
+        """
+        類似度が閾値以上の過去の回答を取得
+
+        Args:
+            embedding: 正規化済みのクエリベクトル
+            scope: 照合範囲（chat_cache_scope の戻り値）
+
+        Returns:
+            {"answer", "query", "similarity", "created_at"}（該当が無ければNone）
+        """
+        with self._lock:
+            ids, matrix = self._scope_vectors(scope)
+            if len(ids) == 0 or matrix.shape[1] != embedding.shape[0]:
+                self.misses += 1
+                return None
+            similarities = matrix @ embedding
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            row = self._conn.execute(
+                "SELECT query, answer, created_at FROM answers WHERE id = ?", (int(ids[best]),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {"query": row[0], "answer": row[1], "similarity": similarity, "created_at": row[2]}
+
+    def add(self, embedding: np.ndarray, scope: str, query: str, answer: str):
+        """回答を保存し、上限を超えた分を古い順に削除"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (scope, data_version, query, answer, embedding, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (scope, self._data_version, query, answer, embedding.astype(np.float32).tobytes(), time.time())
+            )
+            deleted = self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+            self._conn.commit()
+            if deleted:
+                self._vectors = {}
+            else:
+                self._vectors.pop(scope, None)
+
+    def clear(self):
+        """保存済みの回答をすべて削除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+            self._vectors = {}
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict:
+        """件数・閾値・ヒット/ミス数を取得"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_cache: Optional[SemanticCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """プロセス全体で共有されるセマンティックキャッシュを取得（無効化されている場合はNone）"""
+    global _cache
+    if os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "0":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticCache(
+                    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+                    max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+                )
+    _cache.sync_data_version(get_registry().version)
+    return _cache
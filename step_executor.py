@@ -0,0 +1,195 @@
+"""
+分析ステップの並行実行
+依存関係の無いGPT呼び出しをスレッドプールで同時に実行し、ストリーミング中の途中経過と完了を呼び出し元へ通知する
+"""
+
+import contextvars
+import queue
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# 同時に実行するGPT呼び出しの上限
+MAX_PARALLEL_STEPS = 6
+
+# ストリーミング中の途中経過を通知する間隔（秒）。トークンはこの間隔でまとめて描画する
+PROGRESS_INTERVAL = 0.05
+
+
+@dataclass
+class AnalysisStep:
+    """
+    分析ステップの定義
+
+    build_prompt は完了済みステップの結果（キー → 本文）を受け取ってプロンプトを返す。
+    Noneを返した場合、そのステップはスキップされる（例: 仕向地未入力時のチャート分析）。
+    response_format を指定した場合はその形式（JSONモード等）で応答を要求する。
+    """
+    key: str
+    title: str
+    running_label: str
+    section: str
+    system_prompt: str
+    build_prompt: Callable[[Dict[str, str]], Optional[str]]
+    temperature: float = 0.3
+    max_tokens: int = 500
+    depends_on: Tuple[str, ...] = ()
+    requires: Tuple[str, ...] = ()
+    abort_on_error: bool = False
+    error_label: str = ""
+    response_format: Optional[Dict[str, Any]] = None
+
+
+@dataclass
+class StepResult:
+    """ステップの実行結果"""
+    key: str
+    content: Optional[str] = None
+    error: Optional[Exception] = None
+    skipped: bool = False
+    elapsed_ms: float = 0.0
+    first_token_ms: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.content is not None
+
+
+@dataclass
+class PipelineResult:
+    """パイプライン全体の実行結果（aborted: 中断が必要なステップが失敗した）"""
+    results: Dict[str, StepResult] = field(default_factory=dict)
+    aborted: bool = False
+    elapsed_ms: float = 0.0
+
+    def contents(self) -> Dict[str, str]:
+        """成功したステップのキー → 本文"""
+        return {key: result.content for key, result in self.results.items() if result.ok}
+
+    @property
+    def complete(self) -> bool:
+        """中断されず、スキップ以外のすべてのステップが成功した（requires の失敗によるスキップは失敗したステップで判定）"""
+        return not self.aborted and all(result.error is None for result in self.results.values())
+
+
+def join_sections(steps: Sequence[AnalysisStep], contents: Dict[str, str]) -> str:
+    """
+    成功したステップの本文を定義順に連結（完了順に関係なく同じ順序になる）
+
+    Args:
+        steps: ステップ定義
+        contents: キー → 本文
+
+    Returns:
+        "見出し\\n本文\\n\\n" を連結したテキスト
+    """
+    return ''.join(
+        f"{step.section}\n{contents[step.key]}\n\n"
+        for step in steps
+        if step.key in contents
+    )
+
+
+def run_steps(
+    steps: Sequence[AnalysisStep],
+    call_model: Callable[[AnalysisStep, str, Callable[[str], None]], str],
+    on_done: Optional[Callable[[AnalysisStep, StepResult], None]] = None,
+    on_progress: Optional[Callable[[AnalysisStep, str], None]] = None,
+    max_workers: int = MAX_PARALLEL_STEPS
+) -> PipelineResult:
+    """
+    依存関係を満たしたステップから並行に実行
+
+    プロンプトの組み立てと on_done・on_progress の呼び出しは呼び出し元のスレッドで行い、
+    ワーカースレッドでは call_model（GPT呼び出し）のみを実行する。
+
+    Args:
+        steps: ステップ定義（依存先は先に定義されていること）
+        call_model: (ステップ, プロンプト, on_token) → 応答本文。ストリーミング時は
+            受信したトークンごとに on_token(差分) を呼ぶ。例外はステップのエラーとして記録
+        on_done: ステップ完了・スキップ・失敗のたびに呼ばれるコールバック
+        on_progress: ストリーミング中に (ステップ, これまでの本文) で呼ばれるコールバック
+        max_workers: 同時実行数の上限
+
+    Returns:
+        パイプラインの実行結果
+    """
+    pipeline = PipelineResult()
+    pending: List[AnalysisStep] = list(steps)
+    running: Dict[Future, Tuple[AnalysisStep, float]] = {}
+    tokens: "queue.Queue[Tuple[str, str, float]]" = queue.Queue()
+    streamed: Dict[str, List[str]] = {}
+    first_token_at: Dict[str, float] = {}
+    steps_by_key = {step.key: step for step in steps}
+    start = time.perf_counter()
+
+    def token_sink(key: str) -> Callable[[str], None]:
+        # ワーカースレッドから呼ばれるため、キューに積むだけにする
+        return lambda delta: tokens.put((key, delta, time.perf_counter()))
+
+    def drain_tokens():
+        updated = []
+        while True:
+            try:
+                key, delta, received_at = tokens.get_nowait()
+            except queue.Empty:
+                break
+            first_token_at.setdefault(key, received_at)
+            streamed.setdefault(key, []).append(delta)
+            if key not in updated:
+                updated.append(key)
+        if on_progress is not None:
+            for key in updated:
+                on_progress(steps_by_key[key], ''.join(streamed[key]))
+
+    def finish(step: AnalysisStep, result: StepResult):
+        pipeline.results[step.key] = result
+        if on_done is not None:
+            on_done(step, result)
+        if result.error is not None and step.abort_on_error:
+            pipeline.aborted = True
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-step")
+    try:
+        while (pending or running) and not pipeline.aborted:
+            # 依存先がすべて完了したステップを投入
+            for step in [s for s in pending if all(dep in pipeline.results for dep in s.depends_on + s.requires)]:
+                pending.remove(step)
+                if not all(pipeline.results[dep].ok for dep in step.requires):
+                    finish(step, StepResult(step.key, skipped=True))
+                    continue
+                prompt = step.build_prompt(pipeline.contents())
+                if prompt is None:
+                    finish(step, StepResult(step.key, skipped=True))
+                    continue
+                # 呼び出し元のコンテキスト（計測のトレース等）をワーカースレッドに引き継ぐ
+                context = contextvars.copy_context()
+                future = executor.submit(context.run, call_model, step, prompt, token_sink(step.key))
+                running[future] = (step, time.perf_counter())
+
+            if not running:
+                if pending and not pipeline.aborted:
+                    raise ValueError(f"依存関係を解決できないステップがあります: {[s.key for s in pending]}")
+                continue
+
+            done, _ = wait(list(running), timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            drain_tokens()
+            # 同時に完了したステップは定義順に通知
+            for future in sorted(done, key=lambda f: steps.index(running[f][0])):
+                step, submitted_at = running.pop(future)
+                elapsed_ms = (time.perf_counter() - submitted_at) * 1000
+                first_token_ms = None
+                if step.key in first_token_at:
+                    first_token_ms = (first_token_at[step.key] - submitted_at) * 1000
+                try:
+                    result = StepResult(step.key, content=future.result(), elapsed_ms=elapsed_ms, first_token_ms=first_token_ms)
+                except Exception as e:
+                    result = StepResult(step.key, error=e, elapsed_ms=elapsed_ms, first_token_ms=first_token_ms)
+                finish(step, result)
+    finally:
+        # 中断時は未着手のステップを取り消し、実行中の呼び出しは待たずに戻る
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    pipeline.elapsed_ms = (time.perf_counter() - start) * 1000
+    return pipeline
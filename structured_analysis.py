@@ -0,0 +1,296 @@
+"""
+1回の構造化出力による分析（シングルパス）
+段階的分析の各ステップで得ていた判定をJSONスキーマに沿った1つの応答で受け取り、同じセクションのMarkdownに整形する
+"""
+
+import json
+import re
+from typing import Any, Callable, Dict, List, Sequence
+
+# JSONモードの応答形式（gpt-4-turbo-preview は json_schema 形式に未対応のため、スキーマはシステムプロンプトで指示する）
+RESPONSE_FORMAT = {"type": "json_object"}
+
+_STRING = {"type": "string"}
+_STRINGS = {"type": "array", "items": _STRING}
+
+# フィールド名 → JSONスキーマ（分析の種類ごとに必要なフィールドだけを指示する）
+FIELD_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "contract_info": {
+        "type": "object",
+        "properties": {
+            "product_name": _STRING,
+            "us_origin": _STRING,
+            "destination": _STRING,
+            "end_user": _STRING,
+            "end_use": _STRING,
+            "contract_value": _STRING,
+            "delivery_date": _STRING,
+        },
+    },
+    "ear_applicability": {
+        "type": "object",
+        "properties": {
+            "us_origin_items": _STRING,
+            "incorporated_us_content": _STRING,
+            "foreign_direct_product": _STRING,
+            "determination": _STRING,
+        },
+    },
+    "eccn": {
+        "type": "object",
+        "properties": {
+            "eccn": {"type": "string", "description": "5-character ECCN such as 3A001, or EAR99"},
+            "category": _STRING,
+            "group": _STRING,
+            "reasons_for_control": _STRINGS,
+            "rationale": _STRING,
+        },
+    },
+    "country_chart": {
+        "type": "object",
+        "properties": {
+            "destination": _STRING,
+            "reasons": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"reason": _STRING, "license_required": {"type": "boolean"}},
+                },
+            },
+            "determination": {
+                "type": "string",
+                "enum": ["License Required", "License Exception Available", "No License Required"],
+            },
+        },
+    },
+    "license_exceptions": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"exception": _STRING, "conditions": _STRING, "rationale": _STRING},
+        },
+    },
+    "general_prohibitions": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "id": {"type": "string", "description": "GP4, GP5, ... or the list checked (DPL, Entity List, MEU List)"},
+                "title": _STRING,
+                "applies": {"type": "string", "enum": ["Yes", "No", "Unclear"]},
+                "notes": _STRING,
+            },
+        },
+    },
+    "risk": {
+        "type": "object",
+        "properties": {
+            "determination": {
+                "type": "string",
+                "enum": ["License Required", "License Exception Available", "No License Required"],
+            },
+            "risk_level": {"type": "string", "enum": ["High", "Medium", "Low"]},
+            "license_application": {"type": "string", "enum": ["Required", "To be confirmed", "Not required"]},
+            "warnings": _STRINGS,
+            "recommended_actions": _STRINGS,
+        },
+    },
+    "procedures": _STRINGS,
+}
+
+_CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+
+def build_schema(fields: Sequence[str]) -> Dict[str, Any]:
+    """
+    指定したフィールドだけを持つ応答のJSONスキーマを組み立てる
+
+    Args:
+        fields: FIELD_SCHEMAS のフィールド名（応答に含める順）
+
+    Returns:
+        JSONスキーマ
+    """
+    return {
+        "type": "object",
+        "properties": {name: FIELD_SCHEMAS[name] for name in fields},
+        "required": list(fields),
+    }
+
+
+def build_system_prompt(expert: str, fields: Sequence[str]) -> str:
+    """JSONスキーマを含むシングルパス分析用のシステムプロンプトを作成"""
+    schema = json.dumps(build_schema(fields), ensure_ascii=False, separators=(",", ":"))
+    return (
+        f"{expert}"
+        "Respond with a single JSON object that conforms to this JSON Schema and nothing else. "
+        "Use an empty string or empty array when information is not available.\n"
+        f"{schema}"
+    )
+
+
+def parse_structured_analysis(text: str) -> Dict[str, Any]:
+    """
+    シングルパス分析の応答をJSONとして読み込む
+
+    Args:
+        text: モデルの応答本文
+
+    Returns:
+        フィールド名 → 値
+
+    Raises:
+        ValueError: JSONオブジェクトとして読めない場合
+    """
+    try:
+        data = json.loads(_CODE_FENCE.sub("", text or ""))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"構造化出力をJSONとして読み込めません: {str(e)}") from e
+    if not isinstance(data, dict):
+        raise ValueError("構造化出力がJSONオブジェクトではありません")
+    return data
+
+
+def _value(value: Any) -> str:
+    if isinstance(value, bool):
+        return "Yes" if value else "No"
+    if value is None or value == "" or value == []:
+        return "Not provided"
+    if isinstance(value, list):
+        return ", ".join(str(item) for item in value)
+    return str(value)
+
+
+def _object(data: Any) -> Dict[str, Any]:
+    return data if isinstance(data, dict) else {}
+
+
+def _items(data: Any) -> List[Any]:
+    return data if isinstance(data, list) else []
+
+
+def _bullets(items: Sequence[Any], numbered: bool = False) -> str:
+    if not items:
+        return "- Not provided"
+    return "\n".join(f"{f'{i}.' if numbered else '-'} {_value(item)}" for i, item in enumerate(items, 1))
+
+
+def _render_contract_info(data: Any) -> str:
+    info = _object(data)
+    return "\n".join([
+        f"- **Product Name**: {_value(info.get('product_name'))} (US-origin: {_value(info.get('us_origin'))})",
+        f"- **Re-export Destination**: {_value(info.get('destination'))}",
+        f"- **End User**: {_value(info.get('end_user'))}",
+        f"- **End Use**: {_value(info.get('end_use'))}",
+        f"- **Contract Value**: {_value(info.get('contract_value'))}",
+        f"- **Delivery Date**: {_value(info.get('delivery_date'))}",
+    ])
+
+
+def _render_ear_applicability(data: Any) -> str:
+    info = _object(data)
+    return "\n".join([
+        f"- **US-origin items**: {_value(info.get('us_origin_items'))}",
+        f"- **Incorporated US content**: {_value(info.get('incorporated_us_content'))}",
+        f"- **Foreign Direct Product rule**: {_value(info.get('foreign_direct_product'))}",
+        f"- **Determination**: {_value(info.get('determination'))}",
+    ])
+
+
+def _render_eccn(data: Any) -> str:
+    info = _object(data)
+    return "\n".join([
+        f"- **推定ECCN番号**: {_value(info.get('eccn'))}",
+        f"- **Category**: {_value(info.get('category'))}",
+        f"- **Group**: {_value(info.get('group'))}",
+        f"- **Reason for Control**: {_value(info.get('reasons_for_control'))}",
+        f"- **Selection Rationale**: {_value(info.get('rationale'))}",
+    ])
+
+
+def _render_country_chart(data: Any) -> str:
+    info = _object(data)
+    lines = [f"- **Destination**: {_value(info.get('destination'))}"]
+    reasons = [_object(reason) for reason in _items(info.get('reasons'))]
+    if reasons:
+        lines.append("- **License requirement by reason for control**:")
+        lines.extend(
+            f"  - {_value(reason.get('reason'))}: {'X (license required)' if reason.get('license_required') else 'not marked'}"
+            for reason in reasons
+        )
+    lines.append(f"- **Overall Determination**: {_value(info.get('determination'))}")
+    return "\n".join(lines)
+
+
+def _render_license_exceptions(data: Any) -> str:
+    exceptions = [_object(item) for item in _items(data)]
+    if not exceptions:
+        return "- No applicable license exceptions identified"
+    return "\n".join(
+        f"- **{_value(item.get('exception'))}**: {_value(item.get('conditions'))}\n  - Rationale: {_value(item.get('rationale'))}"
+        for item in exceptions
+    )
+
+
+def _render_general_prohibitions(data: Any) -> str:
+    checks = [_object(item) for item in _items(data)]
+    if not checks:
+        return "- Not provided"
+    marks = {"Yes": "⚠️ Applies", "No": "✅ Does not apply", "Unclear": "❓ Unclear"}
+    return "\n".join(
+        f"**{_value(item.get('id'))}: {_value(item.get('title'))}** — {marks.get(item.get('applies'), _value(item.get('applies')))}\n"
+        f"- {_value(item.get('notes'))}"
+        for item in checks
+    )
+
+
+def _render_assessment(data: Any) -> str:
+    info = _object(data)
+    return "\n".join([
+        f"- **US EAR Determination**: {_value(info.get('determination'))}",
+        f"- **Risk Level**: {_value(info.get('risk_level'))}",
+        f"- **License Application Requirement**: {_value(info.get('license_application'))}",
+        "",
+        "**Warnings**:",
+        _bullets(_items(info.get('warnings'))),
+        "",
+        "**Recommended Actions**:",
+        _bullets(_items(info.get('recommended_actions')), numbered=True),
+    ])
+
+
+def _render_procedures(data: Any) -> str:
+    return _bullets(_items(data), numbered=True)
+
+
+# フィールド名 → Markdown整形関数
+SECTION_RENDERERS: Dict[str, Callable[[Any], str]] = {
+    "contract_info": _render_contract_info,
+    "ear_applicability": _render_ear_applicability,
+    "eccn": _render_eccn,
+    "country_chart": _render_country_chart,
+    "license_exceptions": _render_license_exceptions,
+    "general_prohibitions": _render_general_prohibitions,
+    "risk": _render_assessment,
+    "procedures": _render_procedures,
+}
+
+
+def render_sections(data: Dict[str, Any], section_fields: Dict[str, str], skip: Sequence[str] = ()) -> Dict[str, str]:
+    """
+    構造化出力を段階的分析と同じセクションのMarkdownに整形
+
+    Args:
+        data: parse_structured_analysis の戻り値
+        section_fields: ステップキー → フィールド名
+        skip: 出力しないステップキー（例: 仕向地未入力時のカントリーチャート）
+
+    Returns:
+        ステップキー → Markdown（join_sections にそのまま渡せる）
+    """
+    return {
+        key: SECTION_RENDERERS[field](data.get(field))
+        for key, field in section_fields.items()
+        if key not in skip
+    }
+
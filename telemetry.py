@@ -0,0 +1,250 @@
+"""
+LLM・embedding・ベクトル検索の呼び出し計測
+呼び出しごとの所要時間・待ち時間・トークン数・概算コストを記録し、分析（トレース）単位で集計する。
+記録はJSONLファイルにも1行ずつ書き出す（オフライン分析用）。
+
+トレースと呼び出しラベルは contextvars で伝播する。step_executor はワーカースレッドにコンテキストを引き継ぐため、
+並行実行されたステップの呼び出しも呼び出し元のトレースに集計される。
+
+環境変数:
+    TELEMETRY_LOG_PATH  記録の書き出し先（既定: .cache/llm_calls.jsonl）
+    TELEMETRY_LOG       0 でファイルへの書き出しを無効化（画面の集計は常に有効）
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from data_registry import BASE_DIR
+from prompt_budget import count_tokens
+
+LOG_PATH = BASE_DIR / ".cache" / "llm_calls.jsonl"
+
+# モデル → (入力, 出力) の料金（USD / 100万トークン）。未登録のモデルはコスト0として扱う
+MODEL_PRICES_PER_M = {
+    "gpt-4-turbo-preview": (10.0, 30.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+
+def estimate_cost(model: Optional[str], prompt_tokens: int, completion_tokens: int = 0) -> float:
+    """
+    トークン数から概算コスト（USD）を計算
+
+    Args:
+        model: モデル名
+        prompt_tokens: 入力トークン数
+        completion_tokens: 出力トークン数
+
+    Returns:
+        概算コスト（料金が未登録のモデルは0）
+    """
+    input_price, output_price = MODEL_PRICES_PER_M.get(model or "", (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def count_message_tokens(messages: Optional[Sequence[Dict[str, Any]]]) -> int:
+    """chatメッセージの本文のトークン数（メッセージごとのオーバーヘッドは含まない概算）"""
+    return sum(count_tokens(message.get("content") or "") for message in messages or [])
+
+
+@dataclass
+class CallRecord:
+    """1回の呼び出しの計測結果（kind: "chat" / "embedding" / "vector_query"）"""
+    kind: str
+    label: str
+    model: Optional[str]
+    wall_ms: float
+    queue_ms: float = 0.0
+    first_token_ms: Optional[float] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0.0
+    cached: bool = False
+    retries: int = 0
+    error: Optional[str] = None
+    trace_id: Optional[str] = None
+    trace_name: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+class Trace:
+    """1回の分析で発生した呼び出しの集計"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.records: List[CallRecord] = []
+        self.started_at = time.perf_counter()
+        self.elapsed_ms: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add(self, record: CallRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def totals(self) -> Dict[str, Any]:
+        """呼び出し数・トークン数・コスト・分析全体の所要時間"""
+        with self._lock:
+            records = list(self.records)
+        elapsed_ms = self.elapsed_ms if self.elapsed_ms is not None else (time.perf_counter() - self.started_at) * 1000
+        return {
+            "calls": len(records),
+            "cached": sum(1 for r in records if r.cached),
+            "errors": sum(1 for r in records if r.error),
+            "prompt_tokens": sum(r.prompt_tokens for r in records),
+            "completion_tokens": sum(r.completion_tokens for r in records),
+            "cost_usd": sum(r.cost_usd for r in records),
+            "call_ms": sum(r.wall_ms for r in records),
+            "elapsed_ms": elapsed_ms,
+        }
+
+    def by_label(self) -> List[Dict[str, Any]]:
+        """ラベル（ステップ）ごとの集計（最初に呼ばれた順）"""
+        groups: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            records = list(self.records)
+        for r in records:
+            group = groups.setdefault(r.label, {
+                "label": r.label, "kinds": [], "calls": 0, "wall_ms": 0.0, "queue_ms": 0.0, "first_token_ms": None,
+                "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "cached": 0, "retries": 0, "errors": 0,
+            })
+            if r.kind not in group["kinds"]:
+                group["kinds"].append(r.kind)
+            group["calls"] += 1
+            group["wall_ms"] += r.wall_ms
+            group["queue_ms"] += r.queue_ms
+            if r.first_token_ms is not None and group["first_token_ms"] is None:
+                group["first_token_ms"] = r.first_token_ms
+            group["prompt_tokens"] += r.prompt_tokens
+            group["completion_tokens"] += r.completion_tokens
+            group["cost_usd"] += r.cost_usd
+            group["cached"] += int(r.cached)
+            group["retries"] += r.retries
+            group["errors"] += int(bool(r.error))
+        return list(groups.values())
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("telemetry_trace", default=None)
+_current_label: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("telemetry_label", default=None)
+_log_lock = threading.Lock()
+
+
+@contextmanager
+def trace(name: str) -> Iterator[Trace]:
+    """ブロック内の呼び出しを集計するトレースを開始"""
+    current = Trace(name)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current.elapsed_ms = (time.perf_counter() - current.started_at) * 1000
+        _current_trace.reset(token)
+
+
+@contextmanager
+def call_label(label: Optional[str]) -> Iterator[None]:
+    """ブロック内の呼び出しに付けるラベル（例: "contract:step2b"）を設定"""
+    token = _current_label.set(label)
+    try:
+        yield
+    finally:
+        _current_label.reset(token)
+
+
+def _write_log(record: CallRecord):
+    if os.getenv("TELEMETRY_LOG", "1") == "0":
+        return
+    path = Path(os.getenv("TELEMETRY_LOG_PATH", LOG_PATH))
+    try:
+        with _log_lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(asdict(record), ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"計測記録を書き出せません: {str(e)}")
+
+
+def record_call(
+    kind: str,
+    model: Optional[str],
+    wall_ms: float,
+    queue_ms: float = 0.0,
+    first_token_ms: Optional[float] = None,
+    prompt_tokens: int = 0,
+    completion_tokens: int = 0,
+    cached: bool = False,
+    retries: int = 0,
+    error: Optional[str] = None,
+    label: Optional[str] = None
+) -> CallRecord:
+    """
+    呼び出しの計測結果を現在のトレースに追加し、ファイルに書き出す
+
+    Args:
+        kind: "chat" / "embedding" / "vector_query"
+        model: モデル名（コストの計算に使う）
+        wall_ms: 呼び出し全体の所要時間（待ち時間・再試行を含む）
+        queue_ms: 同時実行数の枠を待った時間
+        first_token_ms: ストリーミング時の最初のトークンまでの時間
+        prompt_tokens: 入力トークン数
+        completion_tokens: 出力トークン数
+        cached: キャッシュから返した（コスト0）
+        retries: 再試行の回数
+        error: 失敗した場合のエラー
+        label: ラベル（省略時は call_label で設定された値）
+
+    Returns:
+        記録
+    """
+    current = _current_trace.get()
+    record = CallRecord(
+        kind=kind,
+        label=label or _current_label.get() or kind,
+        model=model,
+        wall_ms=wall_ms,
+        queue_ms=queue_ms,
+        first_token_ms=first_token_ms,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost_usd=0.0 if cached else estimate_cost(model, prompt_tokens, completion_tokens),
+        cached=cached,
+        retries=retries,
+        error=error,
+        trace_id=current.trace_id if current else None,
+        trace_name=current.name if current else None,
+    )
+    if current is not None:
+        current.add(record)
+    _write_log(record)
+    return record
+
+
+@contextmanager
+def measure(kind: str, label: Optional[str] = None, model: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    ブロックの所要時間を計測して記録（SDKラッパーを経由しない呼び出し用。例: Pineconeの検索）
+
+    ブロック内で yield された辞書に prompt_tokens 等を設定すると記録に含める。
+    """
+    details: Dict[str, Any] = {}
+    start = time.perf_counter()
+    error = None
+    try:
+        yield details
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        record_call(kind, model, (time.perf_counter() - start) * 1000, error=error, label=label, **details)
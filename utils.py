@@ -9,6 +9,10 @@ from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 import pandas as pd
 
+from country_index import get_country_alias_index
+from data_registry import get_registry, get_reference_data
+from eccn_index import get_eccn_code_trie, get_eccn_lookup_table, get_eccn_search_index, is_eccn_pattern
+
 def extract_contract_info(text: str) -> Dict[str, str]:
     """
     Extract key information from contract text
@@ -60,6 +64,25 @@ def extract_contract_info(text: str) -> Dict[str, str]:
     
     return info
 
+def _build_country_group_rows(df: Optional[pd.DataFrame]) -> Dict[str, Dict]:
+    """カントリーリストを 国ID → 行（辞書） に変換（同じ国の行が複数あれば先頭を採用）"""
+    rows: Dict[str, Dict] = {}
+    if df is None or df.empty or '国名' not in df.columns:
+        return rows
+    aliases = get_country_alias_index()
+    for row in df.fillna('').to_dict('records'):
+        country_id = aliases.resolve(str(row['国名']))
+        if country_id is not None:
+            rows.setdefault(country_id, row)
+    return rows
+
+def _country_group_rows(df: Optional[pd.DataFrame]) -> Dict[str, Dict]:
+    """カントリーリストの 国ID → 行（共有データの場合はバージョンごとに一度だけ構築）"""
+    registry = get_registry()
+    if df is not None and df is registry.get().get('countries'):
+        return registry.get_derived("country_group_rows", lambda data: _build_country_group_rows(data.get('countries')))
+    return _build_country_group_rows(df)
+
 def check_group_a_country(country: str, df: Optional[pd.DataFrame] = None) -> bool:
     """
     国がグループA国（旧ホワイト国）かどうかを判定
@@ -85,18 +108,35 @@ def check_group_a_country(country: str, df: Optional[pd.DataFrame] = None) -> bo
         "Spain", "Sweden", "Switzerland", "United Kingdom", "UK", "United States", "USA", "South Korea"
     ]
     
-    if df is not None:
-        # DataFrameから確認
-        matching_rows = df[df['国名'].str.contains(country, case=False, na=False)]
-        if not matching_rows.empty:
-            return matching_rows.iloc[0].get('グループA', '') == '○'
-    
-    # デフォルトリストから確認
-    for ga_country in group_a_countries:
-        if ga_country.lower() in country.lower() or country.lower() in ga_country.lower():
-            return True
-    
-    return False
+    aliases = get_country_alias_index()
+    country_id = aliases.resolve(country)
+    if country_id is None:
+        return False
+
+    # カントリーリストに該当国があればその区分を優先
+    row = _country_group_rows(df).get(country_id)
+    if row is not None:
+        return row.get('グループA', '') == '○'
+
+    # デフォルトリストから確認（国IDで比較するため "Niger" と "Nigeria" 等を取り違えない）
+    return country_id in {aliases.resolve(name) for name in group_a_countries}
+
+def _concern_type(country_id: str, df: Optional[pd.DataFrame], concern_countries: Dict[str, str], aliases) -> Optional[str]:
+    """国IDの懸念の種類（懸念国でなければNone）"""
+    row = _country_group_rows(df).get(country_id)
+    if row is not None:
+        concerns = []
+        if row.get('国連武器禁輸', '') == '○':
+            concerns.append("国連武器禁輸国")
+        if row.get('懸念国', '') == '○':
+            concerns.append("懸念国")
+        if concerns:
+            return "・".join(concerns)
+
+    for concern_country, concern_type in concern_countries.items():
+        if aliases.resolve(concern_country) == country_id:
+            return concern_type
+    return None
 
 def check_concern_country(country: str, df: Optional[pd.DataFrame] = None) -> Tuple[bool, str]:
     """
@@ -108,6 +148,7 @@ def check_concern_country(country: str, df: Optional[pd.DataFrame] = None) -> Tu
         
     Returns:
         (懸念国の場合True, 懸念の種類)
+        国名が曖昧な場合（"Korea" 等）は、候補に懸念国があればTrueと候補の懸念の種類
     """
     concern_countries = {
         "北朝鮮": "国連武器禁輸国・懸念国",
@@ -122,34 +163,43 @@ def check_concern_country(country: str, df: Optional[pd.DataFrame] = None) -> Tu
         "Cuba": "懸念国"
     }
     
-    if df is not None:
-        matching_rows = df[df['国名'].str.contains(country, case=False, na=False)]
-        if not matching_rows.empty:
-            row = matching_rows.iloc[0]
-            concerns = []
-            if row.get('国連武器禁輸', '') == '○':
-                concerns.append("国連武器禁輸国")
-            if row.get('懸念国', '') == '○':
-                concerns.append("懸念国")
-            if concerns:
-                return True, "・".join(concerns)
-    
-    for concern_country, concern_type in concern_countries.items():
-        if concern_country.lower() in country.lower() or country.lower() in concern_country.lower():
-            return True, concern_type
-    
-    return False, ""
+    aliases = get_country_alias_index()
+    country_id = aliases.resolve(country)
+    if country_id is not None:
+        concern_type = _concern_type(country_id, df, concern_countries, aliases)
+        return concern_type is not None, concern_type or ""
+
+    # 1つの国に決まらない国名（"Korea"・"朝鮮" 等）は、候補のいずれかが懸念国なら懸念国として扱う
+    concerns = []
+    for candidate in aliases.resolve_candidates(country):
+        concern_type = _concern_type(candidate, df, concern_countries, aliases)
+        if concern_type is not None:
+            concerns.append(f"{aliases.display_name(candidate)}: {concern_type}")
+    if not concerns:
+        return False, ""
+    return True, f"国名が曖昧です（懸念国の候補 {'、'.join(concerns)}）"
 
 def load_eccn_json(json_path: str = "eccnnumber.json") -> Optional[Dict]:
     """
     ECCN番号のJSONデータを読み込む
     
+    標準のeccnnumber.jsonはコンパイル済みスナップショット経由の共有データを返す
+    （読み取り専用として扱うこと）。
+    
     Args:
         json_path: JSONファイルのパス
         
     Returns:
         ECCN データの辞書
     """
+    registry = get_registry()
+    registry_json_path = registry.base_dir / registry.source_files['eccn_json']
+    try:
+        if Path(json_path).resolve() == registry_json_path.resolve():
+            return registry.get().get('eccn_json')
+    except OSError:
+        pass
+    
     try:
         with open(json_path, 'r', encoding='utf-8') as f:
             return json.load(f)
@@ -157,49 +207,80 @@ def load_eccn_json(json_path: str = "eccnnumber.json") -> Optional[Dict]:
         print(f"ECCN JSONファイルの読み込みエラー: {str(e)}")
         return None
 
-def search_eccn_json(keyword: str, eccn_data: Dict) -> List[Dict]:
+def _resolve_eccn_json(eccn_json: Optional[Dict]) -> Optional[Dict]:
+    """ECCN JSONが渡されなければ共有レジストリのデータを使用"""
+    if eccn_json is None:
+        return get_reference_data().get('eccn_json')
+    return eccn_json
+
+def search_eccn_json(keyword: str, eccn_data: Optional[Dict] = None, top_k: Optional[int] = None) -> List[Dict]:
     """
-    JSONデータからECCN番号を検索
+    JSONデータからECCN番号を検索（転置インデックス・BM25ランキング）
+    
+    "5A0*" や "x9xx" のようなワイルドカード付きのECCN番号パターンは番号順で返す。
     
     Args:
         keyword: 検索キーワード
-        eccn_data: ECCN JSONデータ
+        eccn_data: ECCN JSONデータ（省略時は共有レジストリのデータ）
+        top_k: 返す件数の上限（Noneの場合は一致した全件）
         
     Returns:
-        マッチしたECCN情報のリスト
+        マッチしたECCN情報のリスト（関連度の高い順）
     """
-    results = []
-    keyword_lower = keyword.lower()
+    eccn_data = _resolve_eccn_json(eccn_data)
     
     if not eccn_data or 'ccl_categories' not in eccn_data:
-        return results
+        return []
     
-    # 各カテゴリーを検索
-    for category in eccn_data['ccl_categories']:
-        category_number = category.get('category_number', '')
-        category_title = category.get('title', '')
+    # "5A0*" のようなECCN番号パターンはトライで検索
+    if is_eccn_pattern(keyword):
+        results = find_eccns_by_pattern(keyword, eccn_data)
+        return results if top_k is None else results[:top_k]
+    
+    index = get_eccn_search_index(eccn_data)
+    results = []
+    for doc_id, score in index.search(keyword, top_k=top_k):
+        record = index.records[doc_id]
+        results.append({
+            "ECCN番号": record['eccn'],
+            "カテゴリー": f"{record['category_number']} - {record['category_title']}",
+            "グループ": f"{record['group_letter']} - {record['group_title']}",
+            "説明": record['description']
+        })
+    
+    return results
+
+def find_eccns_by_pattern(pattern: str, eccn_json: Optional[Dict] = None) -> List[Dict]:
+    """
+    ECCN番号パターンで検索（ECCN番号トライを使用）
+    
+    例: "5A0*"（5A0で始まる番号）、"4D*"（カテゴリー4のソフトウェア）、"x9xx"（900番台）
+    
+    Args:
+        pattern: ECCN番号パターン（x / ? は任意の1文字、* は以降すべて）
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
         
-        # 各プロダクトグループを検索
-        for group in category.get('product_groups', []):
-            group_letter = group.get('group_letter', '')
-            group_title = group.get('group_title', '')
-            
-            # 各アイテムを検索
-            for item in group.get('items', []):
-                eccn = item.get('eccn', '')
-                description = item.get('description', '')
-                
-                # キーワードマッチング
-                if (keyword_lower in eccn.lower() or 
-                    keyword_lower in description.lower() or
-                    keyword_lower in category_title.lower()):
-                    
-                    results.append({
-                        "ECCN番号": eccn,
-                        "カテゴリー": f"{category_number} - {category_title}",
-                        "グループ": f"{group_letter} - {group_title}",
-                        "説明": description
-                    })
+    Returns:
+        マッチしたECCN情報のリスト（番号順、同じ欄に属する番号は1件にまとめる）
+    """
+    eccn_json = _resolve_eccn_json(eccn_json)
+    if not eccn_json or 'ccl_categories' not in eccn_json:
+        return []
+    
+    trie = get_eccn_code_trie(eccn_json)
+    results = []
+    seen = set()
+    for code, doc_id in trie.match(pattern):
+        if doc_id in seen:
+            continue
+        seen.add(doc_id)
+        record = trie.records[doc_id]
+        results.append({
+            "ECCN番号": record['eccn'],
+            "カテゴリー": f"{record['category_number']} - {record['category_title']}",
+            "グループ": f"{record['group_letter']} - {record['group_title']}",
+            "説明": record['description']
+        })
     
     return results
 
@@ -242,48 +323,45 @@ def search_eccn(keyword: str, df: pd.DataFrame = None, eccn_json: Dict = None) -
     
     return results
 
-def get_eccn_by_number(eccn_number: str, eccn_json: Dict) -> Optional[Dict]:
+def get_eccn_by_number(eccn_number: str, eccn_json: Optional[Dict] = None) -> Optional[Dict]:
     """
     ECCN番号から詳細情報を取得
     
     Args:
         eccn_number: ECCN番号（例: "5A002"）
-        eccn_json: ECCN JSONデータ
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
         
     Returns:
         ECCN情報の辞書
     """
+    eccn_json = _resolve_eccn_json(eccn_json)
     if not eccn_json or 'ccl_categories' not in eccn_json:
         return None
     
-    eccn_number_clean = eccn_number.strip().upper()
-    
-    for category in eccn_json['ccl_categories']:
-        for group in category.get('product_groups', []):
-            for item in group.get('items', []):
-                eccn = item.get('eccn', '')
-                # ECCN番号は複数含まれる場合がある（例: "0A998, 0A999"）
-                if eccn_number_clean in eccn.upper().replace(' ', ''):
-                    return {
-                        "ECCN番号": eccn,
-                        "カテゴリー": f"{category.get('category_number', '')} - {category.get('title', '')}",
-                        "グループ": f"{group.get('group_letter', '')} - {group.get('group_title', '')}",
-                        "説明": item.get('description', '')
-                    }
+    # ECCN番号は複数含まれる場合がある（例: "0A998, 0A999"）→ 展開済みテーブルで直接引く
+    record = get_eccn_lookup_table(eccn_json).lookup(eccn_number)
+    if record is None:
+        return None
     
-    return None
+    return {
+        "ECCN番号": record['eccn'],
+        "カテゴリー": f"{record['category_number']} - {record['category_title']}",
+        "グループ": f"{record['group_letter']} - {record['group_title']}",
+        "説明": record['description']
+    }
 
-def get_eccn_categories_summary(eccn_json: Dict) -> Dict[str, int]:
+def get_eccn_categories_summary(eccn_json: Optional[Dict] = None) -> Dict[str, int]:
     """
     ECCN番号のカテゴリー別統計を取得
     
     Args:
-        eccn_json: ECCN JSONデータ
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
         
     Returns:
         カテゴリー別のアイテム数
     """
     summary = {}
+    eccn_json = _resolve_eccn_json(eccn_json)
     
     if not eccn_json or 'ccl_categories' not in eccn_json:
         return summary
@@ -0,0 +1,488 @@
+"""
+ベクトルストア
+許可例外RAGの検索先を設定で切り替える（Pinecone / ローカルのNumPy行列）。
+ローカルのストアはPineconeのIndexと同じ query / upsert / fetch / delete / list / describe_index_stats を持ち、
+LicenseExceptionRAG からはどちらも同じように使える。
+
+ローカルのストアはnamespaceごとにID・ベクトル（float32、正規化済み）・メタデータを1つの .npz に保存する。
+検索はコサイン類似度の全件比較（exact）か、k-meansで分割したリスト（IVF）のうちクエリに近いものだけを比較する方法を選べる。
+メタデータのフィルタはPineconeの構文（$eq / $ne / $in / $nin / $gt / $gte / $lt / $lte / $and / $or）に対応する。
+
+環境変数:
+    VECTOR_STORE         pinecone（既定）/ local
+    VECTOR_STORE_PATH    ローカルのストアの保存先（既定: .cache/vector_store）
+    VECTOR_STORE_SEARCH  exact / ivf / auto（既定: auto。IVF_MIN_VECTORS 件以上のnamespaceはIVF）
+    VECTOR_STORE_NPROBE  IVFで比較するリスト数（既定: 8）
+
+使い方（Pineconeのインデックスの内容をローカルのストアにコピー）:
+    python vector_store.py export
+"""
+
+import json
+import math
+import os
+import sys
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from data_registry import BASE_DIR
+from lazy_imports import lazy_import
+
+# Pineconeのインデックス名・namespace（ユーザーのPineconeホストURLから判断: license-exceptions）
+INDEX_NAME = "license-exceptions"
+NAMESPACE = "license_exceptions"
+# 登録・検索に使うembeddingの設定（Pineconeインデックスの次元数に合わせる）
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1024
+
+STORE_PATH = BASE_DIR / ".cache" / "vector_store"
+SEARCH_MODES = ("exact", "ivf", "auto")
+DEFAULT_NPROBE = 8
+# この件数未満のnamespaceは auto でも全件比較する（小さい行列はIVFより全件比較の方が速い）
+IVF_MIN_VECTORS = 5000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 50000
+# namespaceごとに保持するフィルタの一致行の数
+MAX_FILTER_CACHE = 64
+
+_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value > operand,
+    "$gte": lambda value, operand: value >= operand,
+    "$lt": lambda value, operand: value < operand,
+    "$lte": lambda value, operand: value <= operand,
+}
+# 否定の演算子はメタデータに値が無いレコードにも一致する
+_NEGATIVE_OPERATORS = {"$ne", "$nin"}
+
+
+def matches_filter(metadata: Optional[Dict[str, Any]], filter: Dict[str, Any]) -> bool:
+    """
+    メタデータがPinecone形式のフィルタに一致するか
+
+    値がリストのメタデータは、いずれかの要素が一致すれば一致とする（否定の演算子はすべての要素）。
+
+    Args:
+        metadata: レコードのメタデータ
+        filter: フィルタ（例: {"exception": {"$in": ["LVS", "GBS"]}, "part": 740}）
+
+    Returns:
+        一致すればTrue
+    """
+    metadata = metadata or {}
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        value = metadata.get(key)
+        for operator, operand in condition.items():
+            compare = _OPERATORS.get(operator)
+            if compare is None:
+                raise ValueError(f"未対応のフィルタ演算子です: {operator}")
+            if value is None:
+                if operator not in _NEGATIVE_OPERATORS:
+                    return False
+                continue
+            values = value if isinstance(value, list) else [value]
+            try:
+                if operator in _NEGATIVE_OPERATORS:
+                    matched = all(compare(v, operand) for v in values)
+                else:
+                    matched = any(compare(v, operand) for v in values)
+            except TypeError:
+                # 型が比較できない値（数値と文字列等）は一致しない
+                matched = False
+            if not matched:
+                return False
+    return True
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの上位k件の位置（スコアの降順）"""
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class IVFIndex:
+    """
+    k-means（球面）でベクトルをリストに分割した転置ファイル
+
+    検索時はクエリに近い nprobe 個のリストに属するベクトルだけを比較する。
+    """
+
+    def __init__(self, matrix: np.ndarray, nlist: Optional[int] = None, seed: int = 0):
+        n = len(matrix)
+        self.nlist = max(1, min(nlist or int(math.sqrt(n)), n))
+        rng = np.random.default_rng(seed)
+        sample = matrix[rng.choice(n, size=min(n, KMEANS_SAMPLE_SIZE), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=self.nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(self.nlist):
+                members = sample[assignments == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = _normalize_rows(centroids)
+        self.centroids = centroids.astype(np.float32)
+        assignments = np.argmax(matrix @ self.centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assignments == i) for i in range(self.nlist)]
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """クエリに近いリストに属する行番号"""
+        probe = _top_k(self.centroids @ query, min(nprobe, self.nlist))
+        return np.concatenate([self.lists[i] for i in probe])
+
+
+class _Namespace:
+    """1つのnamespaceのID・ベクトル・メタデータ"""
+
+    def __init__(self, ids: List[str], matrix: np.ndarray, metadata: List[Dict[str, Any]]):
+        self.ids = ids
+        self.matrix = matrix
+        self.metadata = metadata
+        self.positions = {record_id: i for i, record_id in enumerate(ids)}
+        self.ivf: Optional[IVFIndex] = None
+        # フィルタ（JSON） → 一致する行番号（同じフィルタの検索でメタデータを毎回照合しない）
+        self.filter_rows: Dict[str, np.ndarray] = {}
+
+    def rows_matching(self, filter: Dict[str, Any]) -> np.ndarray:
+        key = json.dumps(filter, sort_keys=True, ensure_ascii=False, default=str)
+        rows = self.filter_rows.get(key)
+        if rows is None:
+            rows = np.array([i for i, metadata in enumerate(self.metadata) if matches_filter(metadata, filter)], dtype=np.int64)
+            if len(self.filter_rows) >= MAX_FILTER_CACHE:
+                self.filter_rows.pop(next(iter(self.filter_rows)))
+            self.filter_rows[key] = rows
+        return rows
+
+
+def _as_record(vector: Any) -> Dict[str, Any]:
+    """upsert の1件（辞書・(id, values, metadata) のタプル・Vectorオブジェクト）を辞書に揃える"""
+    if isinstance(vector, dict):
+        return {"id": vector["id"], "values": vector["values"], "metadata": vector.get("metadata") or {}}
+    if isinstance(vector, (tuple, list)):
+        return {"id": vector[0], "values": vector[1], "metadata": (vector[2] if len(vector) > 2 else None) or {}}
+    return {"id": vector.id, "values": vector.values, "metadata": getattr(vector, "metadata", None) or {}}
+
+
+class LocalVectorStore:
+    """
+    ローカルに保存するベクトルストア（PineconeのIndex互換）
+
+    スコアはコサイン類似度。namespaceは初回利用時にファイルから読み込み、更新のたびに書き出す。
+    """
+
+    store_name = "local"
+
+    def __init__(self, path: Path = STORE_PATH, search: str = "auto", nprobe: int = DEFAULT_NPROBE):
+        if search not in SEARCH_MODES:
+            raise ValueError(f"未対応の検索方法です: {search}（{' / '.join(SEARCH_MODES)}）")
+        self.path = Path(path)
+        self.search = search
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._namespaces: Dict[str, _Namespace] = {}
+
+    def _file(self, namespace: str) -> Path:
+        return self.path / f"{namespace or '_default'}.npz"
+
+    def _load(self, namespace: str) -> _Namespace:
+        data = self._namespaces.get(namespace)
+        if data is None:
+            file = self._file(namespace)
+            if file.exists():
+                with np.load(file, allow_pickle=False) as npz:
+                    data = _Namespace(npz["ids"].tolist(), npz["matrix"], json.loads(str(npz["metadata"])))
+            else:
+                data = _Namespace([], np.zeros((0, 0), dtype=np.float32), [])
+            self._namespaces[namespace] = data
+        return data
+
+    def _save(self, namespace: str, data: _Namespace):
+        self.path.mkdir(parents=True, exist_ok=True)
+        file = self._file(namespace)
+        temp = file.with_suffix(".tmp.npz")
+        np.savez(
+            temp,
+            ids=np.array(data.ids, dtype=str),
+            matrix=data.matrix,
+            metadata=np.array(json.dumps(data.metadata, ensure_ascii=False))
+        )
+        os.replace(temp, file)
+
+    def _use_ivf(self, data: _Namespace) -> bool:
+        if self.search == "auto":
+            return len(data.ids) >= IVF_MIN_VECTORS
+        return self.search == "ivf"
+
+    def query(
+        self,
+        vector: Optional[List[float]] = None,
+        top_k: int = 10,
+        include_metadata: bool = False,
+        include_values: bool = False,
+        namespace: Optional[str] = None,
+        filter: Optional[Dict[str, Any]] = None,
+        id: Optional[str] = None,
+        **kwargs
+    ):
+        """
+        類似度の高い順にレコードを検索
+
+        Args:
+            vector: クエリベクトル
+            top_k: 取得する件数
+            include_metadata: メタデータを含める
+            include_values: ベクトルを含める
+            namespace: namespace
+            filter: メタデータのフィルタ（Pinecone形式）
+            id: ベクトルの代わりに保存済みのレコードのIDで検索
+
+        Returns:
+            .matches（id・score・metadata・values）を持つ結果
+        """
+        namespace = namespace or ""
+        with self._lock:
+            data = self._load(namespace)
+            if id is not None:
+                if id not in data.positions:
+                    return SimpleNamespace(matches=[], namespace=namespace)
+                vector = data.matrix[data.positions[id]]
+            if self._use_ivf(data) and data.ivf is None and data.ids:
+                data.ivf = IVFIndex(data.matrix)
+        if not data.ids or vector is None:
+            return SimpleNamespace(matches=[], namespace=namespace)
+
+        query = np.asarray(vector, dtype=np.float32)
+        if query.shape[0] != data.matrix.shape[1]:
+            raise ValueError(f"ベクトルの次元数が一致しません: {query.shape[0]}（ストア: {data.matrix.shape[1]}）")
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+
+        rows = None
+        if filter:
+            with self._lock:
+                rows = data.rows_matching(filter)
+        if data.ivf is not None and self._use_ivf(data):
+            candidates = data.ivf.candidates(query, self.nprobe)
+            if rows is not None:
+                candidates = np.intersect1d(candidates, rows, assume_unique=True)
+            # 近傍のリストに十分な件数が無ければ全件比較に切り替える（取りこぼしを防ぐ）
+            if len(candidates) >= top_k:
+                rows = candidates
+        if rows is None:
+            scores = data.matrix @ query
+            top = _top_k(scores, top_k)
+            top_scores = scores[top]
+        else:
+            scores = data.matrix[rows] @ query
+            best = _top_k(scores, top_k)
+            top, top_scores = rows[best], scores[best]
+        matches = [
+            SimpleNamespace(
+                id=data.ids[row],
+                score=float(score),
+                metadata=data.metadata[row] if include_metadata else None,
+                values=data.matrix[row].tolist() if include_values else [],
+            )
+            for row, score in zip(top, top_scores)
+        ]
+        return SimpleNamespace(matches=matches, namespace=namespace)
+
+    def upsert(self, vectors: Iterable[Any], namespace: Optional[str] = None, **kwargs):
+        """レコードを追加・更新（同じIDのレコードは置き換える）"""
+        namespace = namespace or ""
+        records = [_as_record(vector) for vector in vectors]
+        if not records:
+            return SimpleNamespace(upserted_count=0)
+        new_matrix = _normalize_rows(np.asarray([record["values"] for record in records], dtype=np.float32))
+        with self._lock:
+            data = self._load(namespace)
+            if data.ids and new_matrix.shape[1] != data.matrix.shape[1]:
+                raise ValueError(f"ベクトルの次元数が一致しません: {new_matrix.shape[1]}（ストア: {data.matrix.shape[1]}）")
+            ids, metadata = list(data.ids), list(data.metadata)
+            positions = dict(data.positions)
+            matrix = data.matrix if data.ids else np.zeros((0, new_matrix.shape[1]), dtype=np.float32)
+            appended = []
+            for i, record in enumerate(records):
+                position = positions.get(record["id"])
+                if position is None:
+                    positions[record["id"]] = len(ids) + len(appended)
+                    appended.append(i)
+                else:
+                    # 既存のレコードは行列をコピーしてから置き換える（検索中の行列は変更しない）
+                    if matrix is data.matrix:
+                        matrix = matrix.copy()
+                    matrix[position] = new_matrix[i]
+                    metadata[position] = record["metadata"]
+            if appended:
+                matrix = np.vstack([matrix, new_matrix[appended]])
+                ids.extend(records[i]["id"] for i in appended)
+                metadata.extend(records[i]["metadata"] for i in appended)
+            data = self._namespaces[namespace] = _Namespace(ids, matrix, metadata)
+            self._save(namespace, data)
+        return SimpleNamespace(upserted_count=len(records))
+
+    def delete(self, ids: Optional[List[str]] = None, namespace: Optional[str] = None, delete_all: bool = False, **kwargs):
+        """レコードを削除"""
+        namespace = namespace or ""
+        with self._lock:
+            data = self._load(namespace)
+            removed = set(data.ids) if delete_all else set(ids or []) & set(data.positions)
+            if not removed:
+                return {}
+            keep = [i for i, record_id in enumerate(data.ids) if record_id not in removed]
+            matrix = data.matrix[keep] if keep else np.zeros((0, 0), dtype=np.float32)
+            data = self._namespaces[namespace] = _Namespace(
+                [data.ids[i] for i in keep], matrix, [data.metadata[i] for i in keep]
+            )
+            self._save(namespace, data)
+        return {}
+
+    def fetch(self, ids: List[str], namespace: Optional[str] = None, **kwargs):
+        """IDでレコードを取得"""
+        namespace = namespace or ""
+        with self._lock:
+            data = self._load(namespace)
+        vectors = {
+            record_id: SimpleNamespace(
+                id=record_id,
+                values=data.matrix[data.positions[record_id]].tolist(),
+                metadata=data.metadata[data.positions[record_id]]
+            )
+            for record_id in ids if record_id in data.positions
+        }
+        return SimpleNamespace(vectors=vectors, namespace=namespace)
+
+    def list(self, namespace: Optional[str] = None, prefix: Optional[str] = None, limit: int = 100, **kwargs) -> Iterator[List[str]]:
+        """IDを limit 件ずつ列挙"""
+        with self._lock:
+            ids = list(self._load(namespace or "").ids)
+        if prefix:
+            ids = [record_id for record_id in ids if record_id.startswith(prefix)]
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def describe_index_stats(self, **kwargs):
+        """namespaceごとのベクトル数と次元数"""
+        with self._lock:
+            namespaces = {file.stem: None for file in self.path.glob("*.npz") if not file.name.endswith(".tmp.npz")}
+            namespaces = {("" if name == "_default" else name): None for name in namespaces}
+            namespaces.update({name: None for name in self._namespaces})
+            loaded = {name: self._load(name) for name in namespaces}
+        dimension = next((data.matrix.shape[1] for data in loaded.values() if data.ids), None)
+        return SimpleNamespace(
+            dimension=dimension,
+            total_vector_count=sum(len(data.ids) for data in loaded.values()),
+            namespaces={name: SimpleNamespace(vector_count=len(data.ids)) for name, data in loaded.items()},
+        )
+
+
+_local_store: Optional[LocalVectorStore] = None
+_local_lock = threading.Lock()
+
+
+def get_local_vector_store() -> LocalVectorStore:
+    """プロセス全体で共有されるローカルのベクトルストアを取得"""
+    global _local_store
+    if _local_store is None:
+        with _local_lock:
+            if _local_store is None:
+                _local_store = LocalVectorStore(
+                    path=Path(os.getenv("VECTOR_STORE_PATH", STORE_PATH)),
+                    search=os.getenv("VECTOR_STORE_SEARCH", "auto"),
+                    nprobe=int(os.getenv("VECTOR_STORE_NPROBE", DEFAULT_NPROBE))
+                )
+    return _local_store
+
+
+def open_pinecone_index():
+    """PineconeのIndexに接続（pineconeはここで読み込む）"""
+    api_key = os.getenv("PINECONE_API_KEY")
+    if not api_key:
+        raise ValueError("PINECONE_API_KEY が設定されていません")
+    Pinecone = lazy_import("pinecone").Pinecone
+    # インデックス名は環境に応じて変更してください
+    return Pinecone(api_key=api_key).Index(INDEX_NAME)
+
+
+def open_vector_index(backend: Optional[str] = None):
+    """
+    設定されたベクトルストアを開く
+
+    Args:
+        backend: "pinecone" / "local"（省略時は VECTOR_STORE）
+
+    Returns:
+        PineconeのIndex互換のオブジェクト
+    """
+    backend = (backend or os.getenv("VECTOR_STORE", "pinecone")).strip().lower()
+    if backend == "local":
+        return get_local_vector_store()
+    if backend == "pinecone":
+        return open_pinecone_index()
+    raise ValueError(f"未対応のベクトルストアです: {backend}（pinecone / local）")
+
+
+def vector_store_name(index) -> str:
+    """計測・表示用のベクトルストア名"""
+    return getattr(index, "store_name", "pinecone")
+
+
+def copy_namespace(source, target, namespace: str = NAMESPACE, batch_size: int = 100) -> int:
+    """
+    namespaceの全レコードを別のベクトルストアにコピー
+
+    Args:
+        source: コピー元（list と fetch を持つIndex）
+        target: コピー先
+        namespace: namespace
+        batch_size: 1回に取得する件数
+
+    Returns:
+        コピーした件数
+    """
+    records = []
+    for ids in source.list(namespace=namespace, limit=batch_size):
+        fetched = source.fetch(ids=list(ids), namespace=namespace)
+        records.extend(
+            {"id": vector.id, "values": list(vector.values), "metadata": dict(vector.metadata or {})}
+            for vector in fetched.vectors.values()
+        )
+    # 書き出しを1回にするため全件をまとめて登録する
+    target.upsert(vectors=records, namespace=namespace)
+    return len(records)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["export"]:
+        print(__doc__)
+        sys.exit(1)
+    from dotenv import load_dotenv
+    load_dotenv()
+    count = copy_namespace(open_pinecone_index(), get_local_vector_store())
+    print(f"{INDEX_NAME}/{NAMESPACE} の {count} 件を {os.getenv('VECTOR_STORE_PATH', STORE_PATH)} にコピーしました")
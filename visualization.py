@@ -3,12 +3,18 @@
 カントリーチャート、ECCN規制の視覚化
 """
 
+import unicodedata
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import streamlit as st
 from typing import Dict, List, Optional
 
+from country_index import get_country_chart_index
+from data_registry import get_registry, get_reference_data
+from eccn_index import get_eccn_lookup_table, is_eccn_pattern
+from utils import find_eccns_by_pattern, search_eccn_json
+from lazy_imports import lazy_import
+
 def create_country_chart_heatmap(country_chart_df: pd.DataFrame, eccn_number: Optional[str] = None):
     """
     カントリーチャートをヒートマップで可視化
@@ -26,13 +32,14 @@ def create_country_chart_heatmap(country_chart_df: pd.DataFrame, eccn_number: Op
     # 規制理由の列（CB 1, NS 1等）を取得
     regulation_columns = country_chart_df.columns[1:17]  # CB 1からAT 2まで
     
-    # データを数値化（Xを1、空白を0に）
-    data_matrix = country_chart_df[regulation_columns].copy()
-    data_matrix = data_matrix.replace('X', 1).fillna(0)
+    # 事前計算済みのブール行列（Xを1、空白を0に）
+    chart_index = get_country_chart_index(country_chart_df)
+    data_matrix = np.asarray(chart_index.matrix, dtype=np.int8)
     
     # ヒートマップ作成
+    go = lazy_import("plotly.graph_objects")
     fig = go.Figure(data=go.Heatmap(
-        z=data_matrix.values,
+        z=data_matrix,
         x=regulation_columns,
         y=countries,
         colorscale=[
@@ -80,43 +87,27 @@ def create_world_map_restrictions(country_chart_df: pd.DataFrame, eccn_number: s
     if country_chart_df is None or country_chart_df.empty:
         return None
     
-    # 国名と規制状況を取得
-    countries = country_chart_df.iloc[:, 0].tolist()
+    # 国名と規制状況を取得（事前計算済みのブール行列の1列）
+    chart_index = get_country_chart_index(country_chart_df)
+    restrictions = chart_index.reason_column(regulation_reason)
     
     # 規制理由の列が存在するか確認
-    if regulation_reason not in country_chart_df.columns:
+    if restrictions is None:
         return None
     
-    restrictions = country_chart_df[regulation_reason].tolist()
-    
     # データフレーム作成
     map_data = pd.DataFrame({
-        'country': countries,
-        'restriction': ['許可必要' if r == 'X' else '許可不要' for r in restrictions],
-        'status': [1 if r == 'X' else 0 for r in restrictions]
+        'country': chart_index.country_names,
+        'restriction': np.where(restrictions, '許可必要', '許可不要'),
+        'status': restrictions.astype(int)
     })
     
-    # 国名を標準化（ISO3コードに変換）
-    # 簡易的なマッピング（実際にはより詳細なマッピングが必要）
-    country_mapping = {
-        'China (P.R.C.)': 'CHN',
-        'Russia': 'RUS',
-        'Japan': 'JPN',
-        'United States': 'USA',
-        'United Kingdom': 'GBR',
-        'Germany': 'DEU',
-        'France': 'FRA',
-        'South Korea': 'KOR',
-        'North Korea': 'PRK',
-        'Iran': 'IRN',
-        'Syria': 'SYR',
-        'Cuba': 'CUB',
-        # 他の国も追加...
-    }
-    
-    map_data['iso_alpha'] = map_data['country'].map(country_mapping)
+    # 国名を標準化（別名索引で解決した国ID = ISO3コード）
+    known = chart_index.aliases.countries
+    map_data['iso_alpha'] = [country_id if country_id in known else None for country_id in chart_index.country_ids]
     
     # 世界地図作成
+    px = lazy_import("plotly.express")
     fig = px.choropleth(
         map_data,
         locations='iso_alpha',
@@ -159,13 +150,8 @@ def create_regulation_summary_chart(country_chart_df: pd.DataFrame):
     if country_chart_df is None or country_chart_df.empty:
         return None
     
-    # 規制理由の列
-    regulation_columns = country_chart_df.columns[1:17]
-    
-    # 各規制理由での「X」の数をカウント
-    restriction_counts = {}
-    for col in regulation_columns:
-        restriction_counts[col] = (country_chart_df[col] == 'X').sum()
+    # 各規制理由での「X」の数をカウント（ブール行列の列和）
+    restriction_counts = get_country_chart_index(country_chart_df).restriction_counts()
     
     # データフレーム作成
     summary_df = pd.DataFrame({
@@ -174,6 +160,7 @@ def create_regulation_summary_chart(country_chart_df: pd.DataFrame):
     })
     
     # 棒グラフ作成
+    px = lazy_import("plotly.express")
     fig = px.bar(
         summary_df,
         x='規制理由',
@@ -193,13 +180,17 @@ def create_regulation_summary_chart(country_chart_df: pd.DataFrame):
     return fig
 
 
-def create_interactive_eccn_table(eccn_json: Dict):
-    """
-    クリック可能なECCNテーブルを作成
-    """
-    if not eccn_json:
-        return None
-    
+# ECCNテーブルの検索用列（正規化済みの全列連結テキスト。表示時は非表示にする）
+ECCN_SEARCH_COLUMN = "_search"
+
+
+def normalize_search_text(text: str) -> str:
+    """検索用にテキストを正規化（全角→半角、小文字化）"""
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def _build_eccn_table(eccn_json: Dict) -> pd.DataFrame:
+    """ECCNテーブルを構築（検索用列を含む）"""
     # ECCNデータを平坦化
     eccn_list = []
     for category in eccn_json.get('ccl_categories', []):
@@ -219,19 +210,102 @@ def create_interactive_eccn_table(eccn_json: Dict):
                 })
     
     df = pd.DataFrame(eccn_list)
+    return add_search_column(df)
+
+
+def add_search_column(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    全列を連結・正規化した検索用列を追加
+    
+    pyarrowが使える場合はArrow文字列型にして、部分一致検索をC++実装で行う。
+    """
+    if df.empty:
+        df[ECCN_SEARCH_COLUMN] = pd.Series(dtype=str)
+        return df
+    
+    display_columns = [col for col in df.columns if col != ECCN_SEARCH_COLUMN]
+    search_text = df[display_columns].fillna('').astype(str).agg('\n'.join, axis=1).map(normalize_search_text)
+    try:
+        search_text = search_text.astype("string[pyarrow]")
+    except (ImportError, TypeError):
+        pass
+    df[ECCN_SEARCH_COLUMN] = search_text
     return df
 
 
-def display_reference_data(eccn_number: str, country: str, eccn_json: Dict, country_chart_df: pd.DataFrame):
+def create_interactive_eccn_table(eccn_json: Optional[Dict] = None):
+    """
+    クリック可能なECCNテーブルを作成
+    
+    共有レジストリのデータの場合はバージョンごとに一度だけ構築し、全セッションで共有する
+    （返されたDataFrameは変更しないこと）。検索用の列 ECCN_SEARCH_COLUMN を含む。
+    """
+    registry = get_registry()
+    if eccn_json is None or eccn_json is registry.get().get('eccn_json'):
+        if registry.get().get('eccn_json') is None:
+            return None
+        return registry.get_derived("eccn_table", lambda data: _build_eccn_table(data['eccn_json']))
+    
+    if not eccn_json:
+        return None
+    
+    return _build_eccn_table(eccn_json)
+
+
+def filter_eccn_table(eccn_df: pd.DataFrame, keyword: str, eccn_json: Optional[Dict] = None) -> pd.DataFrame:
+    """
+    ECCNテーブルをキーワードで絞り込む
+    
+    通常のキーワードは検索用列に対するベクトル化された部分一致（大文字小文字・全角半角を区別しない）で絞り込み、
+    関連度（BM25）の高い順に並べる。"5A0*" のようなECCN番号パターンはECCN番号トライで絞り込む。
+    
+    Args:
+        eccn_df: create_interactive_eccn_table() の返り値
+        keyword: 検索キーワード
+        eccn_json: ECCN JSONデータ（省略時は共有レジストリのデータ）
+        
+    Returns:
+        絞り込んだDataFrame
+    """
+    if not keyword or eccn_df is None or eccn_df.empty:
+        return eccn_df
+    
+    if is_eccn_pattern(keyword):
+        matched_eccns = {hit["ECCN番号"] for hit in find_eccns_by_pattern(keyword, eccn_json)}
+        return eccn_df[eccn_df['ECCN番号'].isin(matched_eccns)]
+    
+    if ECCN_SEARCH_COLUMN not in eccn_df.columns:
+        eccn_df = add_search_column(eccn_df.copy())
+    
+    mask = eccn_df[ECCN_SEARCH_COLUMN].str.contains(normalize_search_text(keyword), regex=False)
+    filtered_df = eccn_df[mask.fillna(False).to_numpy(dtype=bool)]
+    
+    # 関連度順に並べ替え（インデックスにヒットしない行は元の順序のまま後ろへ）
+    ranked_eccns = [hit["ECCN番号"] for hit in search_eccn_json(keyword, eccn_json)]
+    if ranked_eccns and not filtered_df.empty:
+        rank = {eccn: i for i, eccn in enumerate(ranked_eccns)}
+        order = filtered_df['ECCN番号'].map(rank).fillna(len(rank)).to_numpy()
+        filtered_df = filtered_df.iloc[order.argsort(kind='stable')]
+    
+    return filtered_df
+
+
+def display_reference_data(eccn_number: str, country: str, eccn_json: Optional[Dict] = None, country_chart_df: Optional[pd.DataFrame] = None):
     """
     参照データを表示（分析結果の根拠）
     
     Args:
         eccn_number: ECCN番号
         country: 対象国
-        eccn_json: ECCNデータベース
-        country_chart_df: カントリーチャート
+        eccn_json: ECCNデータベース（省略時は共有レジストリのデータ）
+        country_chart_df: カントリーチャート（省略時は共有レジストリのデータ）
     """
+    reference_data = get_reference_data()
+    if eccn_json is None:
+        eccn_json = reference_data.get('eccn_json')
+    if country_chart_df is None:
+        country_chart_df = reference_data.get('country_chart')
+    
     st.markdown("---")
     st.markdown("### 📚 参照データ（分析の根拠）")
     
@@ -240,21 +314,16 @@ def display_reference_data(eccn_number: str, country: str, eccn_json: Dict, coun
     with col1:
         st.markdown("#### 🔢 ECCN番号詳細")
         
-        # ECCN詳細を検索
-        eccn_detail = None
-        if eccn_json:
-            for category in eccn_json.get('ccl_categories', []):
-                for group in category.get('product_groups', []):
-                    for item in group.get('items', []):
-                        if item.get('eccn', '') == eccn_number:
-                            eccn_detail = item
-                            break
+        # ECCN詳細を直接引きテーブルから取得
+        eccn_detail = get_eccn_lookup_table(eccn_json).lookup(eccn_number) if eccn_json else None
         
         if eccn_detail:
             st.info(f"""
-            **ECCN番号**: {eccn_detail.get('eccn', 'N/A')}  
-            **説明**: {eccn_detail.get('description', 'N/A')}  
-            **規制理由**: {eccn_detail.get('reason_for_control', 'N/A')}  
+            **ECCN番号**: {eccn_detail.get('eccn') or 'N/A'}  
+            **カテゴリー**: {eccn_detail.get('category_number', '')} - {eccn_detail.get('category_title', '')}  
+            **グループ**: {eccn_detail.get('group_letter', '')} - {eccn_detail.get('group_title', '')}  
+            **説明**: {eccn_detail.get('description') or 'N/A'}  
+            **規制理由**: {eccn_detail.get('reason_for_control') or 'N/A'}  
             **参照**: Commerce Control List (CCL)
             """)
         else:
@@ -265,7 +334,9 @@ def display_reference_data(eccn_number: str, country: str, eccn_json: Dict, coun
         
         # 対象国の規制状況を検索
         if country_chart_df is not None and not country_chart_df.empty:
-            country_row = country_chart_df[country_chart_df.iloc[:, 0].str.contains(country, case=False, na=False)]
+            # 別名索引で国IDに解決して該当行を取得（"ベトナム"・"VN" 等も可）
+            row = get_country_chart_index(country_chart_df).row_for(country)
+            country_row = country_chart_df.iloc[[row]] if row is not None else country_chart_df.iloc[0:0]
             
             if not country_row.empty:
                 st.info(f"""
@@ -281,10 +352,13 @@ def display_reference_data(eccn_number: str, country: str, eccn_json: Dict, coun
                 st.warning(f"国名 {country} がカントリーチャートに見つかりません")
 
 
-def create_entity_list_viewer(sample_data: Dict):
+def create_entity_list_viewer(sample_data: Optional[Dict] = None):
     """
     Entity List / DPL / UVL / MEU の検索可能なビューワー
     """
+    if sample_data is None:
+        sample_data = get_reference_data()
+    
     st.markdown("### 🚨 制裁リスト検索")
     
     search_term = st.text_input("🔍 企業名・個人名・住所で検索", placeholder="例: Huawei, SMIC, Moscow")